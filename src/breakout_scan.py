@@ -0,0 +1,202 @@
+"""
+Switch-and-measure scan of QSwitch lines through the BNC breakouts.
+
+Each step connects one line to one breakout (and lifts its soft ground), and
+takes a QDAC-II measurement on the channel of that line.  The relay changes
+between consecutive steps are worked out in advance as minimal diffs.
+A line is grounded while its breakouts change: the ground is closed first,
+then the old breakout is opened, the new one closed, and the ground lifted
+last, so that a line never connects two breakouts, and never floats, even
+for a moment.  The changes for the next step are handed to a worker thread
+as soon as a measurement is in, and the settling time is counted from when
+the last of them was done.
+
+Results are written into NumPy arrays as the scan goes, together with the
+time each step took.  Requires NumPy.  Use like this:
+
+import qdac2
+import qswitch_driver
+import common.connection as conn
+from breakout_scan import BreakoutScan
+qdac = qdac2.QDAC2(conn.find_qdac2_on_usb())
+qswitch = qswitch_driver.QSwitch(qswitch_driver.UDPConfig(ip='192.168.8.100'))
+result = BreakoutScan(qdac, qswitch, lines=range(1, 5)).run()
+print(result.values)
+print(result.switch_s.mean(), result.measure_s.mean())
+"""
+
+import numpy as np
+from concurrent.futures import Future
+from dataclasses import dataclass
+from time import monotonic, sleep as sleep_s
+from typing import Callable, FrozenSet, List, Optional, Sequence, Tuple
+from common.worker import InstrumentWorker
+import qdac2
+import qswitch_driver
+
+GROUND_TAP = 0
+
+Relays = FrozenSet[Tuple[int, int]]
+# Relays to close and relays to open, in one change on the QSwitch
+Move = Tuple[Relays, Relays]
+StepCallback = Callable[[int, int, float], None]
+
+
+@dataclass
+class ScanStep:
+    line: int
+    tap: int
+    # Relay changes from the previous step (or the starting state), in order
+    moves: List[Move]
+
+
+@dataclass
+class ScanResult:
+    lines: List[int]
+    taps: List[int]
+    # Element [i, j] belongs to lines[i] and taps[j], NaN if not measured
+    values: np.ndarray
+    # Time from commanding the relays until they were verified
+    switch_s: np.ndarray
+    # Time of the measurement
+    measure_s: np.ndarray
+    # Start of each step, from the start of the scan
+    started_s: np.ndarray
+    total_s: float = 0
+
+
+def scan_steps(lines: Sequence[int], taps: Sequence[int],
+               start: Relays) -> List[ScanStep]:
+    """
+    Relay changes that take each line through each breakout
+
+    Args:
+        lines: Lines to scan, in order
+        taps: Breakouts to visit on each line, in order
+        start: Relays closed before the scan
+    """
+    steps: List[ScanStep] = []
+    current = start
+    for line in lines:
+        for tap in taps:
+            target = (start - {(line, GROUND_TAP)}) | {(line, tap)}
+            steps.append(ScanStep(line, tap, break_before_make(current, target)))
+            current = target
+    return steps
+
+
+def break_before_make(current: Relays, target: Relays) -> List[Move]:
+    """
+    Split the change from one relay state to another so that no line gets a
+    new connection before its old ones are broken, and no line floats
+
+    Every line whose breakouts change is grounded first, together with the
+    opening of its old breakouts.  The new breakouts are then closed, and
+    the grounds that the target does not have are lifted after that, in the
+    same change, as the QSwitch closes relays before opening others.
+    """
+    changing_lines = {line for line, tap in current ^ target if tap != GROUND_TAP}
+    grounds = frozenset((line, GROUND_TAP) for line in changing_lines)
+    grounds |= frozenset(relay for relay in target if relay[1] == GROUND_TAP)
+    breakouts_to_open = frozenset(
+        relay for relay in current - target if relay[1] != GROUND_TAP)
+    breakouts_to_close = frozenset(
+        relay for relay in target - current if relay[1] != GROUND_TAP)
+    grounded = grounds - current
+    lifted = frozenset(relay for relay in current | grounds
+                       if relay[1] == GROUND_TAP and relay not in target)
+    moves = [(grounded, breakouts_to_open), (breakouts_to_close, lifted)]
+    return [(closing, opening) for closing, opening in moves if closing or opening]
+
+
+class BreakoutScan:
+    """
+    Measure every line on every breakout
+    """
+
+    def __init__(self, qdac: qdac2.QDAC2, qswitch: qswitch_driver.QSwitch,
+                 lines: Sequence[int] = range(1, 25),
+                 taps: Sequence[int] = range(1, 9),
+                 measure: str = 'read? (@{channel})',
+                 channel: Callable[[int], int] = lambda line: line,
+                 settle_s: float = 0.005):
+        """
+        Args:
+            lines: Lines to scan, in order
+            taps: Breakouts to visit on each line, in order
+            measure: SCPI query giving the measurement, {channel} is
+                     replaced by the QDAC-II channel
+            channel: QDAC-II channel that measures a line
+            settle_s: Time for the relays to settle before measuring
+        """
+        self.qdac = qdac
+        self.qswitch = qswitch
+        self.lines = list(lines)
+        self.taps = list(taps)
+        self.measure = measure
+        self.channel = channel
+        self.settle_s = settle_s
+
+    def run(self, on_step: Optional[StepCallback] = None) -> ScanResult:
+        """
+        Carry out the scan and put the relays back as they were
+
+        Args:
+            on_step: Called with line, tap and value after each measurement
+        """
+        start = frozenset(self.qswitch.closed_relays())
+        steps = scan_steps(self.lines, self.taps, start)
+        shape = (len(self.lines), len(self.taps))
+        result = ScanResult(self.lines, self.taps,
+                            np.full(shape, np.nan), np.zeros(shape),
+                            np.zeros(shape), np.zeros(shape))
+        relays = InstrumentWorker(self.qswitch)
+        try:
+            began = monotonic()
+            commanded = began
+            pending = self._move(relays, steps[0]) if steps else []
+            for index, step in enumerate(steps):
+                cell = np.unravel_index(index, shape)
+                result.started_s[cell] = commanded - began
+                for change in pending:
+                    change.result()
+                moved = pending[-1].result()
+                result.switch_s[cell] = moved - commanded
+                remaining = moved + self.settle_s - monotonic()
+                if remaining > 0:
+                    sleep_s(remaining)
+                measured = monotonic()
+                query = self.measure.format(channel=self.channel(step.line))
+                answer = self.qdac.query(query)
+                result.measure_s[cell] = monotonic() - measured
+                # Move on while the answer is being dealt with
+                if index + 1 < len(steps):
+                    following = steps[index + 1]
+                    commanded = monotonic()
+                    pending = self._move(relays, following)
+                result.values[cell] = float(answer)
+                if on_step:
+                    on_step(step.line, step.tap, result.values[cell])
+            result.total_s = monotonic() - began
+        finally:
+            restored = relays.submit(lambda: self._restore(start))
+            relays.close()
+            restored.result()
+        return result
+
+    def _move(self, relays: InstrumentWorker, step: ScanStep) -> List[Future]:
+        """
+        Queue the relay changes of a step, in order, followed by a call
+        giving the time at which they were done
+        """
+        changes = [relays.change_relays(close, open) for close, open in step.moves]
+        return changes + [relays.submit(monotonic)]
+
+    def _restore(self, relays: Relays) -> None:
+        """
+        Put the relays back in a state, breaking connections before making
+        new ones
+        """
+        current = frozenset(self.qswitch.closed_relays())
+        for close, open in break_before_make(current, relays):
+            self.qswitch.change_relays(close, open)
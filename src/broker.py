@@ -0,0 +1,340 @@
+"""
+Broker that lets several processes share one serial-attached QDAC-II or
+QSwitch.
+
+The broker owns the VISA connection and serves write/query requests from
+clients over a Unix socket.  Requests are executed one at a time, highest
+priority (lowest number) first.  Identical read-only queries that are waiting
+to be executed are answered by a single round trip to the instrument.
+
+After a write or clear, the broker only serves the same client until it
+sends a query, or for HOLD_S at most, so that the error query a driver sends
+after its commands reads the errors of those commands and not the errors of
+another client.  A request that has not been answered after
+REQUEST_TIMEOUT_S fails with an error.
+
+Start the broker like this:
+
+$ python src/broker.py qswitch --socket /tmp/qswitch.sock
+
+or for a specific address:
+
+$ python src/broker.py qdac2 --address ASRL/dev/ttyUSB0::INSTR --socket /tmp/qdac2.sock
+
+Then, in any number of processes, use BrokerResource in place of the VISA
+resource:
+
+import qswitch
+import broker
+switch = qswitch.QSwitch(broker.BrokerResource('/tmp/qswitch.sock'))
+print(switch.query('stat?'))
+"""
+
+import sys
+import os
+import json
+import socket
+import socketserver
+import threading
+import queue
+import itertools
+import argparse
+import pyvisa as visa
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Dict, List, Optional, Set, Tuple
+import common.connection as conn
+
+DEFAULT_PRIORITY = 10
+# Longest time a client keeps the instrument to itself between a write and
+# the query that follows it
+HOLD_S = 1.0
+# Longest wait for the answer to a request, in the broker and in the client
+REQUEST_TIMEOUT_S = 30.0
+
+# Queries that do not change the state of the instrument, so that concurrent
+# identical requests can share one answer.  Note that the error queries (all?,
+# syst:err:all?) are not in here, as they clear the error queue.
+READ_ONLY_QUERIES = frozenset([
+    '*idn?', '*opc?', 'stat?', 'clos:stat?', 'aut?', 'beep:stat?',
+    'syst:comm:lan:ipad?', 'syst:comm:lan:mac?', 'syst:comm:lan:gat?',
+    'syst:comm:lan:smas?', 'syst:comm:lan:host?', 'syst:comm:lan:dhcp?',
+])
+
+
+def is_read_only(cmd: str) -> bool:
+    return cmd.strip().lower() in READ_ONLY_QUERIES
+
+
+@dataclass
+class _Request:
+    op: str
+    cmd: str
+    # Clients that sent the request
+    clients: Set[int] = field(default_factory=set)
+    waiters: List['_Waiter'] = field(default_factory=list)
+
+
+class _Waiter:
+    def __init__(self):
+        self._done = threading.Event()
+        self.answer: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def deliver(self, answer: Optional[str], error: Optional[str]) -> None:
+        self.answer = answer
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout_s: Optional[float] = None) -> bool:
+        """
+        Returns:
+            False if there was no answer within the timeout
+        """
+        return self._done.wait(timeout_s)
+
+
+class Broker:
+    """
+    Serialise access to a VISA resource for clients on a Unix socket
+    """
+
+    def __init__(self, resource: visa.Resource, socket_path: str):
+        self._resource = resource
+        self._socket_path = socket_path
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._pending: Dict[str, _Request] = dict()
+        self._pending_lock = threading.Lock()
+        self._clients = itertools.count()
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+
+    def serve_forever(self) -> None:
+        """
+        Run the broker until interrupted
+        """
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                broker._handle_client(self.rfile, self.wfile)
+
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self._socket_path, Handler)
+        self._server.daemon_threads = True
+        worker = threading.Thread(target=self._run_worker, daemon=True,
+                                  name='BrokerWorker')
+        worker.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.unlink(self._socket_path)
+
+    def shutdown(self) -> None:
+        """
+        Stop serving clients
+        """
+        if self._server:
+            self._server.shutdown()
+
+    def submit(self, op: str, cmd: str, priority: int = DEFAULT_PRIORITY,
+               client: int = -1) -> _Waiter:
+        """
+        Queue a request for the instrument
+
+        Args:
+            client: Identifies the sender, see _handle_client()
+        """
+        waiter = _Waiter()
+        with self._pending_lock:
+            if op == 'query' and is_read_only(cmd):
+                key = cmd.strip().lower()
+                request = self._pending.get(key)
+                if request:
+                    request.clients.add(client)
+                    request.waiters.append(waiter)
+                    return waiter
+                request = _Request(op, cmd, {client}, [waiter])
+                self._pending[key] = request
+            else:
+                request = _Request(op, cmd, {client}, [waiter])
+        self._queue.put((priority, next(self._sequence), request))
+        return waiter
+
+    def _handle_client(self, rfile, wfile) -> None:
+        client = next(self._clients)
+        for line in rfile:
+            try:
+                message = json.loads(line)
+                op = message['op']
+                if op not in ('write', 'query', 'clear'):
+                    raise ValueError(f'Unknown operation {op}')
+                waiter = self.submit(op, message.get('cmd', ''),
+                                     int(message.get('priority',
+                                                     DEFAULT_PRIORITY)),
+                                     client)
+                if waiter.wait(REQUEST_TIMEOUT_S):
+                    reply = {'answer': waiter.answer, 'error': waiter.error}
+                else:
+                    reply = {'answer': None,
+                             'error': f'No answer within {REQUEST_TIMEOUT_S} s'}
+            except (ValueError, KeyError) as error:
+                reply = {'answer': None, 'error': repr(error)}
+            try:
+                wfile.write(json.dumps(reply).encode() + b'\n')
+                wfile.flush()
+            except OSError:
+                return  # The client gave up and closed the connection
+
+    def _run_worker(self) -> None:
+        # Client that has the instrument to itself, until when, and the
+        # requests of other clients put aside in the meantime
+        held_by: Optional[int] = None
+        held_until = 0.0
+        put_aside: List[Tuple[int, int, _Request]] = []
+        while True:
+            try:
+                timeout_s = None if held_by is None else max(held_until - monotonic(), 0)
+                item = self._queue.get(timeout=timeout_s)
+            except queue.Empty:
+                item = None
+            if item and held_by is not None and held_by not in item[2].clients:
+                # No more clients may join it, the holder would wait for it
+                self._forget_pending(item[2])
+                put_aside.append(item)
+                continue
+            if item is None or item[2].op == 'query':
+                held_by = None
+                for other in put_aside:
+                    self._queue.put(other)
+                put_aside.clear()
+            if item is None:
+                continue
+            request = item[2]
+            if request.op != 'query':
+                held_by = next(iter(request.clients))
+                held_until = monotonic() + HOLD_S
+            self._forget_pending(request)
+            answer, error = self._execute(request)
+            for waiter in request.waiters:
+                waiter.deliver(answer, error)
+
+    def _forget_pending(self, request: _Request) -> None:
+        """
+        Stop other clients from sharing the answer to a request
+        """
+        if request.op != 'query':
+            return
+        with self._pending_lock:
+            key = request.cmd.strip().lower()
+            if self._pending.get(key) is request:
+                del self._pending[key]
+
+    def _execute(self, request: _Request):
+        try:
+            if request.op == 'query':
+                return self._resource.query(request.cmd), None
+            if request.op == 'write':
+                self._resource.write(request.cmd)
+            elif request.op == 'clear':
+                self._resource.clear()
+            return None, None
+        except Exception as error:
+            return None, repr(error)
+
+
+class BrokerResource:
+    """
+    Stand-in for a VISA resource that goes through a Broker
+
+    Can be passed to qdac2.QDAC2 and qswitch.QSwitch instead of the resource
+    returned by common.connection.  Settings like timeouts and terminations
+    are owned by the broker and are ignored here.
+    """
+
+    resource_class = 'ASRL'
+
+    def __init__(self, socket_path: str, priority: int = DEFAULT_PRIORITY,
+                 timeout_s: float = REQUEST_TIMEOUT_S + 5):
+        """
+        Args:
+            timeout_s: Longest wait for an answer from the broker, after
+                       which the connection is closed
+        """
+        self.priority = priority
+        self._lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout_s)
+        self._sock.connect(socket_path)
+        self._file = self._sock.makefile('rwb')
+
+    def write(self, cmd: str) -> None:
+        self._request('write', cmd)
+
+    def query(self, cmd: str) -> str:
+        return self._request('query', cmd)
+
+    def clear(self) -> None:
+        self._request('clear', '')
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+    def _request(self, op: str, cmd: str) -> Any:
+        message = {'op': op, 'cmd': cmd, 'priority': self.priority}
+        with self._lock:
+            try:
+                self._file.write(json.dumps(message).encode() + b'\n')
+                self._file.flush()
+                line = self._file.readline()
+            except OSError as error:
+                # A late answer would be taken for the next one
+                self.close()
+                raise ValueError(f'Broker did not answer [{cmd}]: {repr(error)}')
+        if not line:
+            raise ValueError('Broker closed the connection')
+        reply = json.loads(line)
+        if reply['error']:
+            raise ValueError(f'Broker error [{cmd}]: {reply["error"]}')
+        return reply['answer']
+
+
+def _open_instrument(kind: str, address: Optional[str]) -> visa.Resource:
+    device = conn.devices[0] if kind == 'qdac2' else conn.devices[1]
+    if address:
+        resource = conn.find_visa_device(address, device.kind)
+    elif kind == 'qdac2':
+        resource = conn.find_qdac2_on_usb()
+    else:
+        resource = conn.find_qswitch_on_usb()
+    resource.write_termination = '\n'
+    resource.read_termination = '\n'
+    resource.baud_rate = device.baud_rate
+    if kind == 'qswitch':
+        resource.timeout = 5000
+        resource.query_delay = 0.01
+    else:
+        resource.timeout = 1000
+    return resource
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Share a USB-connected QDAC-II or QSwitch between processes')
+    parser.add_argument('kind', choices=['qdac2', 'qswitch'])
+    parser.add_argument('--address', help='VISA address, default is USB detection')
+    parser.add_argument('--socket', required=True, help='Unix socket path')
+    args = parser.parse_args()
+    try:
+        instrument = _open_instrument(args.kind, args.address)
+        print(f'Serving {args.kind} on {args.socket}')
+        Broker(instrument, args.socket).serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except Exception as error:
+        print(f'Error: {error}')
+        sys.exit(1)
@@ -0,0 +1,139 @@
+"""
+Benchmarks of the channel list conversions used for the QSwitch.
+
+The first table compares the number of bytes, and the time to transmit them
+over the 9600 baud USB link, of the relay commands made with the compressed
+channel list (consecutive lines on the same breakout merged) and with the
+shortest channel list (also merging across relays that are already in the
+right state).
+
+The second table shows the host-side time of parsing, compressing and
+expanding representative states, without (cold) and with (warm) the
+remembered conversions.
+
+Run like this:
+
+$ python src/channel_list_benchmark.py
+"""
+
+import sys
+import random
+import timeit
+from typing import Callable, List, Tuple
+from common import channel_list as codec
+
+BAUD_RATE = 9600
+BITS_PER_BYTE = 10  # Start bit, 8 data bits, stop bit
+
+State = List[Tuple[int, int]]
+
+
+def all_on(tap: int) -> State:
+    return [(line, tap) for line in range(1, 25)]
+
+
+def scenarios() -> List[Tuple[str, State, State]]:
+    grounded = all_on(0)
+    connected = all_on(9)
+    odd_to_3 = [(line, 3) if line % 2 else (line, 0) for line in range(1, 25)]
+    on_2 = all_on(2)
+    every_third_grounded = [(line, 0) if line % 3 == 0 else (line, 2)
+                            for line in range(1, 25)]
+    result = [
+        ('connect all', grounded, connected),
+        ('ground all', connected, grounded),
+        ('odd lines to breakout 3', grounded, odd_to_3),
+        ('every third line off breakout 2', on_2, every_third_grounded),
+    ]
+    generator = random.Random(1)
+    for index in range(5):
+        before = [(line, generator.choice([0, 0, 9, 1, 2, 3]))
+                  for line in range(1, 25)]
+        after = [(line, generator.choice([0, 0, 9, 1, 2, 3]))
+                 for line in range(1, 25)]
+        result.append((f'random reconfiguration {index + 1}', before, after))
+    return result
+
+
+def commands(before: State, after: State, shortest: bool) -> List[str]:
+    positive = frozenset(after) - frozenset(before)
+    negative = frozenset(before) - frozenset(after)
+    stay_closed = frozenset(before) & frozenset(after)
+    stay_open = codec.ALL_RELAYS - frozenset(before) - frozenset(after)
+    result = []
+    if positive:
+        channels = codec.state_to_shortest_list(positive, stay_closed) \
+            if shortest else codec.state_to_compressed_list(positive)
+        result.append(f'clos {channels}\n')
+    if negative:
+        channels = codec.state_to_shortest_list(negative, stay_open) \
+            if shortest else codec.state_to_compressed_list(negative)
+        result.append(f'open {channels}\n')
+    return result
+
+
+def transmit_ms(cmds: List[str]) -> float:
+    size = sum(len(cmd) for cmd in cmds)
+    return size * BITS_PER_BYTE / BAUD_RATE * 1000
+
+
+def microseconds(function: Callable[[], object], cold: bool) -> float:
+    def call():
+        if cold:
+            codec.clear_caches()
+        function()
+    repetitions = 200
+    return min(timeit.repeat(call, number=repetitions, repeat=5)) \
+        / repetitions * 1e6
+
+
+def run_conversions() -> None:
+    states = [(name, after) for name, _, after in scenarios()[:5]]
+    print(f'{"conversion":52} {"cold":>10} {"warm":>10}')
+    for name, state in states:
+        expanded = codec.state_to_expanded_list(state)
+        compressed = codec.state_to_compressed_list(state)
+        cases = [
+            (f'parse expanded ({name})',
+             lambda: codec.channel_list_to_state(expanded)),
+            (f'parse compressed ({name})',
+             lambda: codec.channel_list_to_state(compressed)),
+            (f'compress ({name})',
+             lambda: codec.state_to_compressed_list(state)),
+            (f'expand ({name})',
+             lambda: codec.state_to_expanded_list(state)),
+        ]
+        for label, function in cases:
+            cold = microseconds(function, cold=True)
+            warm = microseconds(function, cold=False)
+            print(f'{label:52} {cold:7.1f} us {warm:7.1f} us')
+
+
+def run_transmission() -> None:
+    print(f'{"scenario":34} {"compressed":>16} {"shortest":>16}')
+    totals = [0.0, 0.0]
+    for name, before, after in scenarios():
+        old = commands(before, after, shortest=False)
+        new = commands(before, after, shortest=True)
+        columns = []
+        for index, cmds in enumerate([old, new]):
+            size = sum(len(cmd) for cmd in cmds)
+            totals[index] += transmit_ms(cmds)
+            columns.append(f'{size:4} B {transmit_ms(cmds):6.1f} ms')
+        print(f'{name:34} {columns[0]:>16} {columns[1]:>16}')
+    print(f'{"total":34} {totals[0]:13.1f} ms {totals[1]:13.1f} ms')
+
+
+def run() -> None:
+    run_transmission()
+    print('')
+    run_conversions()
+
+
+if __name__ == '__main__':
+    try:
+        run()
+        sys.exit(0)
+    except Exception as error:
+        print(f'Error: {error}')
+        sys.exit(1)
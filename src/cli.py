@@ -0,0 +1,114 @@
+"""
+Command line for quick QSwitch and QDAC-II operations, for example from cron
+jobs or shell scripts.
+
+Only the modules needed for the chosen connection are loaded, so that a
+command over the LAN starts fast (see import_benchmark.py).
+
+$ python src/cli.py qswitch --ip 192.168.8.100 state
+$ python src/cli.py qswitch --ip 192.168.8.100 overview
+$ python src/cli.py qswitch --ip 192.168.8.100 ground-all
+$ python src/cli.py qswitch --ip 192.168.8.100 apply 'all connected'
+$ python src/cli.py qswitch --ip 192.168.8.100 apply measure --presets presets.json
+$ python src/cli.py qdac2 --host 192.168.8.200 status
+$ python src/cli.py qdac2 query 'sour1:volt?'
+
+Without --ip or --visa, the QSwitch is found on USB, and without --host the
+QDAC-II is.
+"""
+
+import sys
+import argparse
+from typing import List, Optional
+
+
+def open_qswitch(ip: Optional[str] = None, visa: Optional[str] = None):
+    """
+    Connect to a QSwitch on UDP, on a VISA address or found on USB
+    """
+    import qswitch_driver
+    if ip:
+        config = qswitch_driver.UDPConfig(ip=ip)
+    else:
+        address = visa or qswitch_driver.find_qswitch_on_usb()
+        config = qswitch_driver.VISAConfig(visaAddress=address)
+    return qswitch_driver.QSwitch(config)
+
+
+def open_qdac2(host: Optional[str] = None, serial_number: Optional[str] = None):
+    """
+    Connect to a QDAC-II on the LAN or found on USB, bypassing pyvisa
+    """
+    import qdac2
+    if host:
+        return qdac2.open_qdac2_on_lan(host)
+    return qdac2.open_qdac2_on_usb(serial_number)
+
+
+def run_qswitch(args: argparse.Namespace) -> None:
+    qswitch = open_qswitch(args.ip, args.visa)
+    try:
+        if args.action == 'state':
+            print(qswitch.state())
+        elif args.action == 'overview':
+            for name, connections in qswitch.overview().items():
+                print(f'{name}: {", ".join(connections)}')
+        elif args.action == 'ground-all':
+            qswitch.ground_and_release_all()
+        elif args.action == 'apply':
+            if args.presets:
+                qswitch.load_presets(args.presets)
+            qswitch.apply_preset(args.preset)
+    finally:
+        qswitch.close()
+
+
+def run_qdac2(args: argparse.Namespace) -> None:
+    qdac = open_qdac2(args.host, args.serial_number)
+    try:
+        if args.action == 'status':
+            print(qdac.status())
+        elif args.action == 'query':
+            print(qdac.query(args.cmd))
+    finally:
+        qdac.close()
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Quick QSwitch and QDAC-II operations')
+    instruments = parser.add_subparsers(dest='instrument', required=True)
+
+    qswitch = instruments.add_parser('qswitch')
+    qswitch.add_argument('--ip', help='IP address (UDP, firmware >= 1.9)')
+    qswitch.add_argument('--visa', help='VISA address, default is USB detection')
+    actions = qswitch.add_subparsers(dest='action', required=True)
+    actions.add_parser('state', help='Print the closed relays')
+    actions.add_parser('overview', help='Print the connections of each line')
+    actions.add_parser('ground-all', help='Ground and release all lines')
+    apply = actions.add_parser('apply', help='Change the relays to a preset')
+    apply.add_argument('preset', help='Name of the preset')
+    apply.add_argument('--presets', help='JSON file written by save_presets()')
+
+    qdac = instruments.add_parser('qdac2')
+    qdac.add_argument('--host', help='IP address')
+    qdac.add_argument('--serial-number',
+                      help='USB serial number, if several QDAC-IIs are attached')
+    actions = qdac.add_subparsers(dest='action', required=True)
+    actions.add_parser('status', help='Print and clear the error queue')
+    query = actions.add_parser('query', help='Print the answer to a query')
+    query.add_argument('cmd', help='SCPI query')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    try:
+        if args.instrument == 'qswitch':
+            run_qswitch(args)
+        else:
+            run_qdac2(args)
+        sys.exit(0)
+    except Exception as error:
+        print(f'Error: {error}')
+        sys.exit(1)
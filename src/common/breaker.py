@@ -0,0 +1,133 @@
+"""
+Circuit breakers that make calls to an unreachable instrument fail fast.
+
+A breaker is closed while the instrument answers.  When failure_threshold
+calls in a row fail, after the driver has used up its own retries, the
+breaker opens and later calls fail immediately with CircuitOpenError.  While
+open, an optional probe function is called in the background; when it
+succeeds the breaker closes again.  Without a probe, the breaker becomes
+half-open after reset_timeout_s and lets a single call through to find out
+if the instrument is back.
+
+Breakers are shared per endpoint (IP or VISA address), so that all drivers
+talking to the same unit see the same state:
+
+from common.breaker import breaker_for
+print(breaker_for('192.168.8.100').state)
+"""
+
+import threading
+from time import monotonic, sleep as sleep_s
+from typing import Callable, Dict, Optional
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+Probe = Callable[[], bool]
+
+
+class CircuitOpenError(ValueError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Health of a single instrument endpoint
+    """
+
+    def __init__(self, endpoint: str, failure_threshold: int = 3,
+                 reset_timeout_s: float = 10, probe_interval_s: float = 1):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.probe_interval_s = probe_interval_s
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe: Optional[Probe] = None
+        self._prober: Optional[threading.Thread] = None
+
+    @property
+    def state(self) -> str:
+        """
+        'closed', 'open' or 'half-open'
+        """
+        with self._lock:
+            if self._state == OPEN and self._probe is None and \
+                    monotonic() - self._opened_at >= self.reset_timeout_s:
+                self._state = HALF_OPEN
+            return self._state
+
+    def set_probe(self, probe: Optional[Probe]) -> None:
+        """
+        Set a cheap function that tells if the instrument answers again
+
+        The probe is called from a background thread while the breaker is
+        open, so it must not share a connection with the driver.
+        """
+        with self._lock:
+            self._probe = probe
+
+    def check(self) -> None:
+        """
+        Raise CircuitOpenError if calls to the endpoint should fail fast
+        """
+        if self.state == OPEN:
+            raise CircuitOpenError(f'{self.endpoint} is not responding '
+                                   '(circuit open), failing fast')
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state != HALF_OPEN and \
+                    self._failures < self.failure_threshold:
+                return
+            self._state = OPEN
+            self._opened_at = monotonic()
+            if self._probe and not self._prober:
+                self._prober = threading.Thread(
+                    target=self._run_probe, daemon=True,
+                    name=f'CircuitProbe {self.endpoint}')
+                self._prober.start()
+
+    def _run_probe(self) -> None:
+        while True:
+            with self._lock:
+                probe = self._probe
+                if self._state != OPEN or not probe:
+                    self._prober = None
+                    return
+            try:
+                alive = probe()
+            except Exception:
+                alive = False
+            if alive:
+                with self._lock:
+                    self._state = CLOSED
+                    self._failures = 0
+                    self._prober = None
+                return
+            sleep_s(self.probe_interval_s)
+
+
+_breakers: Dict[str, CircuitBreaker] = dict()
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(endpoint: str) -> CircuitBreaker:
+    """
+    Return the process-wide breaker for an endpoint
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint)
+            _breakers[endpoint] = breaker
+        return breaker
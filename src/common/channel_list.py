@@ -0,0 +1,182 @@
+"""
+Conversion between the QSwitch channel list notation and relay states.
+
+A channel list like '(@1!0:24!0,3!9)' names closed relays as line!tap pairs,
+where consecutive lines on the same tap can be written as a range.  A state
+is a list of (line, tap) pairs, with lines 1-24 and taps 0-9 (0 is the soft
+ground, 9 the input connector and 1-8 the breakouts).
+
+The conversions run on every relay operation, so recently seen channel lists
+and states are remembered.
+"""
+
+import re
+import itertools
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Sequence, Set, Tuple
+
+State = Sequence[Tuple[int, int]]
+
+LINES = range(1, 25)
+TAPS = range(0, 10)
+ALL_RELAYS = frozenset(itertools.product(LINES, TAPS))
+
+_CACHE_SIZE = 256
+
+_outer = re.compile(r'\(@([0-9,:! ]*)\)')
+_pair = re.compile(r'\s*([0-9]+)!([0-9]+)\s*$')
+
+
+def channel_list_to_state(channel_list: str) -> List[Tuple[int, int]]:
+    """
+    Converts channel list notation to the State notation
+    """
+    return list(_parse(channel_list))
+
+
+def state_to_expanded_list(state: State) -> str:
+    """
+    Converts state notation to a long channel list of closed relays
+    """
+    return '(@' + ','.join([f'{line}!{tap}' for (line, tap) in state]) + ')'
+
+
+def state_to_compressed_list(state: State) -> str:
+    """
+    Converts state notation to a short channel list of closed relays,
+    merging consecutive lines on the same tap
+    """
+    return _compress(frozenset(state))
+
+
+def state_to_shortest_list(state: State, optional: State = ()) -> str:
+    """
+    Converts state notation to the shortest channel list that contains all
+    relays in state and otherwise only relays in optional
+    """
+    return _shortest(frozenset(state), frozenset(optional))
+
+
+def clear_caches() -> None:
+    """
+    Forget the remembered conversions
+    """
+    _parse.cache_clear()
+    _compress.cache_clear()
+    _shortest.cache_clear()
+
+
+# ----------------------------------------------------------------------
+# Helpers
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _parse(channel_list: str) -> Tuple[Tuple[int, int], ...]:
+    if len(channel_list) == 0:
+        return ()
+    outer = _outer.match(channel_list)
+    if not outer:
+        raise ValueError(f'Expected channel list, got {channel_list}')
+    if not outer[1].strip():
+        return ()
+    result: List[Tuple[int, int]] = []
+    for sequence in outer[1].split(','):
+        limits = sequence.split(':')
+        if limits == ['']:
+            raise ValueError(f'Expected channel sequence, got {limits}')
+        if len(limits) > 2:
+            raise ValueError(f'Expected channel sequence, got {limits}')
+        line_start, tap_start = _line_tap_split(limits[0])
+        line_stop, tap_stop = line_start, tap_start
+        if len(limits) == 2:
+            line_stop, tap_stop = _line_tap_split(limits[1])
+        if tap_start != tap_stop:
+            raise ValueError(f'Expected same breakout in sequence, got {limits}')
+        for line in range(line_start, line_stop + 1):
+            result.append((line, tap_start))
+    return tuple(result)
+
+
+def _line_tap_split(input: str) -> Tuple[int, int]:
+    pair = _pair.match(input)
+    if not pair:
+        raise ValueError(f'Expected channel pair, got {input}')
+    line, tap = int(pair[1]), int(pair[2])
+    if line not in LINES:
+        raise ValueError(f'Expected line between 1 and 24, got {line}')
+    if tap not in TAPS:
+        raise ValueError(f'Expected tap between 0 and 9, got {tap}')
+    return line, tap
+
+
+def _by_tap(relays: Iterable[Tuple[int, int]]) -> Dict[int, Set[int]]:
+    result: Dict[int, Set[int]] = dict()
+    for line, tap in relays:
+        result.setdefault(tap, set()).add(line)
+    return result
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _compress(state: FrozenSet[Tuple[int, int]]) -> str:
+    intervals: List[str] = []
+    tap_to_lines = _by_tap(state)
+    for tap in sorted(tap_to_lines):
+        for start, stop in _runs(sorted(tap_to_lines[tap])):
+            intervals.append(_interval_text(start, stop, tap))
+    return '(@' + ','.join(intervals) + ')'
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _shortest(state: FrozenSet[Tuple[int, int]],
+              optional: FrozenSet[Tuple[int, int]]) -> str:
+    required = _by_tap(state)
+    allowed = _by_tap(optional)
+    intervals: List[str] = []
+    for tap in sorted(required):
+        lines = required[tap]
+        usable = lines | allowed.get(tap, set())
+        for start, stop in _runs(sorted(usable)):
+            intervals += _shortest_cover(start, stop, lines, tap)
+    return '(@' + ','.join(intervals) + ')'
+
+
+def _runs(lines: Sequence[int]) -> List[Tuple[int, int]]:
+    """
+    Split sorted line numbers into runs of consecutive lines
+    """
+    runs: List[Tuple[int, int]] = []
+    for line in lines:
+        if runs and runs[-1][1] == line - 1:
+            runs[-1] = (runs[-1][0], line)
+        else:
+            runs.append((line, line))
+    return runs
+
+
+def _interval_text(start: int, stop: int, tap: int) -> str:
+    if start == stop:
+        return f'{start}!{tap}'
+    return f'{start}!{tap}:{stop}!{tap}'
+
+
+def _shortest_cover(start: int, stop: int, required: Set[int],
+                    tap: int) -> List[str]:
+    """
+    Fewest characters of intervals within start..stop that cover the
+    required lines
+    """
+    # best[i]: cost and intervals covering the required lines before line i,
+    # each interval costing its text plus a separating comma
+    best: Dict[int, Tuple[int, List[str]]] = {start: (0, [])}
+    for first in range(start, stop + 1):
+        if first not in best:
+            continue
+        cost, intervals = best[first]
+        if first not in required:
+            if first + 1 not in best or cost < best[first + 1][0]:
+                best[first + 1] = (cost, intervals)
+        for last in range(first, stop + 1):
+            text = _interval_text(first, last, tap)
+            total = cost + len(text) + 1
+            if last + 1 not in best or total < best[last + 1][0]:
+                best[last + 1] = (total, intervals + [text])
+    return best[stop + 1][1]
@@ -1,10 +1,19 @@
-import pyvisa as visa
-import serial.tools.list_ports as list_ports
-import serial
+from __future__ import annotations
 import re
+import os
+import socket
+import select
+import ipaddress
+import threading
+from time import monotonic, sleep as sleep_s
 from dataclasses import dataclass
-from typing import Sequence, Tuple, Optional
-from platform import system as platform_system
+from typing import Sequence, Tuple, Optional, Dict, List, Callable, FrozenSet, TYPE_CHECKING
+
+# pyvisa, pyserial and platform take a large part of the start-up time of a
+# script, so they are imported by the functions that need them
+if TYPE_CHECKING:
+    import pyvisa as visa
+    import serial
 
 
 @dataclass
@@ -21,47 +30,209 @@ devices = [
 ]
 
 
-def find_qdac2_on_usb(backend='@py') -> visa.Resource:
+def find_qdac2_on_usb(backend='@py',
+                      serial_number: Optional[str] = None) -> visa.Resource:
     device = devices[0]
-    handle = find_serial_device(device)
+    handle = find_serial_device(device, serial_number)
     if not handle:
         raise ValueError('No device found')
-    if os_platform() == 'windows':
-        if handle[:3].lower() == 'com':
-            handle = handle[3:]
-    return find_visa_device(f'ASRL{handle}::INSTR', 'QDAC-II')
+    return find_visa_device(serial_handle_to_visa_address(handle), 'QDAC-II')
 
 
-def find_qswitch_on_usb(backend='@py') -> visa.Resource:
+def find_qswitch_on_usb(backend='@py',
+                        serial_number: Optional[str] = None) -> visa.Resource:
     device = devices[1]
-    handle = find_serial_device(device)
+    handle = find_serial_device(device, serial_number)
     if not handle:
         raise ValueError('No device found')
+    return find_visa_device(serial_handle_to_visa_address(handle), 'QSwitch')
+
+
+def serial_handle_to_visa_address(handle: str) -> str:
     if os_platform() == 'windows':
         if handle[:3].lower() == 'com':
             handle = handle[3:]
-    return find_visa_device(f'ASRL{handle}::INSTR', 'QSwitch')
+    return f'ASRL{handle}::INSTR'
 
 
 def find_visa_device(address, description, backend='@py') -> visa.Resource:
-    rm = resource_manager(backend)
-    for tries in range(40):
-        try:
-            return rm.open_resource(address)
-        except ValueError:
-            break
-        except visa.VisaIOError:
-            print(f'Retrying connection to {address}')
+    import pyvisa as visa
+    try:
+        return visa_pool.acquire(address, backend)
+    except (ValueError, visa.VisaIOError):
+        pass
     raise ValueError(f'{description} device with address {address} not found')
 
 
+_resource_managers: Dict[str, visa.ResourceManager] = dict()
+_resource_managers_lock = threading.Lock()
+
+
 def resource_manager(backend=None) -> visa.ResourceManager:
-    if backend:
-        return visa.ResourceManager(backend)
-    return visa.ResourceManager()  # Use default NI backend
+    import pyvisa as visa
+    key = backend or ''
+    with _resource_managers_lock:
+        rm = _resource_managers.get(key)
+        if rm is None:
+            if backend:
+                rm = visa.ResourceManager(backend)
+            else:
+                rm = visa.ResourceManager()  # Use default NI backend
+            _resource_managers[key] = rm
+        return rm
+
+
+# ----------------------------------------------------------------------
+# VISA session pool
+
+@dataclass
+class _PooledResource:
+    resource: visa.Resource
+    users: int
+    released_at: float
+
+
+class ResourcePool:
+    """
+    Process-wide pool of open VISA resources keyed by backend and address.
+
+    Acquiring an address that is already open returns the same resource, so
+    constructing a driver again does not open another session.  Released
+    resources are closed once they have been idle for idle_timeout_s, which
+    by default is immediately, as if they were closed directly.
+
+    Use like this to keep sessions around between driver constructions:
+
+    import common.connection as conn
+    conn.visa_pool.idle_timeout_s = 60
+    """
+
+    def __init__(self, idle_timeout_s: float = 0, open_attempts: int = 8,
+                 backoff_s: float = 0.05, max_backoff_s: float = 1):
+        self.idle_timeout_s = idle_timeout_s
+        self.open_attempts = open_attempts
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self._lock = threading.Lock()
+        self._pool: Dict[Tuple[str, str], _PooledResource] = dict()
+        self._opening: Dict[Tuple[str, str], threading.Lock] = dict()
+
+    def acquire(self, address: str, backend: str = '@py') -> visa.Resource:
+        """
+        Return an open resource for the address, opening it if needed
+
+        Raises ValueError if the address is invalid, and VisaIOError if
+        the resource could not be opened after open_attempts tries.
+        """
+        key = (backend, address)
+        with self._lock:
+            opening = self._opening.setdefault(key, threading.Lock())
+        # Opening can take seconds of retries, so only acquires of the same
+        # address wait for it, not the whole pool
+        with opening:
+            with self._lock:
+                self._evict_idle(except_key=key)
+                entry = self._pool.get(key)
+                if entry and _is_healthy(entry.resource):
+                    entry.users += 1
+                    return entry.resource
+                self._pool.pop(key, None)
+            resource = self._open(address, backend)
+            with self._lock:
+                self._pool[key] = _PooledResource(resource, 1, monotonic())
+            return resource
+
+    def release(self, address: str, backend: str = '@py') -> None:
+        """
+        Hand back a resource obtained through acquire()
+        """
+        key = (backend, address)
+        with self._lock:
+            entry = self._pool.get(key)
+            if not entry:
+                return
+            entry.users = max(entry.users - 1, 0)
+            entry.released_at = monotonic()
+            self._evict_idle()
+
+    def release_resource(self, resource: visa.Resource) -> bool:
+        """
+        Hand back a resource obtained through acquire(), found by identity
+
+        Returns:
+            False if the resource is not in the pool, so the caller owns it
+        """
+        with self._lock:
+            key = next((key for key, entry in self._pool.items()
+                        if entry.resource is resource), None)
+        if key is None:
+            return False
+        self.release(key[1], key[0])
+        return True
+
+    def evict_idle(self) -> None:
+        """
+        Close all released resources that have been idle for too long
+        """
+        with self._lock:
+            self._evict_idle()
+
+    def close_all(self) -> None:
+        """
+        Close all resources in the pool, whether in use or not
+        """
+        with self._lock:
+            entries = list(self._pool.values())
+            self._pool.clear()
+        for entry in entries:
+            _close_quietly(entry.resource)
+
+    def _open(self, address: str, backend: str) -> visa.Resource:
+        import pyvisa as visa
+        rm = resource_manager(backend)
+        delay_s = self.backoff_s
+        for attempt in range(1, self.open_attempts + 1):
+            try:
+                return rm.open_resource(address)
+            except visa.VisaIOError:
+                if attempt == self.open_attempts:
+                    raise
+                print(f'Retrying connection to {address}')
+                sleep_s(delay_s)
+                delay_s = min(delay_s * 2, self.max_backoff_s)
+        raise ValueError(f'Could not open {address}')
+
+    def _evict_idle(self, except_key: Optional[Tuple[str, str]] = None) -> None:
+        now = monotonic()
+        for key, entry in list(self._pool.items()):
+            if key == except_key or entry.users > 0:
+                continue
+            if now - entry.released_at >= self.idle_timeout_s:
+                del self._pool[key]
+                _close_quietly(entry.resource)
+
+
+def _is_healthy(resource: visa.Resource) -> bool:
+    import pyvisa as visa
+    try:
+        return resource.session is not None
+    except visa.errors.InvalidSession:
+        return False
+
+
+def _close_quietly(resource: visa.Resource) -> None:
+    import pyvisa as visa
+    try:
+        resource.close()
+    except visa.Error:
+        pass
+
+
+visa_pool = ResourcePool()
 
 
 def os_platform() -> str:
+    from platform import system as platform_system
     os_type = platform_system()
     if os_type == 'Linux':
         return 'linux'
@@ -72,8 +243,13 @@ def os_platform() -> str:
     return 'unkown_os'
 
 
-def find_serial_device(device: Device) -> Optional[str]:
+def find_serial_device(device: Device,
+                       serial_number: Optional[str] = None) -> Optional[str]:
+    import serial.tools.list_ports as list_ports
     candidates = list(list_ports.grep(device.signature))
+    if serial_number:
+        candidates = [candidate for candidate in candidates
+                      if candidate.serial_number == serial_number]
     if len(candidates) == 1:
         return candidates[0].device
     if (len(candidates) > 1):
@@ -83,6 +259,7 @@ def find_serial_device(device: Device) -> Optional[str]:
 
 
 def find_serial_devices() -> Sequence[Tuple[Device, str]]:
+    import serial.tools.list_ports as list_ports
     result = []
     for device in devices:
         candidates = list(list_ports.grep(device.signature))
@@ -95,72 +272,327 @@ def find_serial_devices() -> Sequence[Tuple[Device, str]]:
     return result
 
 
+# ----------------------------------------------------------------------
+# USB hot-plug watcher
+
+@dataclass(frozen=True)
+class AttachedDevice:
+    device: Device
+    handle: str
+    serial_number: str
+
+    @property
+    def visa_address(self) -> str:
+        return serial_handle_to_visa_address(self.handle)
+
+
+ChangeCallback = Callable[[str, AttachedDevice], None]
+
+
+class UsbWatcher:
+    """
+    Registry of QDAC-II and QSwitch units attached through USB, kept up to
+    date by a background thread.
+
+    The registry is keyed by USB serial number, so several units of the same
+    kind can be told apart.  On Linux the thread only enumerates the serial
+    ports when the USB devices or tty nodes in /sys change, so polling is cheap.
+
+    Use like this:
+
+    import common.connection as conn
+    watcher = conn.UsbWatcher()
+    watcher.on_change(lambda event, unit: print(event, unit))
+    watcher.start()
+    unit = watcher.lookup('A1B2C3')
+    device = conn.find_visa_device(unit.visa_address, unit.device.kind)
+    """
+
+    def __init__(self, interval_s: float = 0.5):
+        self._interval_s = interval_s
+        self._lock = threading.Lock()
+        self._registry: Dict[str, AttachedDevice] = dict()
+        self._callbacks: List[ChangeCallback] = list()
+        self._fingerprint: Optional[FrozenSet[str]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Scan once and then keep watching in a background thread
+        """
+        if self._thread:
+            return
+        self._fingerprint = _usb_fingerprint()
+        self.scan()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='UsbWatcher')
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread
+        """
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def on_change(self, callback: ChangeCallback) -> None:
+        """
+        Register a function to call with ('attached' | 'detached', unit)
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def lookup(self, serial_number: str) -> Optional[AttachedDevice]:
+        """
+        Return the attached unit with the given USB serial number, if any
+        """
+        with self._lock:
+            return self._registry.get(serial_number)
+
+    def attached(self, kind: Optional[str] = None) -> Sequence[AttachedDevice]:
+        """
+        Return the attached units, optionally only those of one kind
+        """
+        with self._lock:
+            units = list(self._registry.values())
+        if kind:
+            return [unit for unit in units if unit.device.kind == kind]
+        return units
+
+    def scan(self) -> None:
+        """
+        Enumerate the serial ports and update the registry
+        """
+        import serial.tools.list_ports as list_ports
+        found: Dict[str, AttachedDevice] = dict()
+        for device in devices:
+            for candidate in list_ports.grep(device.signature):
+                serial_number = candidate.serial_number or candidate.device
+                found[serial_number] = AttachedDevice(
+                    device, candidate.device, serial_number)
+        with self._lock:
+            before = self._registry
+            self._registry = found
+            callbacks = list(self._callbacks)
+        events = [('detached', unit) for key, unit in before.items()
+                  if found.get(key) != unit]
+        events += [('attached', unit) for key, unit in found.items()
+                   if before.get(key) != unit]
+        for event, unit in events:
+            for callback in callbacks:
+                # A failing callback must neither stop the others nor the
+                # watcher thread
+                try:
+                    callback(event, unit)
+                except Exception as error:
+                    print(f'USB {event} callback failed: {error}')
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval_s):
+            fingerprint = _usb_fingerprint()
+            if fingerprint is not None and fingerprint == self._fingerprint:
+                continue
+            self._fingerprint = fingerprint
+            self.scan()
+
+
+def _usb_fingerprint() -> Optional[FrozenSet[str]]:
+    """
+    Cheap summary of the attached USB devices, or None when not available
+    """
+    if os_platform() != 'linux':
+        return None
+    # The tty node of a serial device can show up after its USB interface,
+    # so both are watched
+    try:
+        return frozenset(os.path.join(folder, name)
+                         for folder in ('/sys/bus/usb/devices', '/sys/class/tty')
+                         for name in os.listdir(folder))
+    except OSError:
+        return None
+
+
+# ----------------------------------------------------------------------
+# LAN discovery
+
+@dataclass(frozen=True)
+class LanDevice:
+    ip: str
+    model: str
+    serial: str
+    firmware: str
+
+
+def find_qswitches_on_lan(network: str, port: int = 5025,
+                          timeout_s: float = 2) -> Sequence[LanDevice]:
+    """
+    Find QSwitches (firmware >= 1.9) answering on UDP in a network
+
+    The network is either a CIDR range like '192.168.8.0/24', where every
+    host address is probed, or a single (broadcast) address.  All probes are
+    sent from one socket and the answers are gathered within one timeout.
+
+    Use like this:
+
+    import common.connection as conn
+    for unit in conn.find_qswitches_on_lan('192.168.8.0/24'):
+        print(unit.ip, unit.serial, unit.firmware)
+    """
+    targets = _lan_targets(network)
+    probe = b'*IDN?\n'
+    found: Dict[str, LanDevice] = dict()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setblocking(False)
+        deadline = monotonic() + timeout_s
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            writers = [sock] if targets else []
+            readable, writable, _ = select.select([sock], writers, [], remaining)
+            if readable:
+                _receive_lan_answers(sock, found)
+            if writable:
+                try:
+                    while targets:
+                        sock.sendto(probe, (targets[-1], port))
+                        targets.pop()
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    targets.pop()  # Unreachable address, skip it
+    units = sorted(found.values(), key=lambda unit: ipaddress.ip_address(unit.ip))
+    return [unit for unit in units if unit.model == 'QSwitch']
+
+
+def _lan_targets(network: str) -> List[str]:
+    addresses = ipaddress.ip_network(network, strict=False)
+    if addresses.num_addresses == 1:
+        return [str(addresses.network_address)]
+    return [str(host) for host in reversed(list(addresses.hosts()))]
+
+
+def _receive_lan_answers(sock: socket.socket,
+                         found: Dict[str, LanDevice]) -> None:
+    while True:
+        try:
+            data, (ip, _) = sock.recvfrom(1024)
+        except BlockingIOError:
+            return
+        except (ConnectionRefusedError, ConnectionResetError):
+            # A probe got an ICMP port unreachable back (reported as a reset
+            # on Windows), the other answers are still to be read
+            continue
+        fields = data.decode(errors='replace').strip().split(',')
+        if len(fields) < 4:
+            continue
+        found[ip] = LanDevice(ip, fields[1].strip(), fields[2].strip(),
+                              fields[3].strip())
+
+
+# ----------------------------------------------------------------------
+# Serial information queries
+
+class LineReader:
+    """
+    Answers from a serial port, one line at a time
+
+    A read returns as soon as the line terminator has arrived, instead of
+    waiting for a fixed number of bytes or for the timeout.  Bytes after the
+    terminator are kept for the next read, so several queries can be sent
+    at once and their answers read one by one (see query_many()).
+    """
+
+    def __init__(self, connection: serial.Serial):
+        """
+        Args:
+            connection: Open serial port, whose timeout limits the wait for
+                        each chunk of an answer
+        """
+        self.connection = connection
+        self._buffer = bytearray()
+
+    def query(self, cmd: str) -> str:
+        self.connection.write(f'{cmd}\n'.encode())
+        return self.readline()
+
+    def query_many(self, cmds: Sequence[str]) -> List[str]:
+        """
+        Send several queries in one write and return the answers in order
+        """
+        self.connection.write(''.join(f'{cmd}\n' for cmd in cmds).encode())
+        return [self.readline() for _ in cmds]
+
+    def readline(self) -> str:
+        while True:
+            end = self._buffer.find(b'\n')
+            if end >= 0:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + 1]
+                return line.decode('utf-8').strip()
+            chunk = self.connection.read(max(1, self.connection.in_waiting))
+            if not chunk:
+                raise ValueError(f'No answer from {self.connection.port}')
+            self._buffer += chunk
+
+
+def _line_reader(connection) -> LineReader:
+    if isinstance(connection, LineReader):
+        return connection
+    return LineReader(connection)
+
+
 def get_id(connection):
-    raw = bytes('*idn?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(40)
-    answer = data.decode('utf-8')
-    match = re.search('[^\n]+', answer)
-    return match[0]
+    return _line_reader(connection).query('*idn?')
 
 
 def get_ip_addr(connection):
-    raw = bytes('syst:comm:lan:ipad?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:ipad?')
     match = re.search('[0-9.]+', answer)
     return match[0]
 
 
 def get_mac_addr(connection):
-    raw = bytes('syst:comm:lan:mac?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:mac?')
     match = re.search('[0-9A-F:]+', answer)
     return match[0]
 
 
 def get_gateway(connection):
-    raw = bytes('syst:comm:lan:gat?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:gat?')
     match = re.search('[0-9.]+', answer)
     return match[0]
 
 
 def get_mask(connection):
-    raw = bytes('syst:comm:lan:smas?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:smas?')
     match = re.search('[0-9.]+', answer)
     return match[0]
 
 
 def get_name(connection):
-    raw = bytes('syst:comm:lan:host?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:host?')
     match = re.search('[^"]+', answer)
     return match[0]
 
 
 def get_dhcp(connection):
-    raw = bytes('syst:comm:lan:dhcp?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(3)
-    return (float(data.decode('utf-8')) == 1)
+    answer = _line_reader(connection).query('syst:comm:lan:dhcp?')
+    return (float(answer) == 1)
 
 
 def report_device_info():
+    import serial
     for device, serial_info in find_serial_devices():
         print(f'Found: {device.kind}')
         print(f'Port: {serial_info}')
-        connection = serial.Serial(serial_info, device.baud_rate, timeout=0.2)
+        connection = LineReader(serial.Serial(serial_info, device.baud_rate, timeout=0.2))
         id = get_id(connection)
         print(f'identification: {id}')
         mac_addr = get_mac_addr(connection)
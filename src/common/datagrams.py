@@ -0,0 +1,43 @@
+"""
+Packing of several SCPI messages into UDP datagrams.
+
+Messages are joined by newlines into datagrams of at most SAFE_UDP_PAYLOAD
+bytes, which fits in a single Ethernet frame without IP fragmentation and in
+the receive buffer of the instruments.  Replies are split back into one
+string per answer, whether the instrument sent them in one datagram or many.
+"""
+
+import re
+from typing import List, Sequence
+
+SAFE_UDP_PAYLOAD = 512
+
+_reply_separator = re.compile(r'[\n;]')
+
+
+def pack_messages(messages: Sequence[str],
+                  max_bytes: int = SAFE_UDP_PAYLOAD) -> List[bytes]:
+    """
+    Join messages into as few datagrams as possible
+    """
+    datagrams: List[bytes] = []
+    current = bytearray()
+    for message in messages:
+        encoded = message.encode() + b'\n'
+        if len(encoded) > max_bytes:
+            raise ValueError(f'Message too long for one datagram: {message}')
+        if len(current) + len(encoded) > max_bytes:
+            datagrams.append(bytes(current))
+            current.clear()
+        current += encoded
+    if current:
+        datagrams.append(bytes(current))
+    return datagrams
+
+
+def split_replies(data: bytes) -> List[str]:
+    """
+    Split the contents of a datagram into separate answers
+    """
+    replies = _reply_separator.split(data.decode())
+    return [reply.strip() for reply in replies if reply.strip()]
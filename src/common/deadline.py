@@ -0,0 +1,58 @@
+"""
+Time limits for operations that consist of several round trips.
+
+A Deadline is created from a time limit in seconds, or None for no limit.
+Each round trip then uses at most the time that is left, so that the whole
+operation finishes, or fails with DeadlineExceeded, within the limit.
+"""
+
+from time import monotonic
+from typing import Optional
+
+
+class DeadlineExceeded(ValueError):
+    pass
+
+
+class Deadline:
+    """
+    Point in time at which an operation must have finished
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        self._end = None if seconds is None else monotonic() + seconds
+
+    def within(self, seconds: Optional[float]) -> 'Deadline':
+        """
+        Return a deadline that is at most the given time from now
+        """
+        narrowed = Deadline(seconds)
+        if narrowed._end is None or \
+                (self._end is not None and self._end < narrowed._end):
+            narrowed._end = self._end
+        return narrowed
+
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds left, or None if there is no limit
+        """
+        if self._end is None:
+            return None
+        return max(self._end - monotonic(), 0)
+
+    def check(self, what: str = 'Operation') -> None:
+        """
+        Raise DeadlineExceeded if there is no time left
+        """
+        if self._end is not None and monotonic() >= self._end:
+            raise DeadlineExceeded(f'{what} did not finish within the deadline')
+
+    def cap(self, seconds: float, what: str = 'Operation') -> float:
+        """
+        Limit a timeout to the time left
+        """
+        self.check(what)
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        return min(seconds, remaining)
@@ -0,0 +1,201 @@
+"""
+Compact history of QSwitch relay changes.
+
+The journal is a binary file of records.  A snapshot record holds the
+absolute time and all closed relays; it is written when journalling starts
+and whenever the QSwitch is found in a state that the journal did not
+expect.  A change record holds the time since the previous record and the
+relays that toggled.  Times are in milliseconds and encoded as variable
+length integers, and each relay takes one byte, so a typical change takes a
+handful of bytes.
+
+Use like this:
+
+import qswitch_driver
+from common import journal
+qswitch = qswitch_driver.QSwitch(qswitch_driver.UDPConfig(ip='192.168.8.100'))
+qswitch.start_journal('qswitch.journal')
+...
+print(journal.state_at('qswitch.journal', timestamp))
+print(journal.cycle_counts('qswitch.journal'))
+"""
+
+from time import time
+from typing import BinaryIO, Dict, FrozenSet, Iterator, Optional, Sequence, Tuple
+
+MAGIC = b'QSWJ\x01'
+SNAPSHOT = 0
+CHANGE = 1
+
+Relay = Tuple[int, int]
+State = Sequence[Relay]
+
+
+class RelayJournal:
+    """
+    Append relay changes to a journal file
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._state: FrozenSet[Relay] = frozenset()
+        self._last_ms = 0
+
+    def record_snapshot(self, state: State, when: Optional[float] = None) -> None:
+        """
+        Record the full state
+
+        Args:
+            state: Closed relays
+            when: Time in seconds since the epoch, default now
+        """
+        now_ms = _milliseconds(when)
+        self._state = frozenset(state)
+        self._write(SNAPSHOT, now_ms, self._state)
+
+    def record_change(self, closed: State, opened: State,
+                      when: Optional[float] = None) -> None:
+        """
+        Record relays that were closed and opened
+
+        Args:
+            closed: Relays that were closed
+            opened: Relays that were opened
+            when: Time in seconds since the epoch, default now
+        """
+        toggled = (frozenset(closed) - self._state) | \
+            (frozenset(opened) & self._state)
+        if not toggled:
+            return
+        now_ms = _milliseconds(when)
+        self._state = self._state ^ toggled
+        self._write(CHANGE, max(now_ms - self._last_ms, 0), toggled)
+
+    def expects(self, state: State) -> bool:
+        """
+        Tell if the state is the one the journal has recorded last
+        """
+        return frozenset(state) == self._state
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _write(self, kind: int, time_ms: int, relays: FrozenSet[Relay]) -> None:
+        record = bytearray([kind])
+        record += _encode_varint(time_ms)
+        record += _encode_varint(len(relays))
+        record += bytes(sorted(_relay_to_byte(relay) for relay in relays))
+        self._file.write(record)
+        self._file.flush()
+        self._last_ms = time_ms if kind == SNAPSHOT else self._last_ms + time_ms
+
+
+def read_journal(path: str) -> Iterator[Tuple[float, FrozenSet[Relay]]]:
+    """
+    Give the time (seconds since the epoch) and full state after each record
+    """
+    for when, _, state in _replay(path):
+        yield when, state
+
+
+def state_at(path: str, when: float) -> Optional[FrozenSet[Relay]]:
+    """
+    Give the closed relays at a point in time, or None if before the journal
+    """
+    result = None
+    for record_time, state in read_journal(path):
+        if record_time > when:
+            break
+        result = state
+    return result
+
+
+def cycle_counts(path: str) -> Dict[Relay, int]:
+    """
+    Give the number of times each relay has been closed
+
+    Relays already closed when the journal was started do not count, only
+    the closes recorded since.
+    """
+    counts: Dict[Relay, int] = dict()
+    records = _replay(path)
+    next(records, None)  # The first snapshot is where the relays started
+    for _, closed, _ in records:
+        for relay in closed:
+            counts[relay] = counts.get(relay, 0) + 1
+    return counts
+
+
+# ----------------------------------------------------------------------
+# Helpers
+
+def _replay(path: str) -> Iterator[Tuple[float, FrozenSet[Relay], FrozenSet[Relay]]]:
+    """
+    Give the time, the newly closed relays and the full state of each record
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a relay journal')
+        state: FrozenSet[Relay] = frozenset()
+        now_ms = 0
+        while True:
+            kind = file.read(1)
+            if not kind:
+                return
+            time_ms = _decode_varint(file)
+            count = _decode_varint(file)
+            data = file.read(count)
+            if len(data) != count:
+                return  # Incomplete last record
+            relays = frozenset(_byte_to_relay(value) for value in data)
+            if kind[0] == SNAPSHOT:
+                now_ms = time_ms
+                closed = relays - state
+                state = relays
+            elif kind[0] == CHANGE:
+                now_ms += time_ms
+                closed = relays - state
+                state = state ^ relays
+            else:
+                raise ValueError(f'Unknown record type {kind[0]} in {path}')
+            yield now_ms / 1000, closed, state
+
+
+def _milliseconds(when: Optional[float]) -> int:
+    return round((time() if when is None else when) * 1000)
+
+
+def _relay_to_byte(relay: Relay) -> int:
+    line, tap = relay
+    return (line - 1) * 10 + tap
+
+
+def _byte_to_relay(value: int) -> Relay:
+    return value // 10 + 1, value % 10
+
+
+def _encode_varint(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def _decode_varint(file: BinaryIO) -> int:
+    result = 0
+    shift = 0
+    while True:
+        data = file.read(1)
+        if not data:
+            raise ValueError('Truncated relay journal')
+        result |= (data[0] & 0x7f) << shift
+        if not data[0] & 0x80:
+            return result
+        shift += 7
@@ -0,0 +1,85 @@
+"""
+Rate control for UDP datagrams sent to an instrument.
+
+Datagrams that arrive at the QSwitch faster than it can handle them are
+dropped, and the drivers only notice through their retry loops.  An AimdPacer
+spaces out datagrams with a token bucket and adapts its rate to what the unit
+sustains: the rate grows additively for every answered request, and is halved
+when a request is lost or a stale reply shows up (additive increase,
+multiplicative decrease, as in TCP congestion control).
+
+Pacers are shared per IP address, so that all drivers sending to the same unit
+respect the same rate:
+
+from common.pacing import pacer_for
+print(pacer_for('192.168.8.100').rate_hz)
+"""
+
+import threading
+from time import monotonic, sleep as sleep_s
+from typing import Dict
+
+
+class AimdPacer:
+    """
+    Token bucket with an adaptive rate
+    """
+
+    def __init__(self, rate_hz: float = 100, min_rate_hz: float = 2,
+                 max_rate_hz: float = 1000, increase_hz: float = 2,
+                 decrease_factor: float = 0.5, burst: float = 4):
+        self.rate_hz = rate_hz
+        self.min_rate_hz = min_rate_hz
+        self.max_rate_hz = max_rate_hz
+        self.increase_hz = increase_hz
+        self.decrease_factor = decrease_factor
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = monotonic()
+
+    def wait(self) -> None:
+        """
+        Block until the next datagram may be sent
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate_hz)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return
+            delay_s = -self._tokens / self.rate_hz
+        sleep_s(delay_s)
+
+    def on_success(self) -> None:
+        """
+        A request was answered without loss
+        """
+        with self._lock:
+            self.rate_hz = min(self.rate_hz + self.increase_hz, self.max_rate_hz)
+
+    def on_loss(self) -> None:
+        """
+        A request was lost, or a stale reply was received
+        """
+        with self._lock:
+            self.rate_hz = max(self.rate_hz * self.decrease_factor,
+                               self.min_rate_hz)
+
+
+_pacers: Dict[str, AimdPacer] = dict()
+_pacers_lock = threading.Lock()
+
+
+def pacer_for(ip: str) -> AimdPacer:
+    """
+    Return the process-wide pacer for an IP address
+    """
+    with _pacers_lock:
+        pacer = _pacers.get(ip)
+        if pacer is None:
+            pacer = AimdPacer()
+            _pacers[ip] = pacer
+        return pacer
@@ -0,0 +1,106 @@
+"""
+Relay states of one or many QSwitches as NumPy boolean matrices.
+
+A relay matrix has shape (24, 10): element [line - 1, tap] is True when the
+relay between Fischer line and tap is closed (tap 0 is the soft ground, tap 9
+the input connector and taps 1-8 the BNC breakouts).  A fleet is a stack of
+matrices with shape (switches, 24, 10), so that checks over many switches are
+single array operations instead of loops over overview() dicts.
+
+Requires NumPy.  Use like this:
+
+import qswitch_driver
+from common import relay_matrix
+switches = [qswitch_driver.QSwitch(qswitch_driver.UDPConfig(ip=ip)) for ip in ips]
+fleet = relay_matrix.stack(switches)
+print(relay_matrix.floating_lines(fleet).nonzero())
+"""
+
+import numpy as np
+from typing import List, Sequence, Tuple
+
+LINE_COUNT = 24
+TAP_COUNT = 10
+GROUND_TAP = 0
+INPUT_TAP = 9
+BREAKOUT_TAPS = slice(1, 9)
+
+State = Sequence[Tuple[int, int]]
+
+
+def state_to_matrix(state: State) -> np.ndarray:
+    """
+    Convert State notation to a (24, 10) boolean matrix
+    """
+    matrix = np.zeros((LINE_COUNT, TAP_COUNT), dtype=bool)
+    if state:
+        lines, taps = zip(*state)
+        matrix[np.asarray(lines) - 1, np.asarray(taps)] = True
+    return matrix
+
+
+def matrix_to_state(matrix: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Convert a (24, 10) boolean matrix to State notation
+    """
+    lines, taps = np.nonzero(matrix)
+    return [(int(line) + 1, int(tap)) for line, tap in zip(lines, taps)]
+
+
+def stack(switches: Sequence, refresh: bool = False) -> np.ndarray:
+    """
+    Stack the relay matrices of several QSwitches
+
+    Args:
+        switches: qswitch_driver.QSwitch instances
+        refresh: Ask each switch for its state, instead of using the state
+                 known by the driver
+    """
+    return np.stack([switch.relay_matrix(refresh=refresh)
+                     for switch in switches])
+
+
+def differences(before: np.ndarray,
+                after: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Relays to close and relays to open to get from one state to another,
+    for single matrices or whole fleets
+    """
+    return after & ~before, before & ~after
+
+
+def grounded_lines(matrices: np.ndarray) -> np.ndarray:
+    """
+    Lines connected to the soft ground, shape (..., 24)
+    """
+    return matrices[..., GROUND_TAP]
+
+
+def floating_lines(matrices: np.ndarray) -> np.ndarray:
+    """
+    Lines not connected to anything, shape (..., 24)
+    """
+    return ~matrices.any(axis=-1)
+
+
+def shared_breakouts(matrices: np.ndarray) -> np.ndarray:
+    """
+    Breakouts connected to more than one line, shape (..., 8) for taps 1-8
+    """
+    return matrices[..., BREAKOUT_TAPS].sum(axis=-2) > 1
+
+
+def violations(matrices: np.ndarray, forbidden: np.ndarray) -> np.ndarray:
+    """
+    Closed relays that a wiring rule forbids
+
+    Args:
+        matrices: Relay matrix or fleet
+        forbidden: Boolean mask of relays that must be open, either (24, 10)
+                   for all switches or one per switch
+
+    Returns:
+        Array of indices (switch, line - 1, tap) of the violating relays,
+        without the switch index for a single matrix
+    """
+    return np.argwhere(matrices & forbidden)
@@ -0,0 +1,576 @@
+"""
+Transports that carry SCPI messages between a driver and an instrument.
+
+All drivers (qdac2.QDAC2, qswitch.QSwitch, qswitch_driver.QSwitch) talk to
+their instrument through a Transport, which implements writing, batching,
+querying with retries, time limits, metrics and tracing once for every kind
+of connection:
+
+- VisaTransport: a pyvisa resource (USB-serial or TCP/IP socket), or
+  anything that behaves like one, for example broker.BrokerResource.
+- SerialTransport: a serial port opened directly with pyserial.
+- TcpTransport: a raw TCP connection, normally to port 5025.
+- UdpTransport: UDP datagrams to port 5025 (QSwitch firmware >= 1.9).
+
+A transport can be given to qdac2.QDAC2 and qswitch.QSwitch instead of a
+VISA resource:
+
+import qdac2
+from common.transport import TcpTransport
+qdac = qdac2.QDAC2(TcpTransport('192.168.8.200'))
+qdac.transport.tracer = lambda direction, message: print(direction, message)
+print(qdac.query('*idn?'))
+print(qdac.transport.metrics)
+"""
+
+import os
+import select
+import socket
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import monotonic, sleep as sleep_s
+from typing import Any, Callable, List, Optional, Sequence
+from common.connection import visa_pool
+from common.deadline import Deadline, DeadlineExceeded
+from common.pacing import AimdPacer, pacer_for
+from common.datagrams import pack_messages, split_replies
+
+# Retries wait a little longer each time, so that a busy instrument is not
+# asked again right away
+FIRST_RETRY_DELAY_S = 0.1
+RETRY_DELAY_INCREASE_S = 0.5
+
+# Initial size of the receive buffer of serial and TCP transports
+STREAM_BUFFER_SIZE = 4096
+
+# Not on Windows
+_DONT_WAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+Tracer = Callable[[str, str], None]
+Log = Callable[[str], None]
+
+
+@dataclass
+class TransportMetrics:
+    writes: int = 0
+    queries: int = 0
+    retries: int = 0
+    failures: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    query_time_s: float = 0
+
+
+class Transport:
+    """
+    Message-based connection to an instrument
+
+    Subclasses implement _send, _receive and _discard_input, and can
+    override _exchange when the connection has its own query operation.
+
+    The deadline attribute limits the time of all communication; a driver
+    replaces it while an operation with a time limit runs.  The tracer, if
+    set, is called with '>' and each message sent, '<' and each answer
+    received, and '!' and each error.
+
+    Each operation holds the lock, and last_used_s tells when the transport
+    was last used, so that a background task (see health_monitor) can slip
+    in its own queries between those of the driver.
+    """
+
+    # Throw away stale answers before each query
+    clear_before_query = True
+
+    def __init__(self, name: str, timeout_s: float, delay_s: float = 0,
+                 log: Optional[Log] = None):
+        """
+        Args:
+            name: Description of the instrument used in error messages
+            timeout_s: Time to wait for an answer
+            delay_s: Time between sending a query and reading the answer
+            log: Called with a message for every retry and error
+        """
+        self.name = name
+        self.timeout_s = timeout_s
+        self.delay_s = delay_s
+        self.log: Log = log or (lambda message: None)
+        self.deadline = Deadline()
+        self.metrics = TransportMetrics()
+        self.tracer: Optional[Tracer] = None
+        self.lock = threading.RLock()
+        self.last_used_s = monotonic()
+
+    def write(self, cmd: str) -> None:
+        """
+        Send a SCPI message without waiting for an answer
+        """
+        self.write_many([cmd])
+
+    def write_many(self, cmds: Sequence[str]) -> None:
+        """
+        Send SCPI messages back to back, as few transfers as possible
+        """
+        for cmd in cmds:
+            self._trace('>', cmd)
+        self.deadline.check(f'Write [{cmds[0] if len(cmds) == 1 else cmds}]')
+        with self._in_use():
+            try:
+                self.metrics.bytes_sent += self._send(cmds)
+            except DeadlineExceeded:
+                raise
+            except Exception as error:
+                self.metrics.failures += 1
+                self._trace('!', repr(error))
+                self.log(f'{self.name}: Write error [{cmds}]: {repr(error)}')
+                raise ValueError(f'{self.name}: Write error [{cmds}]: {repr(error)}')
+        self.metrics.writes += len(cmds)
+
+    def query(self, cmd: str, attempts: int = 1) -> str:
+        """
+        Send a SCPI query and return the answer
+
+        Args:
+            cmd: SCPI query
+            attempts: Number of times to send the query if no answer comes
+        """
+        self.metrics.queries += 1
+        with self._in_use():
+            return self._retry(f'Query [{cmd}]', attempts,
+                               lambda timeout_s: self._query_once(cmd, timeout_s))
+
+    def read(self, attempts: int = 1) -> str:
+        """
+        Return the next answer without sending anything
+
+        Args:
+            attempts: Number of timeouts to wait
+        """
+        with self._in_use():
+            return self._retry('Read', attempts, self._read_once, feedback=False)
+
+    def clear(self) -> None:
+        """
+        Throw away answers that are waiting to be read
+        """
+        with self._in_use():
+            self._clear()
+
+    def discard_input(self) -> int:
+        """
+        Throw away answers that are waiting to be read
+
+        Returns:
+            The number of answers, or chunks of answers, thrown away
+        """
+        with self._in_use():
+            return self._discard_input()
+
+    def close(self) -> None:
+        pass
+
+    # ----------------------------------------------------------------------
+
+    @contextmanager
+    def _in_use(self):
+        with self.lock:
+            try:
+                yield
+            finally:
+                self.last_used_s = monotonic()
+
+    def _retry(self, what: str, attempts: int, once: Callable[[float], str],
+               feedback: bool = True) -> str:
+        """
+        Call once() with the timeout until it returns an answer
+
+        Args:
+            feedback: Tell _on_answer and _on_loss about the outcome
+        """
+        counter = 0
+        delay_s = FIRST_RETRY_DELAY_S
+        while True:
+            try:
+                answer = once(self.deadline.cap(self.timeout_s, what))
+                if counter > 0:
+                    self.log(f'{self.name}: {what} repeat {counter}')
+                if feedback:
+                    self._on_answer()
+                return answer
+            except DeadlineExceeded:
+                raise
+            except Exception as error:
+                counter += 1
+                self.metrics.failures += 1
+                self._trace('!', repr(error))
+                if feedback:
+                    self._on_loss()
+                self.log(f'{self.name}: {what} error {counter}: {repr(error)}')
+                if counter >= attempts:
+                    raise ValueError(f'{self.name}: {what} failed after '
+                                     f'{attempts} attempts: {repr(error)}')
+                self.metrics.retries += 1
+                sleep_s(self.deadline.cap(delay_s, what))
+                delay_s += RETRY_DELAY_INCREASE_S
+
+    def _query_once(self, cmd: str, timeout_s: float) -> str:
+        if self.clear_before_query:
+            self._clear()
+        self._trace('>', cmd)
+        start = monotonic()
+        answer = self._exchange(cmd, timeout_s)
+        self.metrics.query_time_s += monotonic() - start
+        self.metrics.bytes_sent += len(cmd) + 1
+        self.metrics.bytes_received += len(answer) + 1
+        self._trace('<', answer)
+        return answer
+
+    def _read_once(self, timeout_s: float) -> str:
+        answer = self._receive(timeout_s)
+        self.metrics.bytes_received += len(answer) + 1
+        self._trace('<', answer)
+        return answer
+
+    def _exchange(self, cmd: str, timeout_s: float) -> str:
+        self._send([cmd])
+        if self.delay_s:
+            sleep_s(self.delay_s)
+        return self._receive(timeout_s)
+
+    def _trace(self, direction: str, message: str) -> None:
+        if self.tracer:
+            self.tracer(direction, message)
+
+    def _clear(self) -> None:
+        self._discard_input()
+
+    def _on_answer(self) -> None:
+        pass
+
+    def _on_loss(self) -> None:
+        pass
+
+    def _send(self, cmds: Sequence[str]) -> int:
+        """
+        Send messages, returning the number of bytes sent
+        """
+        raise NotImplementedError
+
+    def _receive(self, timeout_s: float) -> str:
+        """
+        Return the next answer, raising an exception on timeout
+        """
+        raise NotImplementedError
+
+    def _discard_input(self) -> int:
+        raise NotImplementedError
+
+
+class VisaTransport(Transport):
+    """
+    Connection through a pyvisa resource
+    """
+
+    # A device clear on a socket is a round trip of its own, and serial
+    # answers arrive in order
+    clear_before_query = False
+
+    def __init__(self, resource: Any, name: str = 'VISA', timeout_s: float = 2,
+                 delay_s: float = 0.01, baud_rate: Optional[int] = None,
+                 log: Optional[Log] = None, clear_serial: bool = True):
+        """
+        Args:
+            resource: Open pyvisa resource
+            baud_rate: Set for serial resources
+            clear_serial: Let clear() act on serial resources, otherwise
+                          only on sockets
+        """
+        super().__init__(name, timeout_s, delay_s, log)
+        self.resource = resource
+        self.clear_serial = clear_serial
+        resource.write_termination = '\n'
+        resource.read_termination = '\n'
+        resource.timeout = timeout_s * 1000
+        resource.query_delay = delay_s
+        if baud_rate:
+            resource.baud_rate = baud_rate
+
+    def _clear(self) -> None:
+        if self.clear_serial or self.resource.resource_class == 'SOCKET':
+            self.resource.clear()
+
+    def close(self) -> None:
+        # A pooled resource may be shared with other drivers
+        if not visa_pool.release_resource(self.resource):
+            self.resource.close()
+
+    def _exchange(self, cmd: str, timeout_s: float) -> str:
+        self._set_timeout(timeout_s)
+        return self.resource.query(cmd)
+
+    def _send(self, cmds: Sequence[str]) -> int:
+        for cmd in cmds:
+            self.resource.write(cmd)
+        return sum(len(cmd) + 1 for cmd in cmds)
+
+    def _receive(self, timeout_s: float) -> str:
+        self._set_timeout(timeout_s)
+        return self.resource.read()
+
+    def _discard_input(self) -> int:
+        self._clear()
+        return 0
+
+    def _set_timeout(self, timeout_s: float) -> None:
+        timeout_ms = timeout_s * 1000
+        if timeout_ms != self.resource.timeout:
+            self.resource.timeout = timeout_ms
+
+
+class _StreamTransport(Transport):
+    """
+    Newline-terminated messages over a byte stream
+
+    Bytes are read straight into a buffer that is allocated once, and each
+    answer is decoded directly from the buffer up to its newline, so that
+    no intermediate bytes objects are made.
+
+    Answers arrive in order, so stale answers are only thrown away before a
+    query when an earlier answer did not arrive in time.
+    """
+
+    clear_before_query = False
+
+    def __init__(self, name: str, timeout_s: float, delay_s: float,
+                 log: Optional[Log]):
+        super().__init__(name, timeout_s, delay_s, log)
+        self._buffer = bytearray(STREAM_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # First byte not yet returned
+        self._scanned = 0  # No newline between _start and here
+        self._end = 0  # End of the bytes received
+        self._stale = False  # Late answers may still arrive
+
+    def _send(self, cmds: Sequence[str]) -> int:
+        data = ''.join(f'{cmd}\n' for cmd in cmds).encode()
+        self._send_bytes(data)
+        return len(data)
+
+    def _exchange(self, cmd: str, timeout_s: float) -> str:
+        if self._stale:
+            self._discard_input()
+            self._stale = False
+        return super()._exchange(cmd, timeout_s)
+
+    def _receive(self, timeout_s: float) -> str:
+        newline = self._buffer.find(b'\n', self._scanned, self._end)
+        end_time = None
+        while newline < 0:
+            self._scanned = self._end
+            if end_time is None:
+                end_time = monotonic() + timeout_s
+            remaining = end_time - monotonic()
+            if remaining <= 0:
+                self._stale = True
+                raise TimeoutError(f'No answer within {timeout_s} s')
+            self._fill(remaining)
+            newline = self._buffer.find(b'\n', self._scanned, self._end)
+        answer = str(self._view[self._start:newline], 'utf-8').strip()
+        self._start = self._scanned = newline + 1
+        if self._start == self._end:
+            self._start = self._scanned = self._end = 0
+        return answer
+
+    def _discard_input(self) -> int:
+        count = self._buffer.count(b'\n', self._start, self._end)
+        self._start = self._scanned = self._end = 0
+        while True:
+            received = self._receive_into(self._view, 0)
+            if not received:
+                return count
+            count += self._buffer.count(b'\n', 0, received)
+
+    def _fill(self, timeout_s: float) -> None:
+        if self._end == len(self._buffer):
+            unread = self._end - self._start
+            if self._start > 0:
+                self._buffer[:unread] = bytes(self._view[self._start:self._end])
+            else:
+                # An answer longer than the buffer
+                self._view.release()
+                self._buffer.extend(bytes(len(self._buffer)))
+                self._view = memoryview(self._buffer)
+            self._scanned -= self._start
+            self._start = 0
+            self._end = unread
+        self._end += self._receive_into(self._view[self._end:], timeout_s)
+
+    def _send_bytes(self, data: bytes) -> None:
+        raise NotImplementedError
+
+    def _receive_into(self, view: memoryview, timeout_s: float) -> int:
+        """
+        Put the bytes that arrive within the timeout, possibly none, into
+        view and return their number
+        """
+        raise NotImplementedError
+
+
+class SerialTransport(_StreamTransport):
+    """
+    Connection to a serial port through pyserial, bypassing pyvisa
+
+    On Linux and macOS, the port is read directly through its file
+    descriptor.
+    """
+
+    def __init__(self, port: str, baud_rate: int, timeout_s: float = 1,
+                 delay_s: float = 0, log: Optional[Log] = None,
+                 name: Optional[str] = None):
+        """
+        Args:
+            port: Serial port, for example from common.connection.find_serial_device
+            baud_rate: 921600 for QDAC-II, 9600 for QSwitch
+        """
+        import serial  # Only loaded when a serial port is opened
+        super().__init__(name or f'Serial {port}', timeout_s, delay_s, log)
+        self.port = serial.Serial(port, baud_rate, timeout=timeout_s)
+        self._fd = getattr(self.port, 'fd', None) if hasattr(os, 'readv') else None
+
+    def close(self) -> None:
+        self.port.close()
+
+    def _send_bytes(self, data: bytes) -> None:
+        self.port.write(data)
+
+    def _receive_into(self, view: memoryview, timeout_s: float) -> int:
+        if self._fd is None:
+            return self._read_into(view, timeout_s)
+        if timeout_s > 0:
+            ready, _, _ = select.select([self._fd], [], [], timeout_s)
+            if not ready:
+                return 0
+        try:
+            received = os.readv(self._fd, [view])
+        except BlockingIOError:
+            return 0
+        if timeout_s > 0 and not received:
+            raise ConnectionError(f'{self.name} was disconnected')
+        return received
+
+    def _read_into(self, view: memoryview, timeout_s: float) -> int:
+        waiting = self.port.in_waiting
+        if not waiting:
+            if timeout_s <= 0:
+                return 0
+            if self.port.timeout != timeout_s:
+                self.port.timeout = timeout_s
+            return self.port.readinto(view[:1])
+        return self.port.readinto(view[:min(waiting, len(view))])
+
+
+class TcpTransport(_StreamTransport):
+    """
+    Raw TCP connection, bypassing pyvisa
+    """
+
+    def __init__(self, host: str, port: int = 5025, timeout_s: float = 1,
+                 delay_s: float = 0, log: Optional[Log] = None,
+                 name: Optional[str] = None):
+        super().__init__(name or f'TCP {host}:{port}', timeout_s, delay_s, log)
+        self.sock = socket.create_connection((host, port), timeout=timeout_s)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def _send_bytes(self, data: bytes) -> None:
+        self.sock.sendall(data)
+
+    def _receive_into(self, view: memoryview, timeout_s: float) -> int:
+        try:
+            if timeout_s > 0:
+                self.sock.settimeout(timeout_s)
+                received = self.sock.recv_into(view)
+            elif _DONT_WAIT:
+                received = self.sock.recv_into(view, 0, _DONT_WAIT)
+            else:
+                self.sock.settimeout(0.0001)
+                received = self.sock.recv_into(view)
+        except (socket.timeout, BlockingIOError):
+            return 0
+        if not received:
+            raise ConnectionError(f'{self.name} closed the connection')
+        return received
+
+
+class UdpTransport(Transport):
+    """
+    UDP datagrams to an instrument (QSwitch firmware >= 1.9)
+
+    Datagrams are paced by the process-wide pacer for the IP address.
+    Several messages written together are packed into one datagram, and an
+    answer datagram may hold several answers.
+    """
+
+    def __init__(self, ip: str, port: int = 5025, timeout_s: float = 2,
+                 delay_s: float = 0.01, log: Optional[Log] = None,
+                 name: Optional[str] = None, pacer: Optional[AimdPacer] = None):
+        super().__init__(name or f'{ip} (UDP)', timeout_s, delay_s, log)
+        self.ip = ip
+        self.port = port
+        self.pacer = pacer or pacer_for(ip)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout_s)
+        self._answers: List[str] = []
+
+    def _clear(self) -> None:
+        if self._discard_input():
+            self.pacer.on_loss()  # Stale replies to earlier requests
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def _exchange(self, cmd: str, timeout_s: float) -> str:
+        self._send([cmd])
+        if self.delay_s:
+            sleep_s(self.delay_s)
+        # A reply to a single query is a single datagram
+        self.sock.settimeout(timeout_s)
+        data, _ = self.sock.recvfrom(1024)
+        return data.decode().strip()
+
+    def _on_answer(self) -> None:
+        self.pacer.on_success()
+
+    def _on_loss(self) -> None:
+        self.pacer.on_loss()
+
+    def _send(self, cmds: Sequence[str]) -> int:
+        sent = 0
+        for datagram in pack_messages(cmds):
+            self.deadline.check('Write')
+            self.pacer.wait()
+            sent += self.sock.sendto(datagram, (self.ip, self.port))
+        return sent
+
+    def _receive(self, timeout_s: float) -> str:
+        while not self._answers:
+            self.sock.settimeout(timeout_s)
+            data, _ = self.sock.recvfrom(1024)
+            self._answers = split_replies(data)
+        return self._answers.pop(0)
+
+    def _discard_input(self) -> int:
+        count = len(self._answers)
+        self._answers = []
+        self.sock.settimeout(0.0001)
+        try:
+            while True:
+                try:
+                    self.sock.recvfrom(1024)
+                    count += 1
+                except OSError:
+                    return count
+        finally:
+            self.sock.settimeout(self.timeout_s)
@@ -0,0 +1,170 @@
+"""
+Thread-safe access to an instrument driver.
+
+None of the drivers (qdac2.QDAC2, qswitch.QSwitch, qswitch_driver.QSwitch)
+may be used from several threads at the same time, as replies could end up
+with the wrong caller.  An InstrumentWorker owns the driver in a single
+thread; other threads submit requests and get futures back.
+
+Use like this:
+
+import qswitch_driver
+from common.worker import InstrumentWorker
+switch = qswitch_driver.QSwitch(qswitch_driver.UDPConfig(ip='192.168.8.100'))
+worker = InstrumentWorker(switch)
+state = worker.query('stat?')
+worker.change_relays(close=[(1, 9)], open=[(1, 0)])
+print(state.result())
+worker.close()
+
+Relay changes (change_relays) that are queued back to back are merged, so
+that the QSwitch only receives one diff for all of them.  A change that
+closes relays on a line where an earlier change opens relays is not merged,
+as the merged diff would make the new connection before breaking the old one.
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, FrozenSet, List, Optional, Sequence, Tuple
+
+State = Sequence[Tuple[int, int]]
+
+
+@dataclass
+class _Call:
+    function: Callable[[], Any]
+    future: Future = field(default_factory=Future)
+
+
+@dataclass
+class _RelayChange:
+    close: FrozenSet[Tuple[int, int]]
+    open: FrozenSet[Tuple[int, int]]
+    future: Future = field(default_factory=Future)
+
+
+_STOP = object()
+
+
+class InstrumentWorker:
+    """
+    Serialise all communication with an instrument through one thread
+    """
+
+    def __init__(self, instrument: Any, name: Optional[str] = None):
+        self.instrument = instrument
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True,
+            name=name or f'{type(instrument).__name__}Worker')
+        self._thread.start()
+
+    def submit(self, function: Callable[[], Any]) -> Future:
+        """
+        Run a function in the worker thread
+
+        Args:
+            function: Called without arguments, typically a lambda using the
+                      instrument
+        """
+        call = _Call(function)
+        self._queue.put(call)
+        return call.future
+
+    def query(self, cmd: str) -> Future:
+        """
+        Send a SCPI query, the future holds the answer
+        """
+        return self.submit(lambda: self.instrument.query(cmd))
+
+    def command(self, cmd: str) -> Future:
+        """
+        Send a SCPI command, using the command() or write() of the driver
+        """
+        send = getattr(self.instrument, 'command', None) or \
+            getattr(self.instrument, 'write')
+        return self.submit(lambda: send(cmd))
+
+    def change_relays(self, close: State = (), open: State = ()) -> Future:
+        """
+        Close and then open relays on a qswitch_driver.QSwitch
+
+        Consecutive relay changes waiting in the queue are merged into a
+        single change.
+
+        Args:
+            close: Relays to close
+            open: Relays to open afterwards
+        """
+        change = _RelayChange(frozenset(close), frozenset(open))
+        self._queue.put(change)
+        return change.future
+
+    def close(self) -> None:
+        """
+        Finish the queued requests and stop the worker thread
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self) -> None:
+        pending: List[Any] = list()
+        while True:
+            item = pending.pop(0) if pending else self._queue.get()
+            if item is _STOP:
+                return
+            if isinstance(item, _RelayChange):
+                changes = [item]
+                while True:
+                    try:
+                        following = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if not isinstance(following, _RelayChange) or \
+                            not _can_merge(changes, following):
+                        pending.append(following)
+                        break
+                    changes.append(following)
+                self._apply_relay_changes(changes)
+            else:
+                self._execute(item)
+
+    def _execute(self, call: _Call) -> None:
+        if not call.future.set_running_or_notify_cancel():
+            return
+        try:
+            call.future.set_result(call.function())
+        except BaseException as error:
+            call.future.set_exception(error)
+
+    def _apply_relay_changes(self, changes: List[_RelayChange]) -> None:
+        changes = [change for change in changes
+                   if change.future.set_running_or_notify_cancel()]
+        if not changes:
+            return
+        # (state | close) - open, applied one after the other, is the same as
+        # (state | all closes) - (opens not closed again later)
+        closing: FrozenSet[Tuple[int, int]] = frozenset()
+        opening: FrozenSet[Tuple[int, int]] = frozenset()
+        for change in changes:
+            closing = closing | change.close
+            opening = (opening - change.close) | change.open
+        try:
+            self.instrument.change_relays(list(closing), list(opening))
+        except BaseException as error:
+            for change in changes:
+                change.future.set_exception(error)
+            return
+        for change in changes:
+            change.future.set_result(None)
+
+
+def _can_merge(changes: List[_RelayChange], following: _RelayChange) -> bool:
+    """
+    Tell if a change can join earlier ones without closing relays on a line
+    before the earlier changes have opened relays on it
+    """
+    opening_lines = {line for change in changes for line, _ in change.open}
+    return not any(line in opening_lines for line, _ in following.close)
@@ -0,0 +1,185 @@
+"""
+Background health monitoring of a QDAC-II or QSwitch.
+
+A monitor thread polls the error queue (syst:err:all? on the QDAC-II, all?
+on the QSwitch) and, on a QSwitch, the relay state (stat?) at a low rate.
+The polls go straight to the transport of the driver, and only when the
+driver has left it alone for a while, so they fill the idle gaps in the
+traffic of the script instead of adding round trips to it.
+
+Anything noteworthy is passed as a MonitorEvent to the callbacks:
+
+- 'error': the instrument reported errors,
+- 'relays': the QSwitch relays changed without qswitch_driver.QSwitch
+  changing them (any change, with qswitch.QSwitch, which keeps no state),
+- 'unreachable': a poll failed,
+- 'reachable': a poll succeeded again after failing.
+
+Use like this:
+
+import qswitch_driver
+from health_monitor import HealthMonitor
+qswitch = qswitch_driver.QSwitch(qswitch_driver.UDPConfig(ip='192.168.8.100'))
+monitor = HealthMonitor(qswitch, interval_s=2)
+monitor.on_event(print)
+monitor.start()
+...
+monitor.stop()
+
+Reading the error queue empties it, so errors found by the monitor are no
+longer returned by status() or errors(); they are kept in monitor.errors.
+"""
+
+import threading
+from dataclasses import dataclass, field
+from time import monotonic, time
+from typing import Any, Callable, List, Optional, Tuple
+from common.channel_list import channel_list_to_state
+import qdac2
+import qswitch_driver
+
+State = List[Tuple[int, int]]
+
+
+@dataclass
+class MonitorEvent:
+    # 'error', 'relays', 'unreachable' or 'reachable'
+    kind: str
+    message: str
+    # Wall-clock time of the poll
+    when: float = field(default_factory=time)
+
+
+EventCallback = Callable[[MonitorEvent], None]
+
+
+class HealthMonitor:
+    """
+    Poll an instrument for errors and relay changes in a background thread
+    """
+
+    def __init__(self, driver: Any, interval_s: float = 5.0, idle_s: float = 0.5):
+        """
+        Args:
+            driver: qdac2.QDAC2, qswitch.QSwitch or qswitch_driver.QSwitch
+            interval_s: Time between polls
+            idle_s: Time the driver must have been quiet before polling
+        """
+        self.driver = driver
+        self.transport = driver.transport
+        self.interval_s = interval_s
+        self.idle_s = idle_s
+        self.errors: List[MonitorEvent] = []
+        self._callbacks: List[EventCallback] = []
+        self._is_qdac = isinstance(driver, qdac2.QDAC2)
+        self._observed: Optional[State] = None
+        self._reachable = True
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def on_event(self, callback: EventCallback) -> None:
+        """
+        Call a function with every event from now on
+        """
+        self._callbacks.append(callback)
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True,
+            name=f'{type(self.driver).__name__}Monitor')
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the monitor thread (the instrument stays open)
+        """
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def poll(self) -> List[MonitorEvent]:
+        """
+        Check the instrument once, right away
+
+        Returns:
+            The events found, which have also been passed to the callbacks
+        """
+        with self.transport.lock:
+            events = self._poll()
+        return self._publish(events)
+
+    # ----------------------------------------------------------------------
+
+    def _run(self) -> None:
+        due = monotonic() + self.interval_s
+        while not self._stop.wait(max(0, due - monotonic())):
+            quiet_from = self.transport.last_used_s + self.idle_s
+            if monotonic() < quiet_from:
+                due = quiet_from
+                continue
+            if not self.transport.lock.acquire(blocking=False):
+                due = monotonic() + self.idle_s
+                continue
+            try:
+                events = self._poll()
+            finally:
+                self.transport.lock.release()
+            # Callbacks run without the lock, so they do not hold up the driver
+            self._publish(events)
+            due = monotonic() + self.interval_s
+
+    def _poll(self) -> List[MonitorEvent]:
+        events: List[MonitorEvent] = []
+        try:
+            errors = self.transport.query(
+                'syst:err:all?' if self._is_qdac else 'all?')
+            relays = None if self._is_qdac else \
+                channel_list_to_state(self.transport.query('stat?'))
+        except Exception as error:
+            if self._reachable:
+                self._reachable = False
+                events.append(MonitorEvent('unreachable', str(error)))
+            return events
+        if not self._reachable:
+            self._reachable = True
+            events.append(MonitorEvent('reachable', self.transport.name))
+        if not _no_error(errors):
+            event = MonitorEvent('error', errors)
+            self.errors.append(event)
+            events.append(event)
+        if relays is not None:
+            events.extend(self._check_relays(relays))
+        return events
+
+    def _check_relays(self, relays: State) -> List[MonitorEvent]:
+        before = self._observed
+        self._observed = relays
+        if before is None or sorted(relays) == sorted(before):
+            return []
+        if isinstance(self.driver, qswitch_driver.QSwitch):
+            known = self.driver.closed_relays(refresh=False)
+            if sorted(relays) == sorted(known):
+                return []  # The driver changed them
+        closed = sorted(set(relays) - set(before))
+        opened = sorted(set(before) - set(relays))
+        return [MonitorEvent('relays', f'Closed {closed}, opened {opened}')]
+
+    def _publish(self, events: List[MonitorEvent]) -> List[MonitorEvent]:
+        for event in events:
+            for callback in self._callbacks:
+                # A failing callback must neither stop the others nor the
+                # monitor thread
+                try:
+                    callback(event)
+                except Exception as error:
+                    print(f'Monitor {event.kind} callback failed: {error}')
+        return events
+
+
+def _no_error(errors: str) -> bool:
+    return errors.split(',')[0].strip() == '0'
@@ -0,0 +1,86 @@
+"""
+Benchmark of the time it takes to import the drivers, to catch changes that
+make scripts start slowly.
+
+Each module is imported in a fresh Python process, a number of times, and
+the best time is compared with a limit.  The check also fails if a module
+loads one of the heavy dependencies that should only be loaded on the code
+paths that need them (pyvisa, pyserial, packaging, NumPy).
+
+$ python src/import_benchmark.py
+$ python src/import_benchmark.py --limit-ms 50 --runs 10
+
+The exit code is 1 if any module is too slow or loads a heavy dependency,
+so that it can be run as a check before a release.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from typing import List, Tuple
+
+MODULES = ['qswitch_driver', 'qswitch', 'qdac2', 'cli', 'health_monitor', 'qdac2_async']
+HEAVY = ['pyvisa', 'serial', 'packaging', 'numpy']
+
+CHILD = '''
+import sys, json
+from time import perf_counter
+start = perf_counter()
+import {module}
+elapsed = perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps([elapsed, heavy]))
+'''
+
+
+def import_once(module: str) -> Tuple[float, List[str]]:
+    """
+    Import a module in a new process
+
+    Returns:
+        The import time in seconds and the heavy dependencies loaded
+    """
+    source = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD.format(module=module, heavy=HEAVY)],
+        cwd=source, capture_output=True, text=True, check=True).stdout
+    elapsed, heavy = json.loads(output)
+    return elapsed, heavy
+
+
+def run(modules: List[str], runs: int, limit_ms: float) -> bool:
+    """
+    Print the import times and tell if all modules are within the limits
+    """
+    print(f'{"module":20} {"best":>10} {"median":>10}  heavy dependencies')
+    passed = True
+    for module in modules:
+        times: List[float] = []
+        heavy: List[str] = []
+        for _ in range(runs):
+            elapsed, heavy = import_once(module)
+            times.append(elapsed * 1000)
+        times.sort()
+        best, median = times[0], times[len(times) // 2]
+        ok = best <= limit_ms and not heavy
+        passed = passed and ok
+        print(f'{module:20} {best:7.1f} ms {median:7.1f} ms  '
+              f'{", ".join(heavy) or "-"}{"" if ok else "  FAIL"}')
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that the drivers import quickly')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--runs', type=int, default=5, help='Imports per module')
+    parser.add_argument('--limit-ms', type=float, default=100,
+                        help='Largest acceptable best import time, which depends on the computer')
+    args = parser.parse_args()
+    try:
+        sys.exit(0 if run(args.modules, args.runs, args.limit_ms) else 1)
+    except Exception as error:
+        print(f'Error: {error}')
+        sys.exit(1)
@@ -0,0 +1,291 @@
+"""
+Run a plan file of SCPI commands and high-level operations against one or
+more QSwitches and QDAC-IIs, with one connection per instrument for the
+whole plan.
+
+Each instrument gets its own worker thread, so steps on different
+instruments run at the same time, while the steps on one instrument run in
+the order of the plan.  Commands in a step are sent together.  A QDAC-II
+reports errors at the end of each step, while the error queue of a QSwitch
+is only read at a "sync" step and at the end of the plan, instead of after
+every command.  Errors found are attributed to the steps run on that
+instrument since the previous check; use --check-each-step to check after
+every step instead.
+
+A plan is a JSON file like this:
+
+{
+  "instruments": {
+    "switch": {"kind": "qswitch", "ip": "192.168.8.100", "presets": "presets.json"},
+    "dac": {"kind": "qdac2", "host": "192.168.8.200"}
+  },
+  "steps": [
+    {"on": "dac", "volts": {"1": 0, "2": 0}},
+    {"on": "switch", "ground": "all"},
+    {"sync": true},
+    {"on": "switch", "preset": "measure"},
+    {"on": "switch", "connect": ["1", "2"]},
+    {"on": "dac", "scpi": ["sour1:volt 0.1", "sour2:volt -0.1"]},
+    {"on": "dac", "query": "sour1:volt?"}
+  ]
+}
+
+A QSwitch is reached on UDP ("ip"), on a VISA address ("visa") or found on
+USB, and a QDAC-II on the LAN ("host") or found on USB ("serial_number" to
+pick one).  The operations are:
+
+- scpi: a command or a list of commands, for any instrument,
+- query: a query, whose answer is reported, for any instrument,
+- volts: QDAC-II channel: voltage setpoints,
+- ground, connect: "all" or a list of QSwitch line names,
+- preset: name of a QSwitch preset.
+
+$ python src/plan_runner.py plan.json
+"""
+
+import sys
+import json
+import argparse
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Dict, List, Optional
+from concurrent.futures import Future
+from common.worker import InstrumentWorker
+from cli import open_qdac2, open_qswitch
+
+KINDS = ['qswitch', 'qdac2']
+OPERATIONS = {
+    'qswitch': ['scpi', 'query', 'ground', 'connect', 'preset'],
+    'qdac2': ['scpi', 'query', 'volts'],
+}
+
+
+@dataclass
+class StepResult:
+    index: int
+    instrument: str
+    operation: str
+    # From the start of the plan
+    started_s: float = 0
+    duration_s: float = 0
+    answer: str = ''
+    error: str = ''
+    skipped: bool = False
+
+
+class _Session:
+    """
+    Connection to one instrument and the steps run on it
+    """
+
+    def __init__(self, name: str, kind: str, driver: Any):
+        self.name = name
+        self.kind = kind
+        self.driver = driver
+        self.worker = InstrumentWorker(driver, name=f'{name}Worker')
+        self.futures: List[Future] = []
+        # Steps since the error queue was last read
+        self.unchecked: List[StepResult] = []
+        self.failed = False
+
+    def close(self) -> None:
+        self.worker.close()
+        self.driver.close()
+
+
+class PlanRunner:
+    """
+    Carry out a plan with one session per instrument
+    """
+
+    def __init__(self, plan: Dict[str, Any], check_each_step: bool = False):
+        """
+        Args:
+            plan: Instruments and steps, as read from a plan file
+            check_each_step: Read the error queue after every step
+        """
+        self.instruments: Dict[str, Dict[str, Any]] = plan.get('instruments', {})
+        self.steps: List[Dict[str, Any]] = plan.get('steps', [])
+        self.check_each_step = check_each_step
+        self._validate()
+
+    @classmethod
+    def from_file(cls, path: str, check_each_step: bool = False) -> 'PlanRunner':
+        with open(path) as file:
+            return cls(json.load(file), check_each_step)
+
+    def run(self) -> List[StepResult]:
+        """
+        Carry out all steps, stopping on an instrument after its first error
+
+        Returns:
+            The outcome of each step, in plan order
+        """
+        sessions: Dict[str, _Session] = dict()
+        results: List[StepResult] = []
+        try:
+            for name, config in self.instruments.items():
+                sessions[name] = _Session(name, config['kind'], _connect(config))
+            began = monotonic()
+            for index, step in enumerate(self.steps):
+                if step.get('sync'):
+                    self._sync(sessions.values())
+                    continue
+                session = sessions[step['on']]
+                result = StepResult(index, session.name, _describe(step))
+                results.append(result)
+                session.futures.append(session.worker.submit(
+                    lambda session=session, step=step, result=result:
+                        self._execute(session, step, result, began)))
+            self._sync(sessions.values())
+        finally:
+            for session in sessions.values():
+                session.close()
+        return results
+
+    # ----------------------------------------------------------------------
+
+    def _validate(self) -> None:
+        for name, config in self.instruments.items():
+            if config.get('kind') not in KINDS:
+                raise ValueError(f'Instrument "{name}" must have a kind out of {KINDS}')
+        for index, step in enumerate(self.steps):
+            if step.get('sync'):
+                continue
+            name = step.get('on')
+            if name not in self.instruments:
+                raise ValueError(f'Step {index}: unknown instrument "{name}"')
+            allowed = OPERATIONS[self.instruments[name]['kind']]
+            operations = [key for key in step if key != 'on']
+            if len(operations) != 1 or operations[0] not in allowed:
+                raise ValueError(f'Step {index}: needs one operation out of {allowed}')
+
+    def _sync(self, sessions) -> None:
+        """
+        Wait for the queued steps and read the error queues
+        """
+        checks = [session.worker.submit(lambda session=session: self._check(session))
+                  for session in sessions]
+        for session in sessions:
+            for future in session.futures:
+                future.result()
+            session.futures.clear()
+        for check in checks:
+            check.result()
+
+    def _execute(self, session: _Session, step: Dict[str, Any],
+                 result: StepResult, began: float) -> None:
+        if session.failed:
+            result.skipped = True
+            return
+        start = monotonic()
+        result.started_s = start - began
+        try:
+            result.answer = _perform(session, step) or ''
+        except Exception as error:
+            result.error = str(error)
+            session.failed = True
+        result.duration_s = monotonic() - start
+        session.unchecked.append(result)
+        if self.check_each_step:
+            self._check(session)
+
+    def _check(self, session: _Session) -> None:
+        """
+        Read the error queue and blame the steps since the last check
+        """
+        if session.failed or not session.unchecked:
+            session.unchecked.clear()
+            return
+        steps = session.unchecked[:]
+        session.unchecked.clear()
+        try:
+            errors = session.driver.errors() if session.kind == 'qswitch' \
+                else session.driver.status()
+        except Exception as error:
+            errors = str(error)
+        if _no_error(errors):
+            return
+        session.failed = True
+        indices = ', '.join(str(step.index) for step in steps)
+        for step in steps:
+            step.error = f'{errors} (after step {indices})'
+
+
+def _connect(config: Dict[str, Any]) -> Any:
+    if config['kind'] == 'qswitch':
+        driver = open_qswitch(config.get('ip'), config.get('visa'))
+        if config.get('presets'):
+            driver.load_presets(config['presets'])
+        return driver
+    return open_qdac2(config.get('host'), config.get('serial_number'))
+
+
+def _perform(session: _Session, step: Dict[str, Any]) -> Optional[str]:
+    """
+    Carry out the operation of a step in the worker thread of the session
+    """
+    driver = session.driver
+    if 'query' in step:
+        return driver.query(step['query'])
+    if 'scpi' in step:
+        cmds = [step['scpi']] if isinstance(step['scpi'], str) else step['scpi']
+        if session.kind == 'qswitch':
+            driver.write_many(cmds)
+            # The commands may have moved relays behind the back of the driver
+            driver._state_force_update()
+        else:
+            driver.sequence(cmds)
+    elif 'volts' in step:
+        driver.sequence([f'sour{channel}:volt {volts}'
+                         for channel, volts in step['volts'].items()])
+    elif 'ground' in step:
+        if step['ground'] == 'all':
+            driver.ground_and_release_all()
+        else:
+            driver.ground_and_release([str(line) for line in step['ground']])
+    elif 'connect' in step:
+        if step['connect'] == 'all':
+            driver.connect_and_unground_all()
+        else:
+            driver.connect_and_unground([str(line) for line in step['connect']])
+    elif 'preset' in step:
+        driver.apply_preset(step['preset'])
+    return None
+
+
+def _describe(step: Dict[str, Any]) -> str:
+    operation, argument = next((key, value) for key, value in step.items()
+                               if key != 'on')
+    return f'{operation} {json.dumps(argument)}'
+
+
+def _no_error(errors: str) -> bool:
+    return errors.split(',')[0].strip() == '0'
+
+
+def report(results: List[StepResult]) -> None:
+    print(f'{"step":>4} {"instrument":12} {"start":>10} {"time":>10}  operation')
+    for result in results:
+        outcome = 'skipped' if result.skipped else \
+            f'error: {result.error}' if result.error else result.answer
+        print(f'{result.index:4} {result.instrument:12} '
+              f'{result.started_s * 1000:7.1f} ms {result.duration_s * 1000:7.1f} ms  '
+              f'{result.operation}{"  -> " + outcome if outcome else ""}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a plan of QSwitch and QDAC-II operations')
+    parser.add_argument('plan', help='JSON plan file')
+    parser.add_argument('--check-each-step', action='store_true',
+                        help='Read the error queue after every step')
+    args = parser.parse_args()
+    try:
+        results = PlanRunner.from_file(args.plan, args.check_each_step).run()
+        report(results)
+        failed = any(result.error or result.skipped for result in results)
+        sys.exit(1 if failed else 0)
+    except Exception as error:
+        print(f'Error: {error}')
+        sys.exit(1)
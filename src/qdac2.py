@@ -1,5 +1,10 @@
-import pyvisa as visa
-from typing import Sequence, List
+from __future__ import annotations
+from typing import Sequence, List, Optional, TYPE_CHECKING
+import common.connection as conn
+from common.transport import Transport, VisaTransport, SerialTransport, TcpTransport
+
+if TYPE_CHECKING:
+    import pyvisa as visa  # Only needed for VISA resources, which the caller opens
 
 
 def comma_sequence_to_list(sequence: str):
@@ -23,16 +28,27 @@ class QDAC2:
     device = conn.find_qdac2_on_usb()
     qdac = qdac2.QDAC2(device)
     print(qdac.status())
+
+    Instead of a VISA resource, any common.transport.Transport can be given,
+    for example a TcpTransport.  To bypass pyvisa, which saves time on every
+    message, use open_qdac2_on_usb() or open_qdac2_on_lan() instead.
     """
 
-    def __init__(self, visa_resource: visa.Resource):
-        self._dac = visa_resource
-        self._dac.write_termination = '\n'
-        self._dac.read_termination = '\n'
-        self._dac.baud_rate = 921600
-        self._dac.timeout = 1000  # ms
+    def __init__(self, visa_resource: visa.Resource | Transport):
+        if isinstance(visa_resource, Transport):
+            self.transport = visa_resource
+        else:
+            self.transport = VisaTransport(visa_resource, 'QDAC', timeout_s=1,
+                                           delay_s=0, baud_rate=921600,
+                                           log=print)
         self._record_commands = False
 
+    def close(self) -> None:
+        """
+        Close the connection, or hand a pooled VISA resource back
+        """
+        self.transport.close()
+
     def status(self) -> str:
         """
         Return the error status of the instrument.
@@ -41,14 +57,16 @@ class QDAC2:
 
     def sequence(self, cmds: Sequence[str]):
         """
-        Send a sequence of SCPI commands to the QDAC
+        Send a sequence of SCPI commands to the QDAC, and check for errors
+        once they have all been sent
         """
-        for cmd in cmds:
-            self._write(cmd)
-            errors = self.query('syst:err:all?')
-            if is_ok(errors):
-                return
-            raise ValueError(f'Error: {errors} while executing {cmds}')
+        if self._record_commands:
+            self._scpi_sent.extend(cmds)
+        self.transport.write_many(cmds)
+        errors = self.query('syst:err:all?')
+        if is_ok(errors):
+            return
+        raise ValueError(f'Error: {errors} while executing {cmds}')
 
     def command(self, cmd: str):
         """
@@ -66,19 +84,13 @@ class QDAC2:
         """
         if self._record_commands:
             self._scpi_sent.append(cmd)
-        try:
-            answer = self._dac.query(cmd)
-        except visa.errors.VisaIOError as error:
-            msg = f'QDAC failed query (1st try): {repr(error)}'
-            print(msg)
-            answer = self._dac.query(cmd)
-        return answer
+        return self.transport.query(cmd, attempts=2)
 
     def clear(self) -> None:
         """
         Function to reset the VISA message queue of the instrument.
         """
-        self._dac.clear()
+        self.transport.clear()
 
     # ----------------------------------------------------------------------
     # Debugging and testing
@@ -106,4 +118,27 @@ class QDAC2:
     def _write(self, cmd: str) -> None:
         if self._record_commands:
             self._scpi_sent.append(cmd)
-        self._dac.write(cmd)
+        self.transport.write(cmd)
+
+
+def open_qdac2_on_usb(serial_number: Optional[str] = None) -> QDAC2:
+    """
+    Connect to a USB-attached QDAC-II through pyserial, bypassing pyvisa
+
+    Args:
+        serial_number: Pick the QDAC-II with this USB serial number, if
+                       several are attached
+    """
+    device = conn.devices[0]
+    port = conn.find_serial_device(device, serial_number)
+    if not port:
+        raise ValueError('No device found')
+    return QDAC2(SerialTransport(port, device.baud_rate, name='QDAC',
+                                 log=print))
+
+
+def open_qdac2_on_lan(host: str, port: int = 5025) -> QDAC2:
+    """
+    Connect to a QDAC-II through a raw TCP socket, bypassing pyvisa
+    """
+    return QDAC2(TcpTransport(host, port, name='QDAC', log=print))
@@ -0,0 +1,266 @@
+"""
+asyncio wrapper for communicating with a QDAC-II.
+
+Every call is a coroutine, so that an asyncio program can talk to several
+QDAC-IIs at the same time without threads.  Messages to one QDAC-II are
+sent in order, and each answer is matched with its query.
+
+Use like this on the LAN:
+
+import asyncio
+from qdac2_async import AsyncQDAC2
+
+async def main():
+    async with await AsyncQDAC2.open_lan('192.168.8.200') as qdac:
+        print(await qdac.query('*idn?'))
+        await qdac.command('sour1:volt 0.1')
+
+asyncio.run(main())
+
+or on USB (Linux and macOS only):
+
+qdac = await AsyncQDAC2.open_usb()
+
+A call that is cancelled, or that times out, after its query was sent leaves
+the answer to arrive later.  The next call waits for that answer and throws
+it away before sending anything, so answers never end up with the wrong
+caller.
+"""
+
+import os
+import asyncio
+from typing import List, Optional, Sequence
+import common.connection as conn
+from qdac2 import is_ok
+
+DEFAULT_TIMEOUT_S = 1
+QUIET_S = 0.01  # Time without input after which clear() stops reading
+# Answers on a stream are late rather than lost, so wait this long for the
+# answers to abandoned queries before giving up on them
+LATE_ANSWER_LIMIT_S = 5
+
+
+class _TcpStream:
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self.reader = reader
+        self._writer = writer
+
+    async def write(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def close(self) -> None:
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+class _SerialStream:
+    """
+    Serial port read and written through the event loop, without threads
+    """
+
+    def __init__(self, port: str, baud_rate: int):
+        import serial  # Only loaded when a serial port is opened
+        self._loop = asyncio.get_running_loop()
+        self._port = serial.Serial(port, baud_rate, timeout=0)
+        self._fd = self._port.fileno()
+        self.reader = asyncio.StreamReader()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    async def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self._fd, view):]
+            except BlockingIOError:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    async def close(self) -> None:
+        self._loop.remove_reader(self._fd)
+        self._port.close()
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        if data:
+            self.reader.feed_data(data)
+        else:
+            self._loop.remove_reader(self._fd)
+            self.reader.feed_eof()
+
+
+class AsyncQDAC2:
+    """
+    asyncio counterpart of qdac2.QDAC2
+    """
+
+    def __init__(self, stream, timeout_s: float = DEFAULT_TIMEOUT_S):
+        """
+        Use open_lan() or open_usb() instead
+
+        Args:
+            timeout_s: Default time to wait for an answer
+        """
+        self.timeout_s = timeout_s
+        self._stream = stream
+        self._lock = asyncio.Lock()
+        self._unclaimed = 0  # Answers to abandoned queries still to come
+
+    @classmethod
+    async def open_lan(cls, host: str, port: int = 5025,
+                       timeout_s: float = DEFAULT_TIMEOUT_S) -> 'AsyncQDAC2':
+        """
+        Connect to a QDAC-II through TCP
+        """
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout_s)
+        return cls(_TcpStream(reader, writer), timeout_s)
+
+    @classmethod
+    async def open_usb(cls, serial_number: Optional[str] = None,
+                       timeout_s: float = DEFAULT_TIMEOUT_S) -> 'AsyncQDAC2':
+        """
+        Connect to a USB-attached QDAC-II (Linux and macOS only)
+
+        Args:
+            serial_number: Pick the QDAC-II with this USB serial number, if
+                           several are attached
+        """
+        if conn.os_platform() == 'windows':
+            raise ValueError('AsyncQDAC2 on USB is not supported on Windows')
+        device = conn.devices[0]
+        port = conn.find_serial_device(device, serial_number)
+        if not port:
+            raise ValueError('No device found')
+        return cls(_SerialStream(port, device.baud_rate), timeout_s)
+
+    async def __aenter__(self) -> 'AsyncQDAC2':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def status(self) -> str:
+        """
+        Return the error status of the instrument.
+        """
+        return await self.query('syst:err:all?')
+
+    async def command(self, cmd: str, timeout_s: Optional[float] = None) -> None:
+        """
+        Send a SCPI command to the QDAC and check for errors
+        """
+        errors = (await self._exchange([cmd], 'syst:err:all?', timeout_s))[-1]
+        if not is_ok(errors):
+            raise ValueError(f'Error: {errors} after executing {cmd}')
+
+    async def sequence(self, cmds: Sequence[str],
+                       timeout_s: Optional[float] = None) -> None:
+        """
+        Send a sequence of SCPI commands to the QDAC and check for errors once
+        """
+        errors = (await self._exchange(cmds, 'syst:err:all?', timeout_s))[-1]
+        if not is_ok(errors):
+            raise ValueError(f'Error: {errors} while executing {cmds}')
+
+    async def query(self, cmd: str, timeout_s: Optional[float] = None) -> str:
+        """
+        Send a SCPI query to the QDAC
+        """
+        return (await self._exchange([], cmd, timeout_s))[-1]
+
+    async def query_many(self, cmds: Sequence[str],
+                         timeout_s: Optional[float] = None) -> List[str]:
+        """
+        Send several SCPI queries at once and return the answers in order
+        """
+        if not cmds:
+            return []
+        return await self._exchange(cmds[:-1], cmds[-1], timeout_s,
+                                    all_queries=True)
+
+    async def clear(self) -> None:
+        """
+        Throw away answers that are waiting to be read
+        """
+        async with self._lock:
+            await self._discard_buffered()
+            self._unclaimed = 0
+
+    async def close(self) -> None:
+        await self._stream.close()
+
+    # ----------------------------------------------------------------------
+
+    async def _exchange(self, before: Sequence[str], query: str,
+                        timeout_s: Optional[float],
+                        all_queries: bool = False) -> List[str]:
+        """
+        Send messages followed by a query, and wait for the answers
+
+        Args:
+            before: Commands, or queries if all_queries, sent first
+            query: Query whose answer ends the exchange
+            timeout_s: Time to wait for the answers
+        """
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        expected = len(before) + 1 if all_queries else 1
+        async with self._lock:
+            await self._skip_unclaimed(timeout_s)
+            data = ''.join(f'{cmd}\n' for cmd in [*before, query]).encode()
+            self._unclaimed = expected
+            await self._stream.write(data)
+            try:
+                return await asyncio.wait_for(self._read_answers(expected),
+                                              timeout_s)
+            except asyncio.TimeoutError:
+                raise ValueError(f'QDAC: No answer to [{query}] within {timeout_s} s')
+
+    async def _read_answers(self, count: int) -> List[str]:
+        answers: List[str] = []
+        while len(answers) < count:
+            answers.append(await self._readline())
+            self._unclaimed -= 1
+        return answers
+
+    async def _readline(self) -> str:
+        line = await self._stream.reader.readline()
+        if not line.endswith(b'\n'):
+            raise ValueError('QDAC closed the connection')
+        return line.decode().strip()
+
+    async def _skip_unclaimed(self, timeout_s: float) -> None:
+        """
+        Throw away the answers to queries that were cancelled or timed out
+        """
+        if not self._unclaimed:
+            return
+        try:
+            await asyncio.wait_for(self._read_answers(self._unclaimed),
+                                   max(timeout_s, LATE_ANSWER_LIMIT_S))
+        except asyncio.TimeoutError:
+            # They are not coming
+            await self._discard_buffered()
+            self._unclaimed = 0
+
+    async def _discard_buffered(self) -> None:
+        """
+        Read until nothing more arrives for a moment, or the connection is
+        closed
+        """
+        while True:
+            try:
+                data = await asyncio.wait_for(self._stream.reader.read(4096),
+                                              QUIET_S)
+            except asyncio.TimeoutError:
+                return
+            if not data:
+                return
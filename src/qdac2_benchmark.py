@@ -0,0 +1,123 @@
+"""
+Benchmark of the QDAC-II round-trip time through pyvisa and through the
+transports that bypass it.
+
+Without arguments, a simulated instrument on a local TCP port answers the
+queries, so that the table shows the host-side overhead of each path:
+pyvisa-py with a TCPIP socket resource against common.transport.TcpTransport.
+
+With arguments, the queries go to a real QDAC-II, for example:
+
+$ python src/qdac2_benchmark.py --visa ASRL/dev/ttyUSB0::INSTR --serial /dev/ttyUSB0
+$ python src/qdac2_benchmark.py --visa TCPIP::192.168.8.200::5025::SOCKET --host 192.168.8.200
+
+Only one of the paths can have a serial port open at a time, so they are
+measured one after the other.
+"""
+
+import sys
+import socket
+import argparse
+import threading
+from time import perf_counter
+from typing import Callable, List, Optional, Tuple
+import common.connection as conn
+from common.transport import SerialTransport, TcpTransport, Transport, VisaTransport
+
+QUERY = '*idn?'
+ANSWER = b'QDevil,QDAC-II,0,13-1.3\n'
+
+
+def simulate_instrument() -> int:
+    """
+    Answer every line ending with '?' on a local TCP port, returning the port
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+
+    def serve_client(client: socket.socket) -> None:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pending = b''
+        while True:
+            data = client.recv(4096)
+            if not data:
+                return
+            pending += data
+            *lines, pending = pending.split(b'\n')
+            answers = [ANSWER for line in lines if line.endswith(b'?')]
+            if answers:
+                client.sendall(b''.join(answers))
+
+    def accept() -> None:
+        while True:
+            client, _ = server.accept()
+            threading.Thread(target=serve_client, args=(client,),
+                             daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def measure(query: Callable[[], str], count: int) -> Tuple[float, float]:
+    """
+    Median and best round-trip time in microseconds
+    """
+    query()  # Warm up
+    times: List[float] = []
+    for _ in range(count):
+        start = perf_counter()
+        query()
+        times.append((perf_counter() - start) * 1e6)
+    times.sort()
+    return times[len(times) // 2], times[0]
+
+
+def open_visa(address: str) -> Transport:
+    resource = conn.resource_manager('@py').open_resource(address)
+    return VisaTransport(resource, 'QDAC', timeout_s=1, delay_s=0,
+                         baud_rate=921600 if address.startswith('ASRL') else None)
+
+
+def report(label: str, opener: Callable[[], Transport], count: int) -> None:
+    transport = opener()
+    try:
+        median, best = measure(lambda: transport.query(QUERY), count)
+    finally:
+        transport.close()
+    print(f'{label:40} {median:9.1f} us {best:9.1f} us')
+
+
+def run(visa_address: Optional[str], serial_port: Optional[str],
+        host: Optional[str], count: int) -> None:
+    print(f'{"path":40} {"median":>12} {"best":>12}')
+    if not (visa_address or serial_port or host):
+        port = simulate_instrument()
+        visa_address = f'TCPIP::127.0.0.1::{port}::SOCKET'
+        report('pyvisa (simulated)', lambda: open_visa(visa_address), count)
+        report('raw TCP (simulated)',
+               lambda: TcpTransport('127.0.0.1', port), count)
+        return
+    if visa_address:
+        report(f'pyvisa {visa_address}', lambda: open_visa(visa_address), count)
+    if serial_port:
+        report(f'raw serial {serial_port}',
+               lambda: SerialTransport(serial_port, 921600), count)
+    if host:
+        report(f'raw TCP {host}', lambda: TcpTransport(host), count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare QDAC-II round trips through pyvisa and raw transports')
+    parser.add_argument('--visa', help='VISA address of a QDAC-II')
+    parser.add_argument('--serial', help='Serial port of a QDAC-II')
+    parser.add_argument('--host', help='IP address of a QDAC-II')
+    parser.add_argument('--count', type=int, default=2000, help='Queries per path')
+    args = parser.parse_args()
+    try:
+        run(args.visa, args.serial, args.host, args.count)
+        sys.exit(0)
+    except Exception as error:
+        print(f'Error: {error}')
+        sys.exit(1)
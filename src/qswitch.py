@@ -1,10 +1,13 @@
-import pyvisa as visa
-from typing import Sequence, List, Tuple
+from __future__ import annotations
+from typing import Sequence, List, Tuple, TYPE_CHECKING
 from dataclasses import dataclass
-import socket
 from datetime import datetime
-from time import sleep as sleep_s
-import re
+from contextlib import contextmanager
+from common.transport import Transport, UdpTransport, VisaTransport
+from common.channel_list import channel_list_to_state
+
+if TYPE_CHECKING:
+    import pyvisa as visa  # Only needed for VISA resources, which the caller opens
 
 def is_ok(message: str) -> bool:
     return message == '0,"No error"'
@@ -19,6 +22,8 @@ class UdpConfig:
 
 UDP_QUERY_MAX_ATTEMPTS = 5
 UDP_WRITE_MAX_ATTEMPTS = 3
+# Commands sent without *opc? before synchronising anyway (VISA)
+DEFERRED_SYNC_LIMIT = 16
 
 class QSwitch:
     """
@@ -38,33 +43,39 @@ class QSwitch:
     device = qswitch.UdpConfig(ip="192.168.8.100")
     switch = qswitch.QSwitch(device)
     print(switch.status())
+
+    Any common.transport.Transport can also be given, for example a
+    SerialTransport.
+
+    On VISA, command() normally waits for each command with a *opc? query.
+    With defer_sync=True, or inside batch(), a single *opc? is sent before
+    the next query instead.
     """
 
-    def __init__(self, resource: visa.Resource | UdpConfig):
+    def __init__(self, resource: visa.Resource | UdpConfig | Transport,
+                 defer_sync: bool = False):
         self.verbose = False 
         self.log = print
+        self._sync_deferred = defer_sync
+        self._unsynced: List[str] = []
         
         if isinstance(resource, UdpConfig):
             # UDP Mode
-            self._udp_mode = True
-            self._udp_config = resource
-            self.verbose = self._udp_config.verbose
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self._sock.settimeout(resource.timeout_ms / 1000)  # Convert ms to seconds
-            if self.verbose: 
-                self.log(f"{datetime.now()} Connected UDP: {resource.ip}:{resource.port}, timeout:{resource.timeout_ms}ms")
+            self.verbose = resource.verbose
+            self.transport: Transport = UdpTransport(
+                resource.ip, resource.port, resource.timeout_ms / 1000,
+                resource.delay_s, self._log_verbose,
+                name=f'QSwitch {resource.ip} (UDP)')
+            self._log_verbose(f"Connected UDP: {resource.ip}:{resource.port}, timeout:{resource.timeout_ms}ms")
+        elif isinstance(resource, Transport):
+            self.transport = resource
         else:
             # VISA Mode
-            self._udp_mode = False
-            self._switch = resource
-            self._switch.write_termination = '\n'
-            self._switch.read_termination = '\n'
-            self._switch.timeout = 5000
-            self._switch.query_delay = 0.01
-            self._switch.baud_rate = 9600
-            if self.verbose:
-                self.log(f"{datetime.now()} Connected VISA: timeout:{self._switch.timeout }ms, query_delay:{self._switch.query_delay}s")
-
+            self.transport = VisaTransport(
+                resource, 'QSwitch VISA', timeout_s=5, delay_s=0.01,
+                baud_rate=9600, log=self._log_verbose, clear_serial=False)
+            self._log_verbose(f"Connected VISA: timeout:{resource.timeout}ms, query_delay:{resource.query_delay}s")
+        self._udp_mode = isinstance(self.transport, UdpTransport)
         self._record_commands = False
 
     def status(self) -> str:
@@ -89,86 +100,98 @@ class QSwitch:
         Send a SCPI command to the QSwitch, and check when ready for a new command by sending a query
         UDP connection: For relay open/close and *rst commands, only, it is checked the command was well received
         """
-        if self._udp_mode:
-            cmd_lower = cmd.lower()
-            is_open_close_cmd = cmd_lower.find("clos ",0,12) != -1 or (cmd_lower.find("close ",0,12) != -1) or (cmd_lower.find("open ",0,12)  != -1) 
-            is_rst_cmd = (cmd_lower == "*rst")
-            counter = 0
-            while True: 
-                try:
-                    self._sock.sendto(f"{cmd}\n".encode(), (self._udp_config.ip, self._udp_config.port))
-                except Exception as e:
-                    raise ValueError(f'QSwitch {self._udp_config.ip} (UDP): Write Error [{cmd}]: {repr(e)}')
-                # Check that relay command was well received
-                if (is_open_close_cmd or is_rst_cmd): 
-                    if (counter > 0) and self.verbose: self.log(f'{datetime.now()} UDP write repeat {counter} [{cmd}]')
-                    if is_open_close_cmd:
-                        self.query('*opc?')  
-                        splitcmd = cmd.split(" ")
-                        reply = self.query(splitcmd[0]+"? "+splitcmd[1] if len(splitcmd)==2 else "")
-                        if (len(reply) > 0) and (reply.find("0") == -1):  
-                            return
-                    elif is_rst_cmd:
-                        self.query('*opc?')    
-                        reply = self.query("clos:stat?")
-                        if (reply == "(@1!0:24!0)"):
-                            return
-                    counter += 1
-                    if self.verbose: 
-                        self.log(f"{datetime.now()} UDP: {counter} failed check of [{cmd_lower}], result: {reply}")
-                    if (counter >= UDP_WRITE_MAX_ATTEMPTS):
-                        raise ValueError(f'QSwitch {self._udp_config.ip} (UDP): Command check failure [{cmd_lower}] after {UDP_WRITE_MAX_ATTEMPTS} attempts')
-                else:
-                    self.query('*opc?')
-                    return
-        else: # VISA
-            try:
-                self._switch.write(cmd)
-                self.query('*opc?')
-            except Exception as e:
-                if self.verbose: self.log(f'{datetime.now()} VISA error: {repr(e)}')
-                raise ValueError(f"QSwitch VISA error: {repr(e)}")
+        if not self._udp_mode:
+            self._write(cmd)
+            self._unsynced.append(cmd)
+            if not self._sync_deferred or len(self._unsynced) >= DEFERRED_SYNC_LIMIT:
+                self.sync()
             return
+        counter = 0
+        while True:
+            self._write(cmd)
+            if counter > 0:
+                self._log_verbose(f'UDP write repeat {counter} [{cmd}]')
+            self.query('*opc?')
+            if self._udp_check(cmd):
+                return
+            counter += 1
+            self.transport.pacer.on_loss()
+            self._log_verbose(f"UDP: {counter} failed check of [{cmd}]")
+            if (counter >= UDP_WRITE_MAX_ATTEMPTS):
+                raise ValueError(f'{self.transport.name}: Command check failure [{cmd.lower()}] after {UDP_WRITE_MAX_ATTEMPTS} attempts')
 
+    def command_many(self, cmds: Sequence[str]):
+        """
+        Send several SCPI commands to the QSwitch, and check when ready for a new command by sending a query
+        UDP connection: The commands are packed into as few datagrams as possible.  Relay open/close and *rst
+        commands are then checked, and those not well received are sent again
+        """
+        if not self._udp_mode:
+            with self.batch():
+                for cmd in cmds:
+                    self.command(cmd)
+            return
+        pending = list(cmds)
+        counter = 0
+        while True:
+            if self._record_commands:
+                self._scpi_sent.extend(pending)
+            self.transport.write_many(pending)
+            self.query('*opc?')
+            failed = [cmd for cmd in pending if not self._udp_check(cmd)]
+            if not failed:
+                return
+            counter += 1
+            self.transport.pacer.on_loss()
+            self._log_verbose(f"UDP: {counter} failed check of {failed}")
+            if (counter >= UDP_WRITE_MAX_ATTEMPTS):
+                raise ValueError(f'{self.transport.name}: Command check failure {failed} after {UDP_WRITE_MAX_ATTEMPTS} attempts')
+            pending = failed
 
     def query(self, cmd: str) -> str:
         """
         Send a SCPI query to the QSwitch
         UDP: Repeat query until a reply is received
+        VISA: Commands whose *opc? was deferred are synchronised first
         """
+        self.sync()
         if self._record_commands:
             self._scpi_sent.append(cmd)
+        attempts = UDP_QUERY_MAX_ATTEMPTS if self._udp_mode else 1
+        return self.transport.query(cmd, attempts)
+
+    @contextmanager
+    def batch(self):
+        """
+        Send the commands in the block with a single *opc? at the end, or
+        before the first query in it (VISA only)
+        """
+        deferred = self._sync_deferred
+        self._sync_deferred = True
+        try:
+            yield self
+        finally:
+            self._sync_deferred = deferred
+        if deferred:
+            return  # An outer batch, or defer_sync, synchronises later
+        self.sync()
 
-        if self._udp_mode: # UDP (ethernet)
-            counter = 0
-            time_before_next = 0.1
-            while True:
-                try:
-                    self.clear()
-                    self._sock.sendto(f"{cmd}\n".encode(), (self._udp_config.ip, self._udp_config.port))
-                    sleep_s(self._udp_config.delay_s)
-                    # Wait for response
-                    time_before = datetime.now()
-                    data, _ = self._sock.recvfrom(1024)
-                    answer = data.decode().strip()
-                    if (counter > 0) and self.verbose: self.log(f'{datetime.now()} UDP query repeat {counter} [{cmd}]')
-                    return answer
-                except Exception as error:
-                    counter += 1
-                    if self.verbose:
-                        self.log(f'{time_before} - {datetime.now().time()} UDP query error {counter} [{cmd}]: {repr(error)}')
-                    if (counter >= UDP_QUERY_MAX_ATTEMPTS):
-                        raise ValueError(f'QSwitch {self._udp_config.ip} (UDP): Query timeout [{cmd}] after {UDP_QUERY_MAX_ATTEMPTS} attempts')
-                    sleep_s(time_before_next)
-                    time_before_next += 0.5   # Next time we wait even longer so that we do not quickly run out of retries
-        else: # VISA 
-            try:
-                answer = self._switch.query(cmd)
-            except visa.errors.VisaIOError as error:
-                if self.verbose:
-                    self.log(f'{datetime.now()} QSwitch failed VISA query [{cmd}] (1st try): {repr(error)}')
-                raise ValueError(f'QSwitch failed VISA query [{cmd}] (1st try): {repr(error)}')
-            return answer
+    def sync(self) -> None:
+        """
+        Wait until the QSwitch has carried out the commands sent so far
+
+        Raises ValueError naming the commands if it does not answer.
+        """
+        if not self._unsynced:
+            return
+        pending = self._unsynced
+        self._unsynced = []
+        if self._record_commands:
+            self._scpi_sent.append('*opc?')
+        try:
+            self.transport.query('*opc?')
+        except ValueError as error:
+            raise ValueError(f'{self.transport.name}: No answer after {pending}: {error}')
 
     def clear(self) -> None:
         """
@@ -176,58 +199,42 @@ class QSwitch:
         or flush the input buffer for a UDP connection (FW >= 1.9).
         In USB-serial mode, do nothing. 
         """
-        if self._udp_mode:
-            self._sock.settimeout( 0.0001 )
-            while True:
-                try:
-                    data,_ = self._sock.recvfrom(1024)
-                except:
-                    break
-            self._sock.settimeout( self._udp_config.timeout_ms / 1000)
-        else: 
-            if (self._switch.resource_class == "SOCKET"):
-                self._switch.clear()
-            
+        self.transport.clear()
 
     def close(self):
-        if self._udp_mode:
-            self._sock.close()
-        else:
-            self._switch.close()
+        try:
+            self.sync()
+        finally:
+            self.transport.close()
 
 
     def _write(self, cmd: str) -> None:
         if self._record_commands:
             self._scpi_sent.append(cmd)
+        self.transport.write(cmd)
 
-        if self._udp_mode:
-            try:
-                self._sock.sendto(f"{cmd}\n".encode(), (self._udp_config.ip, self._udp_config.port))
-            except Exception as e:
-                self.log(f'{datetime.now()} UDP write Error: {repr(e)}')  # raise?
-                raise ValueError(f'QSwitch {self._udp_config.ip} (UDP): Write Error [{cmd}]: {repr(e)}')
-        else:
-            self._switch.write(cmd)
+    def _udp_check(self, cmd: str) -> bool:
+        """
+        Check that a relay open/close or *rst command was well received.
+        Other commands cannot be checked and are taken as received.
+        """
+        cmd_lower = cmd.lower()
+        if cmd_lower.find("clos ",0,12) != -1 or (cmd_lower.find("close ",0,12) != -1) or (cmd_lower.find("open ",0,12)  != -1):
+            splitcmd = cmd.split(" ")
+            if len(splitcmd) != 2:
+                return True
+            reply = self.query(splitcmd[0]+"? "+splitcmd[1])
+            return (len(reply) > 0) and (reply.find("0") == -1)
+        if cmd_lower == "*rst":
+            return self.query("clos:stat?") == "(@1!0:24!0)"
+        return True
 
     def _read(self):
-        counter = 0
-        time_before_next = 0.1
-        while True:
-            try:
-                # Wait for response
-                data, _ = self._sock.recvfrom(1024)
-                answer = data.decode().strip()
-                if (counter > 1) and self._verbose: 
-                    self.log(f'{datetime.now()} UDP read repeat {counter}')
-                return answer
-            except Exception as error:
-                counter += 1
-                if self.verbose:
-                    self.log(f'{datetime.now()} UDP read error {counter} : {repr(error)}')
-                if (counter >= UDP_QUERY_MAX_ATTEMPTS):
-                    raise ValueError(f'QSwitch {self._udp_config.ip} (UDP): Read timeout after {UDP_QUERY_MAX_ATTEMPTS} attempts')
-                sleep_s(time_before_next)
-                time_before_next += 0.5
+        return self.transport.read(UDP_QUERY_MAX_ATTEMPTS)
+
+    def _log_verbose(self, message: str) -> None:
+        if self.verbose:
+            self.log(f'{datetime.now()} {message}')
 
     # ----------------------------------------------------------------------
     # Debugging and testing
@@ -255,40 +262,3 @@ class QSwitch:
 # ----------------------------------------------------------------------
 # Helpers
 State = Sequence[Tuple[int, int]]
-
-
-def _line_tap_split(input: str) -> Tuple[int, int]:
-    pair = input.split('!')
-    if len(pair) != 2:
-        raise ValueError(f'Expected channel pair, got {input}')
-    if not pair[0].isdecimal():
-        raise ValueError(f'Expected channel, got {pair[0]}')
-    if not pair[1].isdecimal():
-        raise ValueError(f'Expected channel, got {pair[1]}')
-    return int(pair[0]), int(pair[1])
-
-
-def channel_list_to_state( channel_list: str) -> State:
-    outer = re.match(r'\(@([0-9,:! ]*)\)', channel_list)
-    if not outer:
-        raise ValueError(f'Expected channel list, got {channel_list}')
-    result: List[Tuple[int, int]] = []
-    sequences = outer[1].split(',')
-    if sequences == ['']:
-        return result
-    for sequence in sequences:
-        limits = sequence.split(':')
-        if limits == ['']:
-            raise ValueError(f'Expected channel sequence, got {limits}')
-        line_start, tap_start = _line_tap_split(limits[0])
-        line_stop, tap_stop = line_start, tap_start
-        if len(limits) == 2:
-            line_stop, tap_stop = _line_tap_split(limits[1])
-        if len(limits) > 2:
-            raise ValueError(f'Expected channel sequence, got {limits}')
-        if tap_start != tap_stop:
-            raise ValueError(
-                f'Expected same breakout in sequence, got {limits}')
-        for line in range(line_start, line_stop+1):
-            result.append((line, tap_start))
-    return result
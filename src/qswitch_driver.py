@@ -1,14 +1,19 @@
-import pyvisa as visa
-from typing import Tuple, Sequence, List, Dict, Set, Union, Optional
+from typing import Tuple, Sequence, List, Dict, Union, Optional
 from dataclasses import dataclass
 import socket
 from datetime import datetime
 from time import sleep as sleep_s
-import re
 import itertools
-from packaging.version import parse
-import serial.tools.list_ports as list_ports
-from platform import system as platform_system
+import json
+import re
+import common.connection as conn
+from common.breaker import breaker_for, HALF_OPEN
+from common.deadline import Deadline, DeadlineExceeded
+from common.transport import Transport, UdpTransport, VisaTransport
+from common import channel_list as codec
+from common.channel_list import ALL_RELAYS
+from common.journal import RelayJournal
+from contextlib import contextmanager
 
 # version 1.1.4
 
@@ -39,6 +44,19 @@ import qswitch_driver
 qswitch = qswitch_driver.QSwitch( qswitch.VISAconfig(visaAddress="TCPIP::192.168.8.100::5025::SOCKET"))
 """
 
+# Time limits for polling readiness after reset and restart, when the caller
+# does not give a deadline
+RESET_READY_LIMIT_S = 5
+RESTART_READY_LIMIT_S = 15
+RESTART_SETTLE_S = 0.5
+READY_POLL_S = 0.2
+# Time a VISA QSwitch gets to answer *opc? after a failure, before the
+# failure counts towards opening the circuit breaker
+FAILURE_CHECK_LIMIT_S = 0.5
+# Commands written without *opc? before synchronising anyway, so that the
+# input buffer of the QSwitch cannot overflow
+DEFERRED_SYNC_LIMIT = 16
+
 @dataclass
 class UDPConfig:
     ip: str                         
@@ -52,6 +70,9 @@ class VISAConfig:
     visaAddress: str                         
     timeout_ms: float = 5000
     delay_s: float = 0.01
+    # Only synchronise with *opc? before the next query instead of after
+    # every command, see QSwitch.batch()
+    defer_sync: bool = False
 
 
 class QSwitch:
@@ -67,34 +88,48 @@ class QSwitch:
         self.log = print
         self.verbose = False
         self._config = config
+        self._deadline = Deadline()
+        self._journal: Optional[RelayJournal] = None
+        self._sync_deferred = False
+        self._unsynced: List[str] = []
 
         if isinstance(config, UDPConfig):
             # Setup UDP configuration for ethernet port
             self._udp_mode = True
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self._sock.settimeout(self._config.timeout_ms / 1000)  # Convert ms to seconds
-            if self.verbose:
-                self.log(f"{datetime.now()} Connected UDP: {self._config.ip}:5025, timeout:{self._config.timeout_ms}ms")
+            self.transport: Transport = UdpTransport(
+                self._config.ip, 5025, self._config.timeout_ms / 1000,
+                self._config.delay_s, self._log_verbose,
+                name=f'QSwitch {self._config.ip} (UDP)')
+            self._log_verbose(f"Connected UDP: {self._config.ip}:5025, timeout:{self._config.timeout_ms}ms")
+            self._breaker = breaker_for(self._config.ip)
+            self._pacer = self.transport.pacer
+            self._breaker.set_probe(lambda: _udp_probe(self._config.ip))
         elif isinstance(config, VISAConfig):
             # Setup VISA configuration for USB or TCP/IP
             self._udp_mode = False
-            self._switch = visa.ResourceManager('@py').open_resource(self._config.visaAddress)
-            self._switch.write_termination = '\n'
-            self._switch.read_termination = '\n'
-            self._switch.timeout = self._config.timeout_ms
-            self._switch.query_delay = self._config.delay_s
-            self._switch.baud_rate = 9600
-            if self.verbose:
-                self.log(f"{datetime.now()} Connected VISA: timeout: {self._switch.timeout} ms, query_delay: {self._switch.query_delay} s")
+            self.transport = VisaTransport(
+                conn.visa_pool.acquire(self._config.visaAddress),
+                'QSwitch VISA', self._config.timeout_ms / 1000,
+                self._config.delay_s, baud_rate=9600, log=self._log_verbose,
+                clear_serial=False)
+            self._log_verbose(f"Connected VISA: timeout: {self._config.timeout_ms} ms, query_delay: {self._config.delay_s} s")
+            self._breaker = breaker_for(self._config.visaAddress)
+            self._sync_deferred = self._config.defer_sync
         
-        self._set_default_names()
-        self._set_up_debug_settings()
+        try:
+            self._set_default_names()
+            self._set_default_presets()
+            self._set_up_debug_settings()
 
-        self._state = self.query('stat?')
+            self._state = self.query('stat?')
 
-        self._check_for_wrong_model()
-        self._check_for_incompatible_firmware()
-        self._state_force_update()
+            self._check_for_wrong_model()
+            self._check_for_incompatible_firmware()
+            self._state_force_update()
+        except Exception:
+            # Hand the socket or the pooled VISA session back
+            self.transport.close()
+            raise
 
     OneOrMore = Union[str, Sequence[str]]
     State = Sequence[Tuple[int, int]]
@@ -155,142 +190,199 @@ class QSwitch:
         else:
             raise ValueError(f'Unknown autosave setting {val}')
     
-    def reset(self) -> None:
+    def reset(self, deadline_s: Optional[float] = None) -> None:
         """"
         Reset the QSwitch to power-on conditions and then update the known state
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self._write('*rst')
-        sleep_s(0.6)
-        self._state_force_update()
+        with self._within(deadline_s):
+            self._write('*rst')
+            self._wait_until_ready(RESET_READY_LIMIT_S)
+            self._state_force_update()
 
-    def restart(self) -> None:
+    def restart(self, deadline_s: Optional[float] = None) -> None:
         """"
         Restart the QSwitch firmware, including the LAN interface, resets to power-on conditions, and then update the known state
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self._write('rest')
-        sleep_s(5)
-        self._state_force_update()
+        with self._within(deadline_s):
+            self._write('rest')
+            # Give the firmware time to go down before polling for it to come back
+            sleep_s(self._deadline.cap(RESTART_SETTLE_S))
+            self._wait_until_ready(RESTART_READY_LIMIT_S)
+            self._state_force_update()
+
+    def health(self) -> str:
+        """
+        State of the connection health tracking (circuit breaker)
+
+        Returns:
+            str: 'closed' when the QSwitch answers, 'open' when it does not
+                 answer and calls fail immediately, or 'half-open' when the
+                 next call will find out if it answers again
+        """
+        return self._breaker.state
 
     # -----------------------------------------------------------------------
     # Direct manipulation of the relays
     # -----------------------------------------------------------------------
 
-    def close_relays(self, relays: State) -> None:
+    def close_relays(self, relays: State, deadline_s: Optional[float] = None) -> None:
         """
         Close a set of relays
 
         Args:
             relays: sets of channel and breakout numbers
+            deadline_s: Time limit in seconds for the whole operation
         """
-        currently = self._channel_list_to_state(self._state)
-        union = list(itertools.chain(currently, relays))
-        self._effectuate(union)
+        with self._within(deadline_s):
+            currently = self._channel_list_to_state(self._state)
+            union = list(itertools.chain(currently, relays))
+            self._effectuate(union)
 
-    def close_relay(self, line: int, tap: int) -> None:
+    def close_relay(self, line: int, tap: int, deadline_s: Optional[float] = None) -> None:
         """
         Close a single relay
 
         Args:
             line: Fischer channel number
             tap: BNC breakout number
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self.close_relays([(line, tap)])
+        self.close_relays([(line, tap)], deadline_s)
 
-    def open_relays(self, relays: State) -> None:
+    def open_relays(self, relays: State, deadline_s: Optional[float] = None) -> None:
         """
         Open a set of relays
 
         Args:
             relays: sets of channel and breakout numbers
+            deadline_s: Time limit in seconds for the whole operation
         """
-        currently = frozenset(self._channel_list_to_state(self._state))
-        subtraction = frozenset(relays)
-        self._effectuate(list(currently - subtraction))
+        with self._within(deadline_s):
+            currently = frozenset(self._channel_list_to_state(self._state))
+            subtraction = frozenset(relays)
+            self._effectuate(list(currently - subtraction))
 
-    def open_relay(self, line: int, tap: int) -> None:
+    def open_relay(self, line: int, tap: int, deadline_s: Optional[float] = None) -> None:
         """
         Open a single relay
 
         Args:
             line: Fischer channel number
             tap: BNC breakout number
+            deadline_s: Time limit in seconds for the whole operation
+        """
+        self.open_relays([(line, tap)], deadline_s)
+
+    def change_relays(self, close: State = (), open: State = (), deadline_s: Optional[float] = None) -> None:
+        """
+        Close a set of relays and open another set, in one go
+
+        Relays are closed before others are opened.
+
+        Args:
+            close: sets of channel and breakout numbers to close
+            open: sets of channel and breakout numbers to open
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self.open_relays([(line, tap)])
+        with self._within(deadline_s):
+            currently = frozenset(self._channel_list_to_state(self._state))
+            target = (currently | frozenset(close)) - frozenset(open)
+            self._effectuate(list(target))
 
     #-----------------------------------------------------------------------
     # Manipulation functions - close/open relays in a fixed order
     # ----------------------------------------------------------------------
 
-    def ground_and_release(self, lines: OneOrMore) -> None:
+    def ground_and_release(self, lines: OneOrMore, deadline_s: Optional[float] = None) -> None:
         """
         Soft ground one or more channels and then disconnect them from the input and breakout connectors.
         
         Args:
             lines: One or more channels to ground
-        """
-        connections: List[Tuple[int, int]] = []
-        if isinstance(lines, str):
-            line = self._to_line(lines)
-            self.close_relay(line, 0)
-            taps = range(1, 10)
-            connections = list(itertools.zip_longest([], taps, fillvalue=line))
-            self.open_relays(connections)
-        else:
-            numbers = map(self._to_line, lines)
-            grounds = list(itertools.zip_longest(numbers, [], fillvalue=0))
-            self.close_relays(grounds)
-            for tap in range(1, 10):
-                connections += itertools.zip_longest(
-                                    map(self._to_line, lines), [], fillvalue=tap)
-            self.open_relays(connections)
+            deadline_s: Time limit in seconds for the whole operation
+        """
+        with self._within(deadline_s):
+            connections: List[Tuple[int, int]] = []
+            if isinstance(lines, str):
+                line = self._to_line(lines)
+                self.close_relay(line, 0)
+                taps = range(1, 10)
+                connections = list(itertools.zip_longest([], taps, fillvalue=line))
+                self.open_relays(connections)
+            else:
+                numbers = map(self._to_line, lines)
+                grounds = list(itertools.zip_longest(numbers, [], fillvalue=0))
+                self.close_relays(grounds)
+                for tap in range(1, 10):
+                    connections += itertools.zip_longest(
+                                        map(self._to_line, lines), [], fillvalue=tap)
+                self.open_relays(connections)
 
-    def ground_and_release_all(self) -> None:
+    def ground_and_release_all(self, deadline_s: Optional[float] = None) -> None:
         """
         Soft ground all channels and then disconnect them from the input and breakout connectors.
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
         """
-        grounds = list(itertools.zip_longest(range(1,25), [], fillvalue=0))
-        self.close_relays(grounds)
-        for tap in range(1, 10):
-            connections = itertools.zip_longest(range(1,25), [], fillvalue=tap)
-            self.open_relays(connections)
+        with self._within(deadline_s):
+            grounds = list(itertools.zip_longest(range(1,25), [], fillvalue=0))
+            self.close_relays(grounds)
+            for tap in range(1, 10):
+                connections = itertools.zip_longest(range(1,25), [], fillvalue=tap)
+                self.open_relays(connections)
 
-    def connect_and_unground(self, lines: OneOrMore) -> None:
+    def connect_and_unground(self, lines: OneOrMore, deadline_s: Optional[float] = None) -> None:
         """
         Connect one or more channels to the input Fischer connector and then disconnect them from the soft ground.
         
         Args:
             lines: One or more channels to connect to the input Fischer connector
+            deadline_s: Time limit in seconds for the whole operation
         """
-        if isinstance(lines, str):
-            self.close_relay(self._to_line(lines), 9)
-            self.open_relay(self._to_line(lines), 0)
-        else:
-            numbers = map(self._to_line, lines)
-            pairs = list(itertools.zip_longest(numbers, [], fillvalue=9))
-            self.close_relays(pairs)
-            numbers = map(self._to_line, lines)
-            connections = list(itertools.zip_longest(numbers, [], fillvalue=0))
-            self.open_relays(connections)
+        with self._within(deadline_s):
+            if isinstance(lines, str):
+                self.close_relay(self._to_line(lines), 9)
+                self.open_relay(self._to_line(lines), 0)
+            else:
+                numbers = map(self._to_line, lines)
+                pairs = list(itertools.zip_longest(numbers, [], fillvalue=9))
+                self.close_relays(pairs)
+                numbers = map(self._to_line, lines)
+                connections = list(itertools.zip_longest(numbers, [], fillvalue=0))
+                self.open_relays(connections)
 
-    def connect_and_unground_all(self) -> None:
+    def connect_and_unground_all(self, deadline_s: Optional[float] = None) -> None:
         """
         Connect all channels to the input Fischer connector and then disconnect them from the soft ground.
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
         """
-        connects = list(itertools.zip_longest(range(1,25), [], fillvalue=9))
-        self.close_relays(connects)
-        ungrounds = list(itertools.zip_longest(range(1,25), [], fillvalue=0))
-        self.open_relays(ungrounds)
+        with self._within(deadline_s):
+            connects = list(itertools.zip_longest(range(1,25), [], fillvalue=9))
+            self.close_relays(connects)
+            ungrounds = list(itertools.zip_longest(range(1,25), [], fillvalue=0))
+            self.open_relays(ungrounds)
 
-    def breakout(self, line: str, tap: str) -> None:
+    def breakout(self, line: str, tap: str, deadline_s: Optional[float] = None) -> None:
         """
         Connect a channel to a BNC breakout connector and then disconnect them from the soft ground.
         
         Args:
             line (str): Channel to connect to the BNC breakout connector
             tap (str): BNC breakout connector
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self.close_relay(self._to_line(line), self._to_tap(tap))
-        self.open_relay(self._to_line(line), 0)
+        with self._within(deadline_s):
+            self.close_relay(self._to_line(line), self._to_tap(tap))
+            self.open_relay(self._to_line(line), 0)
 
     #-----------------------------------------------------------------------
     # Naming
@@ -320,35 +412,195 @@ class QSwitch:
         taps = range(1, 10)
         self._line_names = dict(zip(map(str, lines), lines))
         self._tap_names = dict(zip(map(str, taps), taps))
+
+    #-----------------------------------------------------------------------
+    # Presets
+    # ----------------------------------------------------------------------
+
+    def store_preset(self, name: str, relays: Optional[State | str] = None) -> None:
+        """
+        Store a full relay configuration under a name
+
+        Args:
+            name (str): Name of the preset
+            relays: Closed relays, as State or channel list notation.
+                    Default is the current known state.
+        """
+        if relays is None:
+            relays = self._state
+        if isinstance(relays, str):
+            relays = self._channel_list_to_state(relays)
+        self._add_preset(name, frozenset(relays))
+
+    def apply_preset(self, name: str, deadline_s: Optional[float] = None) -> None:
+        """
+        Change the relays to a stored configuration, in a single diff from
+        the current state
+
+        Args:
+            name (str): Name of the preset
+            deadline_s: Time limit in seconds for the whole operation
+        """
+        try:
+            preset = self._presets[name]
+        except KeyError:
+            raise ValueError(f'Unknown preset "{name}"')
+        with self._within(deadline_s):
+            self._effectuate(list(preset))
+
+    def presets(self) -> Dict[str, str]:
+        """
+        Give the stored presets in the channel list notation
+        """
+        return {name: self._state_to_compressed_list(list(relays))
+                for name, relays in self._presets.items()}
+
+    def recognise_preset(self, refresh: bool = True) -> Optional[str]:
+        """
+        Give the name of the preset matching the state of the QSwitch, if any
+
+        Args:
+            refresh: Ask the QSwitch for its state instead of using the known state
+        """
+        if refresh:
+            self._state_force_update()
+        current = frozenset(self._channel_list_to_state(self._state))
+        return self._preset_index.get(current)
+
+    def save_presets(self, path: str) -> None:
+        """
+        Write the stored presets to a JSON file
+
+        Args:
+            path (str): File name
+        """
+        with open(path, 'w') as file:
+            json.dump(self.presets(), file, indent=2)
+
+    def load_presets(self, path: str) -> None:
+        """
+        Add the presets from a JSON file written by save_presets()
+
+        Args:
+            path (str): File name
+        """
+        with open(path) as file:
+            presets = json.load(file)
+        for name, relays in presets.items():
+            self.store_preset(name, relays)
+
+    def _set_default_presets(self) -> None:
+        """
+        Set the presets that every QSwitch has
+        """
+        self._presets: Dict[str, frozenset] = dict()
+        self._preset_index: Dict[frozenset, str] = dict()
+        self._add_preset('all grounded', frozenset((line, 0) for line in range(1, 25)))
+        self._add_preset('all connected', frozenset((line, 9) for line in range(1, 25)))
+
+    def _add_preset(self, name: str, relays: frozenset) -> None:
+        """
+        Store a preset and keep the reverse index up to date
+        Args:
+            name (str): Name of the preset
+            relays (frozenset): Closed relays
+        """
+        previous = self._presets.get(name)
+        self._presets[name] = relays
+        if previous is not None and self._preset_index.get(previous) == name:
+            del self._preset_index[previous]
+            for other, other_relays in self._presets.items():
+                if other_relays == previous:
+                    self._preset_index[previous] = other
+                    break
+        self._preset_index.setdefault(relays, name)
     
+    #-----------------------------------------------------------------------
+    # Journal
+    # ----------------------------------------------------------------------
+
+    def start_journal(self, path: str) -> None:
+        """
+        Append every relay change to a journal file
+
+        The file can be read with common.journal, for example to find the
+        state at a given time or how many times each relay has been closed.
+
+        Args:
+            path (str): File name, appended to if it exists
+        """
+        self.stop_journal()
+        self._state_force_update()
+        journal = RelayJournal(path)
+        journal.record_snapshot(self._channel_list_to_state(self._state))
+        self._journal = journal
+
+    def stop_journal(self) -> None:
+        """
+        Stop appending relay changes to the journal file
+        """
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
     #-----------------------------------------------------------------------
     # Overview functions
     # ----------------------------------------------------------------------
 
-    def overview(self) -> dict[str, List[str]]:
+    def overview(self, deadline_s: Optional[float] = None) -> dict[str, List[str]]:
         """
         Give an overview list of all channels with their connections
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self._state_force_update()
-        result = self._channel_list_to_overview(self._state)
-        return result
+        with self._within(deadline_s):
+            self._state_force_update()
+            result = self._channel_list_to_overview(self._state)
+            return result
 
-    def state(self) -> str:
+    def state(self, deadline_s: Optional[float] = None) -> str:
         """
         Gives the state of the QSwitch in the channel list notation
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
         """
-        self._state_force_update()
-        result = self._state_to_compressed_list(self._channel_list_to_state(self._state))
-        return result
+        with self._within(deadline_s):
+            self._state_force_update()
+            result = self._state_to_compressed_list(self._channel_list_to_state(self._state))
+            return result
 
-    def closed_relays(self) -> str:
+    def closed_relays(self, deadline_s: Optional[float] = None, refresh: bool = True) -> str:
         """
         Gives the state of the QSwitch in the State notation (Python array)
-        """
-        self._state_force_update()
-        result = self._channel_list_to_state(self._state)
-        return result
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
+            refresh: Ask the QSwitch for its state instead of using the known state
+        """
+        if not refresh:
+            return self._channel_list_to_state(self._state)
+        with self._within(deadline_s):
+            self._state_force_update()
+            result = self._channel_list_to_state(self._state)
+            return result
     
+    def relay_matrix(self, refresh: bool = True, deadline_s: Optional[float] = None):
+        """
+        Gives the state of the QSwitch as a 24x10 boolean NumPy matrix, where
+        element [line - 1, tap] is True for a closed relay (requires NumPy)
+
+        Args:
+            refresh: Ask the QSwitch for its state instead of using the known state
+            deadline_s: Time limit in seconds for the whole operation
+        """
+        from common.relay_matrix import state_to_matrix
+        if refresh:
+            with self._within(deadline_s):
+                self._state_force_update()
+        return state_to_matrix(self._channel_list_to_state(self._state))
+
     def expand_channel_list(self, channel_list: str) -> str:
         """
         Expand the channel list notation to note all individualy closed relays
@@ -369,91 +621,184 @@ class QSwitch:
     # Instrument communication
     # -----------------------------------------------------------------------
   
-    def write(self, cmd: str):
+    def write(self, cmd: str, deadline_s: Optional[float] = None):
         """
         Send SCPI command to instrument
 
         Args:
             cmd (str): SCPI command
+            deadline_s: Time limit in seconds for the whole operation
 
         Send a SCPI command to the QSwitch, and check when ready for a new command by sending a query
         UDP connection: For relay open/close and *rst commands, only, it is checked if the command was well received
         """
-        if self._udp_mode: # UDP (ethernet) commands
-            cmd_lower = cmd.lower()
-            is_open_close_cmd = cmd_lower.find("clos ",0,12) != -1 or (cmd_lower.find("close ",0,12) != -1) or (cmd_lower.find("open ",0,12)  != -1) 
-            is_rst_cmd = (cmd_lower == "*rst")
-            counter = 0
-            while True: 
-                self._write(cmd)
-                # Check that relay command was well received
-                if (is_open_close_cmd or is_rst_cmd): 
-                    if (counter > 0) and self.verbose:
-                        self.log(f'{datetime.now()} UDP write repeat {counter} [{cmd}]')  # log repetition if verbose=True
-                    if is_open_close_cmd:
-                        splitcmd = cmd.split(" ") # split command name and channel representation
-                        reply = self.query(splitcmd[0]+"? "+splitcmd[1] if len(splitcmd)==2 else "") # use the written command as a query to verify state 
-                        if (len(reply) > 0) and (reply.find("0") == -1):  # verify that the relays have switched
-                            return
-                    elif is_rst_cmd:
-                        reply = self.query("clos:stat?")  
-                        if (reply == "(@1!0:24!0)"):  # verify that the relays are in the default state
+        with self._within(deadline_s):
+            self._breaker.check()
+            if self._udp_mode: # UDP (ethernet) commands
+                cmd_lower = cmd.lower()
+                check = self._verification_query(cmd)
+                counter = 0
+                while True: 
+                    self._write(cmd)
+                    # Check that relay command was well received
+                    if check: 
+                        if (counter > 0) and self.verbose:
+                            self.log(f'{datetime.now()} UDP write repeat {counter} [{cmd}]')  # log repetition if verbose=True
+                        reply = self.query(check)
+                        if self._is_verified(cmd, reply):
                             return
-                    counter += 1
-                    if self.verbose: 
-                        self.log(f"{datetime.now()} UDP: {counter} failed check of [{cmd_lower}], result: {reply}")
-                    if (counter >= self._config.write_attempts):  # throw error when max attempts is reached
-                        raise ValueError(f'QSwitch {self._config.ip} (UDP): Command check failure [{cmd_lower}] after {self._config.write_attempts} attempts')
-                else:
-                    self.query('*opc?')
+                        counter += 1
+                        self._pacer.on_loss()
+                        if self.verbose: 
+                            self.log(f"{datetime.now()} UDP: {counter} failed check of [{cmd_lower}], result: {reply}")
+                        if (counter >= self._config.write_attempts):  # throw error when max attempts is reached
+                            raise ValueError(f'QSwitch {self._config.ip} (UDP): Command check failure [{cmd_lower}] after {self._config.write_attempts} attempts')
+                    else:
+                        self.query('*opc?')
+                        return
+            else: # VISA (USB) commands
+                try:
+                    self._write(cmd)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    self._visa_failure(e, [cmd])
+                self._unsynced.append(cmd)
+                if not self._sync_deferred or len(self._unsynced) >= DEFERRED_SYNC_LIMIT:
+                    self._sync()
+                return
+
+    def write_many(self, cmds: Sequence[str], deadline_s: Optional[float] = None) -> None:
+        """
+        Send several SCPI commands to instrument
+
+        Args:
+            cmds (Sequence[str]): SCPI commands, executed in order
+            deadline_s: Time limit in seconds for the whole operation
+
+        UDP connection: The commands are packed into as few datagrams as
+        possible.  Relay open/close and *rst commands are then checked with
+        pipelined queries, and those not well received are sent again.
+        VISA: The commands are written one by one, and synchronised with a
+        single *opc? at the end, or later inside batch() or with defer_sync.
+        """
+        with self._within(deadline_s):
+            if not self._udp_mode:
+                with self.batch():
+                    for cmd in cmds:
+                        self.write(cmd)
+                return
+            self._breaker.check()
+            pending = list(cmds)
+            counter = 0
+            while pending:
+                self._write_packed(pending)
+                checks = [self._verification_query(cmd) for cmd in pending]
+                replies = iter(self.query_many([check for check in checks if check] + ['*opc?']))
+                failed = [cmd for cmd, check in zip(pending, checks)
+                          if check and not self._is_verified(cmd, next(replies))]
+                if not failed:
                     return
-        else: # VISA (USB) commands
-            try:
-                self._write(cmd)
-                self._query('*opc?')
-            except Exception as e:
-                if self.verbose: 
-                    self.log(f'{datetime.now()} VISA error: {repr(e)}')
-                raise ValueError(f"QSwitch VISA error: {repr(e)}")
-            return
+                counter += 1
+                self._pacer.on_loss()
+                if self.verbose:
+                    self.log(f"{datetime.now()} UDP: {counter} failed check of {failed}")
+                if (counter >= self._config.write_attempts):
+                    raise ValueError(f'QSwitch {self._config.ip} (UDP): Command check failure {failed} after {self._config.write_attempts} attempts')
+                pending = failed
 
-    def query(self, cmd: str) -> str:
+    def query(self, cmd: str, deadline_s: Optional[float] = None) -> str:
         """
         Send a SCPI query to the QSwitch
 
         Args:
             cmd (str): SCPI query command
+            deadline_s: Time limit in seconds for the whole operation
 
         UDP: Repeat query until a reply is received
+        VISA: Commands whose *opc? was deferred are synchronised first
+        """
+        with self._within(deadline_s):
+            self._sync()
+            self._breaker.check()
+            # Only try once when finding out if an unresponsive QSwitch is back
+            attempts = 1
+            if self._udp_mode and self._breaker.state != HALF_OPEN:
+                attempts = self._config.query_attempts
+            try:
+                answer = self._query(cmd, attempts)
+            except DeadlineExceeded:
+                raise
+            except ValueError:
+                self._record_failure()
+                raise
+            self._breaker.record_success()
+            return answer
+
+    def query_many(self, cmds: Sequence[str], group_size: int = 8,
+                   window: int = 2, deadline_s: Optional[float] = None) -> List[str]:
         """
-        if self._udp_mode: # UDP (ethernet) queries
-            if self._record_commands:
-                self._scpi_sent.append(cmd)
-            counter = 0
-            time_before_next = 0.1
-            while True:
-                try:
-                    self.clear()
-                    time_before = datetime.now()
-                    self._sock.sendto(f"{cmd}\n".encode(), (self._config.ip, 5025))
-                    sleep_s(self._config.delay_s)
-                    # Wait for response
-                    data, _ = self._sock.recvfrom(1024)
-                    answer = data.decode().strip()
-                    if (counter > 0) and self.verbose: 
-                        self.log(f'{datetime.now()} UDP query repeat {counter} [{cmd}]')
-                    return answer
-                except Exception as error:
-                    counter += 1
-                    if self.verbose:
-                        self.log(f'{time_before} - {datetime.now().time()} UDP query error {counter} [{cmd}]: {repr(error)}')
-                    if (counter >= self._config.query_attempts):
-                        raise ValueError(f'QSwitch {self._config.ip} (UDP): Query timeout [{cmd}] after {self._config.query_attempts} attempts')
-                    sleep_s(time_before_next)
-                    time_before_next += 0.5   # Next time we wait even longer so that we do not quickly run out of retries
-        else: # VISA (USB) queries
-            answer = self._query(cmd)
-        return answer
+        Send several SCPI queries to the QSwitch without waiting for each answer
+
+        Args:
+            cmds (Sequence[str]): SCPI query commands
+            group_size (int): Number of queries between fences
+            window (int): Number of groups in flight at the same time
+            deadline_s: Time limit in seconds for the whole operation
+
+        Returns:
+            List[str]: The answers, in the same order as the queries
+
+        UDP: The queries are sent in groups, each followed by a *IDN? fence.
+        The answers of a group are only accepted when the fence answer comes
+        right after them, otherwise the group is sent again.  *IDN? is used
+        rather than *opc? because its answer cannot be mistaken for the
+        answer to a relay query.  *IDN? queries in cmds are therefore not sent,
+        they are answered with the identification read when connecting.
+        VISA: The queries are sent one by one.
+        """
+        if not self._udp_mode:
+            return [self.query(cmd, deadline_s) for cmd in cmds]
+        sent = [cmd for cmd in cmds if not _is_identification_query(cmd)]
+        answers = iter(self._query_pipelined(sent, group_size, window, deadline_s))
+        return [self._identification if _is_identification_query(cmd)
+                else next(answers) for cmd in cmds]
+
+    @contextmanager
+    def batch(self, deadline_s: Optional[float] = None):
+        """
+        Write commands in the block without waiting for each to finish
+
+        VISA: Instead of a *opc? query after every command, a single one is
+        sent at the end of the block, or before the first query in it.  If
+        it fails, the error names all the commands since the previous one.
+        UDP: No difference, commands are checked as usual.
+
+        Args:
+            deadline_s: Time limit in seconds for the synchronisation at the end
+        """
+        deferred = self._sync_deferred
+        self._sync_deferred = True
+        try:
+            yield self
+        finally:
+            self._sync_deferred = deferred
+        if deferred:
+            return  # An outer batch, or defer_sync, synchronises later
+        self.sync(deadline_s)
+
+    def sync(self, deadline_s: Optional[float] = None) -> None:
+        """
+        Wait until the QSwitch has carried out all commands written so far
+
+        Only needed with VISAConfig(defer_sync=True), as queries synchronise
+        by themselves.
+
+        Args:
+            deadline_s: Time limit in seconds for the whole operation
+        """
+        with self._within(deadline_s):
+            self._sync()
 
     def clear(self) -> None:
         """
@@ -461,26 +806,20 @@ class QSwitch:
         or flush the input buffer for a UDP connection (FW >= 1.9).
         In USB-serial mode, do nothing. 
         """
-        if self._udp_mode: # UDP (ethernet) clear
-            self._sock.settimeout( 0.0001 )
-            while True:
-                try:
-                    data,_ = self._sock.recvfrom(1024)
-                except:
-                    break
-            self._sock.settimeout( self._config.timeout_ms / 1000)
-        else:  # VISA (USB) clear
-            if (self._switch.resource_class == "SOCKET"):
-                self._switch.clear()
+        self.transport.clear()
             
     def close(self):
         """
         Close the QSwitch instrument 
         """
+        self.stop_journal()
         if self._udp_mode:
-            self._sock.close()
-        else:
-            self._switch.close()
+            self.transport.close()
+            return
+        try:
+            self._sync()
+        finally:
+            conn.visa_pool.release(self._config.visaAddress)
 
     # ----------------------------------------------------------------------
     # Debugging and testing
@@ -513,11 +852,49 @@ class QSwitch:
         self._message_flush_timeout_ms = 1
         self._round_off = None
     
+    @contextmanager
+    def _within(self, deadline_s: Optional[float]):
+        """
+        Limit the time of all communication within the block
+
+        Nested limits can only make the time shorter.
+        Args:
+            deadline_s (float): Time limit in seconds, or None for no limit
+        """
+        outer = self._deadline
+        self._deadline = outer.within(deadline_s)
+        self.transport.deadline = self._deadline
+        try:
+            yield
+        finally:
+            self._deadline = outer
+            self.transport.deadline = outer
+
+    def _wait_until_ready(self, limit_s: float) -> None:
+        """
+        Poll the QSwitch until it answers again, for example after a reset
+        Args:
+            limit_s (float): Time limit used when the caller gave no deadline
+        """
+        if self._deadline.remaining() is not None:
+            limit_s = None
+        with self._within(limit_s):
+            while True:
+                try:
+                    # Serial replies arrive in order, so only UDP can poll with
+                    # a shorter timeout without risking a late, stale answer
+                    with self._within(READY_POLL_S if self._udp_mode else None):
+                        self._query('*opc?')
+                    return
+                except ValueError:
+                    self._deadline.check('Waiting for the QSwitch')
+
     def _check_for_wrong_model(self) -> None:
         """
         Check if the instrument is a QSwitch
         """
-        model = self.query('*IDN?').split(',')[1]
+        self._identification = self.query('*IDN?')
+        model = self._identification.split(',')[1]
         if model != 'QSwitch':
             raise ValueError(f'Unknown model {model}. Are you using the right'
                              ' driver for your instrument?')
@@ -526,9 +903,9 @@ class QSwitch:
         """
         Check if the firmware is 0.178 or above
         """
-        firmware = self.query('*IDN?').split(',')[3]
+        firmware = self._identification.split(',')[3]
         least_compatible_fw = '0.178'
-        if parse(firmware) < parse(least_compatible_fw):
+        if _version(firmware) < _version(least_compatible_fw):
             raise ValueError(f'Incompatible firmware {firmware}. You need at '
                              f'least {least_compatible_fw}')
         
@@ -546,45 +923,196 @@ class QSwitch:
         if self._record_commands:
             self._scpi_sent.append(cmd)
 
-        if self._udp_mode: # UDP (ethernet) write
+        self.transport.write(cmd)
+
+    def _drain(self) -> int:
+        """
+        Throw away all UDP datagrams waiting to be read
+        Returns:
+            The number of datagrams thrown away
+        """
+        return self.transport.discard_input()
+
+    def _query_pipelined(self, cmds: Sequence[str], group_size: int, window: int,
+                         deadline_s: Optional[float]) -> List[str]:
+        """
+        Send UDP queries in fenced groups, see query_many()
+        Args:
+            cmds (Sequence[str]): SCPI query commands, without *IDN?
+        Returns:
+            The answers, in the same order as the queries
+        """
+        with self._within(deadline_s):
+            self._breaker.check()
+            groups = [cmds[i:i + group_size] for i in range(0, len(cmds), group_size)]
+            answers: List[str] = []
+            first = 0
+            failures = 0
+            while first < len(groups):
+                self._drain()
+                in_flight = groups[first:first + window]
+                for group in in_flight:
+                    self._send_group(group)
+                for group in in_flight:
+                    replies = self._receive_group(len(group))
+                    if replies is None:
+                        break
+                    answers += replies
+                    first += 1
+                    for _ in replies:
+                        self._pacer.on_success()
+                else:
+                    continue
+                failures += 1
+                self._pacer.on_loss()
+                if self.verbose:
+                    self.log(f'{datetime.now()} UDP pipelined query group {first} lost, resending ({failures})')
+                if failures >= self._config.query_attempts:
+                    self._breaker.record_failure()
+                    raise ValueError(f'QSwitch {self._config.ip} (UDP): Pipelined query timeout after {failures} attempts')
+            self._breaker.record_success()
+            return answers
+
+    def _send_group(self, cmds: Sequence[str]) -> None:
+        """
+        Send UDP queries back to back, followed by a fence
+        Args:
+            cmds (Sequence[str]): SCPI query commands
+        """
+        self._write_packed(list(itertools.chain(cmds, ['*IDN?'])))
+
+    def _receive_group(self, size: int) -> Optional[List[str]]:
+        """
+        Receive the UDP answers to a group of queries sent by _send_group
+        Args:
+            size (int): Number of queries in the group, not counting the fence
+        Returns:
+            The answers, or None if answers were lost
+        """
+        replies: List[str] = []
+        while len(replies) <= size:
             try:
-                self._sock.sendto(f"{cmd}\n".encode(), (self._config.ip, 5025))
-            except Exception as e:
-                self.log(f'{datetime.now()} UDP write Error: {repr(e)}')  # raise?
-                raise ValueError(f'QSwitch {self._config.ip} (UDP): Write Error [{cmd}]: {repr(e)}')
-        else: # VISA (USB) write
-            self._switch.write(cmd)
+                reply = self.transport.read()
+            except DeadlineExceeded:
+                raise
+            except ValueError:
+                return None
+            if reply == self._identification:
+                return replies if len(replies) == size else None
+            replies.append(reply)
+        return None
+
+    def _write_packed(self, cmds: Sequence[str]) -> None:
+        """
+        Write SCPI messages to QSwitch over UDP, several per datagram
+        Args:
+            cmds (Sequence[str]): SCPI messages
+        """
+        if self._record_commands:
+            self._scpi_sent.extend(cmds)
+        self.transport.write_many(cmds)
+
+    def _verification_query(self, cmd: str) -> Optional[str]:
+        """
+        Query that tells if a relay open/close or *rst command was well received
+        Args:
+            cmd (str): SCPI command
+        Returns:
+            The query, or None if the command cannot be checked
+        """
+        cmd_lower = cmd.lower()
+        if cmd_lower.find("clos ",0,12) != -1 or (cmd_lower.find("close ",0,12) != -1) or (cmd_lower.find("open ",0,12)  != -1):
+            splitcmd = cmd.split(" ") # split command name and channel representation
+            if len(splitcmd) == 2:
+                return splitcmd[0]+"? "+splitcmd[1] # use the written command as a query to verify state
+        elif cmd_lower == "*rst":
+            return "clos:stat?"
+        return None
+
+    def _is_verified(self, cmd: str, reply: str) -> bool:
+        """
+        Check the answer to the query from _verification_query
+        Args:
+            cmd (str): SCPI command
+            reply (str): answer to the verification query
+        """
+        if cmd.lower() == "*rst":
+            return reply == "(@1!0:24!0)"  # verify that the relays are in the default state
+        return (len(reply) > 0) and (reply.find("0") == -1)  # verify that the relays have switched
 
-    def _query(self, cmd:str) -> str:
+    def _query(self, cmd: str, attempts: int = 1) -> str:
         """
         Send SCPI query to QSwitch and receive answer
 
         Args:
             cmd (str): SCPI query command
+            attempts (int): Number of times to send the query if no answer comes
         """
         if self._record_commands:
             self._scpi_sent.append(cmd)
+        return self.transport.query(cmd, attempts)
 
-        if self._udp_mode: # UDP (ethernet) query
-            try:
-                self.clear()
-                self._sock.sendto(f"{cmd}\n".encode(), (self._config.ip, 5025))
-                sleep_s(self._config.delay_s)
-                # Wait for response
-                data, _ = self._sock.recvfrom(1024)
-                answer = data.decode().strip()
-            except Exception as error:
-                if self.verbose:
-                    self.log(f'{datetime.now()} QSwitch failed UDP query [{cmd}] (1st try): {repr(error)}')
-                raise ValueError(f'QSwitch failed UDP query [{cmd}] (1st try): {repr(error)}')
-        else: # VISA (USB) query
-            try:
-                answer = self._switch.query(cmd)
-            except visa.errors.VisaIOError as error:
-                if self.verbose:
-                    self.log(f'{datetime.now()} QSwitch failed VISA query [{cmd}] (1st try): {repr(error)}')
-                raise ValueError(f'QSwitch failed VISA query [{cmd}] (1st try): {repr(error)}')
-        return answer
+    def _sync(self) -> None:
+        """
+        Wait for the commands written without *opc? (VISA)
+        """
+        if not self._unsynced:
+            return
+        pending = self._unsynced
+        self._unsynced = []
+        try:
+            self._query('*opc?')
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            self._visa_failure(e, pending)
+        self._breaker.record_success()
+
+    def _record_failure(self) -> None:
+        """
+        Count a failure towards opening the circuit breaker
+
+        VISA: There is no probe, so first check with *opc? that the QSwitch
+        really does not answer.  A query it silently ignores, for example a
+        mistyped one, then does not make all drivers fail fast.
+        """
+        if not self._udp_mode and self._still_answers():
+            self._breaker.record_success()
+            return
+        self._breaker.record_failure()
+
+    def _still_answers(self) -> bool:
+        """
+        Tell if the QSwitch answers *opc? within FAILURE_CHECK_LIMIT_S, so
+        that an unplugged QSwitch still fails fast
+        """
+        try:
+            with self._within(FAILURE_CHECK_LIMIT_S):
+                if self._query('*opc?') != '1':
+                    # A late answer to the failed query came first
+                    self.transport.read()
+            return True
+        except ValueError:
+            return False
+
+    def _visa_failure(self, error: Exception, cmds: Sequence[str]) -> None:
+        """
+        Log and count a failed VISA command, and raise an error naming it
+        Args:
+            error (Exception): What went wrong
+            cmds (Sequence[str]): Commands that may not have been carried out
+        """
+        if self.verbose:
+            self.log(f'{datetime.now()} VISA error: {repr(error)}')
+        self._record_failure()
+        raise ValueError(f"QSwitch VISA error after {list(cmds)}: {repr(error)}")
+
+    def _log_verbose(self, message: str) -> None:
+        """
+        Log a message if verbose is set
+        """
+        if self.verbose:
+            self.log(f'{datetime.now()} {message}')
 
     def _channel_list_to_overview(self, channel_list: str) -> dict[str, List[str]]:
         """
@@ -664,6 +1192,11 @@ class QSwitch:
             channel_list (str): channel list notation of closed relays
         """
         self._state = channel_list
+        if self._journal:
+            # Changed behind our back, for example by a reset or another client
+            state = self._channel_list_to_state(channel_list)
+            if not self._journal.expects(state):
+                self._journal.record_snapshot(state)
 
     def _effectuate(self, state: State) -> None:
         """
@@ -673,56 +1206,28 @@ class QSwitch:
         """
         currently = self._channel_list_to_state(self._state)
         positive, negative, total = self._state_diff(currently, state)
+        # Relays that stay closed may be closed again, and relays that stay
+        # open may be opened again, if that gives a shorter channel list
+        stay_closed = frozenset(currently) & frozenset(state)
+        stay_open = ALL_RELAYS - frozenset(currently) - frozenset(state)
+        cmds = []
         if positive:
-            self.write(f'clos {self._state_to_compressed_list(positive)}')
+            cmds.append(f'clos {self._state_to_shortest_list(positive, stay_closed)}')
         if negative:
-            self.write(f'open {self._state_to_compressed_list(negative)}')
+            cmds.append(f'open {self._state_to_shortest_list(negative, stay_open)}')
+        if cmds:
+            self.write_many(cmds)
+        if self._journal:
+            self._journal.record_change(positive, negative)
         self._set_state_raw(self._state_to_compressed_list(total))
 
-    def _line_tap_split(self, input: str) -> Tuple[int, int]:
-        """
-        Splits the line and tap commands from the channel list
-        Args:
-            input (str): line and tap numbers separated by !
-        """
-        pair = input.split('!')
-        if len(pair) != 2:
-            raise ValueError(f'Expected channel pair, got {input}')
-        if not pair[0].isdecimal():
-            raise ValueError(f'Expected channel, got {pair[0]}')
-        if not pair[1].isdecimal():
-            raise ValueError(f'Expected channel, got {pair[1]}')
-        return int(pair[0]), int(pair[1])
-
-
     def _channel_list_to_state(self, channel_list: str) -> State:
         """
         Converts channel list notation to the State notation
         Args:
             channel_list (str): channel list notation of closed relays
         """
-        outer = re.match(r'\(@([0-9,:! ]*)\)', channel_list)
-        result: List[Tuple[int, int]] = []
-        if len(channel_list)==0:
-            return result
-        elif not outer:
-            raise ValueError(f'Expected channel list, got {channel_list}')
-        sequences = outer[1].split(',')
-        for sequence in sequences:
-            limits = sequence.split(':')
-            if limits == ['']:
-                raise ValueError(f'Expected channel sequence, got {limits}')
-            line_start, tap_start = self._line_tap_split(limits[0])
-            line_stop, tap_stop = line_start, tap_start
-            if len(limits) == 2:
-                line_stop, tap_stop = self._line_tap_split(limits[1])
-            if len(limits) > 2:
-                raise ValueError(f'Expected channel sequence, got {limits}')
-            if tap_start != tap_stop:
-                raise ValueError(f'Expected same breakout in sequence, got {limits}')
-            for line in range(line_start, line_stop+1):
-                result.append((line, tap_start))
-        return result
+        return codec.channel_list_to_state(channel_list)
 
     def _state_to_expanded_list(self, state: State) -> str:
         """
@@ -730,10 +1235,7 @@ class QSwitch:
         Args:
             state (State): state of the relays
         """
-        return \
-            '(@' + \
-            ','.join([f'{line}!{tap}' for (line, tap) in state]) + \
-            ')'
+        return codec.state_to_expanded_list(state)
 
     def _state_to_compressed_list(self, state: State) -> str:
         """
@@ -741,36 +1243,17 @@ class QSwitch:
         Args:
             state (State): state of the relays
         """
-        tap_to_line: Dict[int, Set[int]] = dict()
-        for line, tap in state:
-            tap_to_line.setdefault(tap, set()).add(line)
-        taps = list(tap_to_line.keys())
-        taps.sort()
-        intervals = []
-        for tap in taps:
-            start_line = None
-            end_line = None
-            lines = list(tap_to_line[tap])
-            lines.sort()
-            for line in lines:
-                if not start_line:
-                    start_line = line
-                    end_line = line
-                    continue
-                if line == end_line + 1:
-                    end_line = line
-                    continue
-                if start_line == end_line:
-                    intervals.append(f'{start_line}!{tap}')
-                else:
-                    intervals.append(f'{start_line}!{tap}:{end_line}!{tap}')
-                start_line = line
-                end_line = line
-            if start_line == end_line:
-                intervals.append(f'{start_line}!{tap}')
-            else:
-                intervals.append(f'{start_line}!{tap}:{end_line}!{tap}')
-        return '(@' + ','.join(intervals) + ')'
+        return codec.state_to_compressed_list(state)
+
+    def _state_to_shortest_list(self, state: State, optional: State = ()) -> str:
+        """
+        Converts state notation to the shortest channel list that contains
+        all relays in state and otherwise only relays in optional
+        Args:
+            state (State): relays that must be in the list
+            optional (State): relays that may be in the list
+        """
+        return codec.state_to_shortest_list(state, optional)
 
     def _state_diff(self, before: State, after: State) -> Tuple[State, State, State]:
         """
@@ -783,20 +1266,48 @@ class QSwitch:
         target = frozenset(after)
         return list(target - initial), list(initial - target), list(target)
     
+def _version(text: str) -> Tuple[int, ...]:
+    """
+    Firmware version as numbers that compare in the right order
+    """
+    return tuple(int(part) for part in re.findall(r'\d+', text))
+
+
+def _is_identification_query(cmd: str) -> bool:
+    return cmd.strip().lower() == '*idn?'
+
+
+def _udp_probe(ip: str, timeout_s: float = 0.2) -> bool:
+    """
+    Check if a QSwitch answers on UDP, using a separate socket
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout_s)
+        try:
+            sock.sendto(b'*opc?\n', (ip, 5025))
+            sock.recvfrom(1024)
+            return True
+        except OSError:
+            return False
+
 # ----------------------------------------------------------------------
 # USB detection   
 # ----------------------------------------------------------------------
 
-def find_qswitch_on_usb() -> str:
+def find_qswitch_on_usb(serial_number: Optional[str] = None) -> str:
+    import serial.tools.list_ports as list_ports
     signature = '04D8:00DD'
     candidates = list(list_ports.grep(signature))
+    if serial_number:
+        candidates = [candidate for candidate in candidates
+                      if candidate.serial_number == serial_number]
     if len(candidates) == 1:
         handle = candidates[0].device
     elif (len(candidates) > 1):
         raise ValueError(f'More than one device with signature {signature} found')
     else:
         raise ValueError(f'No device with signature {signature} found')
-    if platform_system() == 'Windows':
+    if conn.os_platform() == 'windows':
         if handle[:3].lower() == 'com':
             handle = handle[3:]
     return f'ASRL{handle}::INSTR'
\ No newline at end of file
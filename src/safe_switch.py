@@ -0,0 +1,247 @@
+"""
+Relay changes on a QSwitch that keep the connected device safe from
+voltage steps coming from the QDAC-II.
+
+QSwitch line N carries QDAC-II channel N when its input relay (tap 9) is
+closed.  Before such a line is grounded, connected to a breakout or
+disconnected, the QDAC-II channel has to be at the potential of what the
+line is switched to (0 V, or the breakout potential), and afterwards it can
+go back to its previous voltage.
+
+The scheduler works out which channels need ramping, and overlaps the work
+so that the dead time is as short as possible:
+
+- all ramps run at the same time, on the QDAC-II,
+- relays on lines that need no ramping move while the ramps run,
+- the remaining relays move in one go as soon as the slowest ramp is done,
+- the channels are ramped back, optionally without waiting for it, unless
+  the line stays connected to a breakout or ground, in which case the
+  channel stays at the safe voltage.
+
+The slew rates of the ramped channels are put back as they were once the
+ramps are over, at the latest by the next execute() or by close().
+
+Use like this:
+
+import qdac2
+import qswitch_driver
+import common.connection as conn
+from safe_switch import SafeSwitcher, VoltageConstraints
+qdac = qdac2.QDAC2(conn.find_qdac2_on_usb())
+qswitch = qswitch_driver.QSwitch(qswitch_driver.UDPConfig(ip='192.168.8.100'))
+switcher = SafeSwitcher(qdac, qswitch, VoltageConstraints(breakout_potentials={1: 0.5}))
+plan = switcher.plan([(line, 9) for line in range(1, 25)])
+print(plan)
+switcher.execute(plan)
+"""
+
+from dataclasses import dataclass, field
+from time import monotonic, sleep as sleep_s
+from typing import Dict, FrozenSet, List, Sequence, Set, Tuple
+from common.worker import InstrumentWorker
+import qdac2
+import qswitch_driver
+
+INPUT_TAP = 9
+GROUND_TAP = 0
+
+State = Sequence[Tuple[int, int]]
+
+
+@dataclass
+class VoltageConstraints:
+    # Potential on each breakout connector (1-8), default 0 V
+    breakout_potentials: Dict[int, float] = field(default_factory=dict)
+    # Voltage steps at least this small need no ramping
+    tolerance_v: float = 0.001
+    # Ramp rate of the QDAC-II channels
+    slew_v_per_s: float = 1.0
+    # Extra wait after the computed end of a ramp, before moving relays
+    ramp_margin_s: float = 0.005
+    # Time for relays to settle after moving
+    relay_settle_s: float = 0.01
+
+
+@dataclass
+class SwitchPlan:
+    # Relay moves on lines that need no ramping, done while ramping
+    free_close: FrozenSet[Tuple[int, int]]
+    free_open: FrozenSet[Tuple[int, int]]
+    # QDAC-II channel: (present voltage, safe voltage)
+    ramps: Dict[int, Tuple[float, float]]
+    # Relay moves on the ramped lines, done once the ramps are finished
+    guarded_close: FrozenSet[Tuple[int, int]]
+    guarded_open: FrozenSet[Tuple[int, int]]
+    # Ramped channels that go back to their present voltage afterwards
+    restore: FrozenSet[int]
+    slew_v_per_s: float
+    relay_settle_s: float
+
+    @property
+    def ramp_time_s(self) -> float:
+        """
+        Time for the slowest ramp to the safe voltages
+        """
+        steps = [abs(safe - present) for present, safe in self.ramps.values()]
+        return max(steps, default=0) / self.slew_v_per_s
+
+
+class SafeSwitcher:
+    """
+    Safe relay changes on a QSwitch connected to a QDAC-II
+    """
+
+    def __init__(self, qdac: qdac2.QDAC2, qswitch: qswitch_driver.QSwitch,
+                 constraints: VoltageConstraints = VoltageConstraints()):
+        self.qdac = qdac
+        self.qswitch = qswitch
+        self.constraints = constraints
+        self._relays = InstrumentWorker(qswitch)
+        # Slew rates of ramped channels as they were, in QDAC-II notation
+        self._saved_slews: Dict[int, str] = dict()
+        self._ramping_until = 0.0
+
+    def plan(self, target: State) -> SwitchPlan:
+        """
+        Work out how to get to a relay state safely from the present one
+
+        Args:
+            target: All relays that should be closed afterwards
+        """
+        before = frozenset(self.qswitch.closed_relays())
+        after = frozenset(target)
+        closing = after - before
+        opening = before - after
+        changed_lines = {line for line, _ in closing | opening}
+        ramps: Dict[int, Tuple[float, float]] = dict()
+        for line in sorted(changed_lines):
+            if (line, INPUT_TAP) not in before | after:
+                continue  # The QDAC-II channel is not involved
+            safe = self._safe_voltage(line, before, after)
+            present = float(self.qdac.query(f'sour{line}:volt?'))
+            if abs(present - safe) > self.constraints.tolerance_v:
+                ramps[line] = (present, safe)
+        guarded = set(ramps)
+        # A channel left connected to a breakout or ground has to stay there
+        restore = frozenset(line for line in ramps
+                            if (line, INPUT_TAP) not in after or
+                            not any(other_line == line and tap != INPUT_TAP
+                                    for other_line, tap in after))
+        return SwitchPlan(
+            free_close=_on_lines(closing, changed_lines - guarded),
+            free_open=_on_lines(opening, changed_lines - guarded),
+            ramps=ramps,
+            guarded_close=_on_lines(closing, guarded),
+            guarded_open=_on_lines(opening, guarded),
+            restore=restore,
+            slew_v_per_s=self.constraints.slew_v_per_s,
+            relay_settle_s=self.constraints.relay_settle_s)
+
+    def execute(self, plan: SwitchPlan, wait_for_restore: bool = True) -> None:
+        """
+        Carry out a plan made by plan()
+
+        Args:
+            plan: The relay moves and ramps
+            wait_for_restore: Wait until the restored channels are back at
+                              their previous voltages
+        """
+        self._finish_ramps()
+        free = self._relays.change_relays(plan.free_close, plan.free_open)
+        if not plan.ramps:
+            free.result()
+            return
+        ramps_done = monotonic() + self._ramp(plan.ramps)
+        free.result()
+        _sleep_until(ramps_done)
+        self._relays.change_relays(plan.guarded_close, plan.guarded_open).result()
+        sleep_s(plan.relay_settle_s)
+        back = {channel: (safe, present)
+                for channel, (present, safe) in plan.ramps.items()
+                if channel in plan.restore}
+        if back:
+            self._ramping_until = monotonic() + self._ramp(back)
+        if wait_for_restore or not back:
+            self._finish_ramps()
+
+    def switch(self, target: State, wait_for_restore: bool = True) -> SwitchPlan:
+        """
+        Plan and carry out a safe change to a relay state
+
+        Args:
+            target: All relays that should be closed afterwards
+            wait_for_restore: Wait until the ramped channels are back at
+                              their previous voltages
+        """
+        plan = self.plan(target)
+        self.execute(plan, wait_for_restore)
+        return plan
+
+    def close(self) -> None:
+        """
+        Stop the relay worker thread (the instruments stay open)
+        """
+        self._finish_ramps()
+        self._relays.close()
+
+    def _ramp(self, ramps: Dict[int, Tuple[float, float]]) -> float:
+        """
+        Start ramping channels at the same time
+
+        Args:
+            ramps: QDAC-II channel: (from voltage, to voltage)
+        Returns:
+            The time the slowest ramp takes, with a margin
+        """
+        slew = self.constraints.slew_v_per_s
+        cmds: List[str] = []
+        for channel, (_, volts) in ramps.items():
+            if channel not in self._saved_slews:
+                self._saved_slews[channel] = self.qdac.query(f'sour{channel}:volt:slew?')
+            cmds += [f'sour{channel}:volt:slew {slew}', f'sour{channel}:volt {volts}']
+        self.qdac.sequence(cmds)
+        steps = [abs(end - start) for start, end in ramps.values()]
+        return max(steps, default=0) / slew + self.constraints.ramp_margin_s
+
+    def _finish_ramps(self) -> None:
+        """
+        Wait for the ramps started earlier and put the slew rates back
+        """
+        _sleep_until(self._ramping_until)
+        if not self._saved_slews:
+            return
+        self.qdac.sequence([f'sour{channel}:volt:slew {slew}'
+                            for channel, slew in self._saved_slews.items()])
+        self._saved_slews.clear()
+
+    def _safe_voltage(self, line: int, before: FrozenSet[Tuple[int, int]],
+                      after: FrozenSet[Tuple[int, int]]) -> float:
+        """
+        Potential of everything the line is connected to before or after,
+        apart from the QDAC-II itself
+        """
+        potentials: Set[float] = set()
+        for other_line, tap in before | after:
+            if other_line != line or tap == INPUT_TAP:
+                continue
+            if tap == GROUND_TAP:
+                potentials.add(0.0)
+            else:
+                potentials.add(self.constraints.breakout_potentials.get(tap, 0.0))
+        if not potentials:
+            return 0.0
+        if max(potentials) - min(potentials) > self.constraints.tolerance_v:
+            raise ValueError(f'Line {line} would connect breakouts at different '
+                             f'potentials ({sorted(potentials)} V)')
+        return potentials.pop()
+
+
+def _on_lines(relays: FrozenSet[Tuple[int, int]],
+              lines: Set[int]) -> FrozenSet[Tuple[int, int]]:
+    return frozenset(relay for relay in relays if relay[0] in lines)
+
+
+def _sleep_until(moment: float) -> None:
+    remaining = moment - monotonic()
+    if remaining > 0:
+        sleep_s(remaining)
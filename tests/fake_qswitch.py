@@ -0,0 +1,64 @@
+"""
+A QSwitch stand-in on UDP, enough for the driver to connect and query relays.
+"""
+
+import re
+import socket
+import threading
+from typing import List, Optional, Set, Tuple
+
+from common.channel_list import channel_list_to_state, state_to_compressed_list
+
+
+class FakeQSwitch:
+    """
+    Answer SCPI datagrams sent to ip:5025 from a background thread
+    """
+
+    def __init__(self, ip: str = '127.0.0.77'):
+        self.ip = ip
+        self.received: List[str] = []
+        self.relays: Set[Tuple[int, int]] = {(line, 0) for line in range(1, 25)}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((ip, 5025))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def answer(self, cmd: str) -> Optional[str]:
+        self.received.append(cmd)
+        lowered = cmd.strip().lower()
+        if lowered == '*idn?':
+            return 'QDevil,QSwitch,1,1.10'
+        if lowered == 'stat?':
+            return state_to_compressed_list(sorted(self.relays))
+        if lowered == '*opc?':
+            return '1'
+        if lowered in ('all?', 'next?'):
+            return '0,"No error"'
+        match = re.match(r'(clos|open) (\(@.*\))', lowered)
+        if match:
+            relays = set(channel_list_to_state(match[2]))
+            if match[1] == 'clos':
+                self.relays |= relays
+            else:
+                self.relays -= relays
+            return None
+        if lowered.endswith('?'):
+            return '0'
+        return None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                data, sender = self._sock.recvfrom(65535)
+            except OSError:
+                return
+            for cmd in re.split(r'[;\n]', data.decode()):
+                if not cmd.strip():
+                    continue
+                reply = self.answer(cmd)
+                if reply is not None:
+                    self._sock.sendto(f'{reply}\n'.encode(), sender)
@@ -0,0 +1,32 @@
+import common.connection as conn
+
+
+class FakeSocket:
+    """
+    Hands out prepared results of recvfrom(), then reports no more data
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+
+    def recvfrom(self, size):
+        if not self.results:
+            raise BlockingIOError()
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_lan_answers_survive_connection_reset():
+    sock = FakeSocket([
+        ConnectionResetError(10054, 'An existing connection was forcibly closed'),
+        (b'QDevil,QSwitch,5,1.10\n', ('192.168.8.100', 5025)),
+        ConnectionRefusedError(),
+        (b'QDevil,QDAC-II,7,13-1.57\n', ('192.168.8.200', 5025)),
+    ])
+    found = dict()
+    conn._receive_lan_answers(sock, found)
+    assert sorted(found) == ['192.168.8.100', '192.168.8.200']
+    assert found['192.168.8.100'].model == 'QSwitch'
+    assert found['192.168.8.100'].serial == '5'
@@ -0,0 +1,23 @@
+import pytest
+
+import qswitch_driver
+from common.breaker import CLOSED
+from fake_qswitch import FakeQSwitch
+
+
+@pytest.fixture
+def udp_qswitch():
+    fake = FakeQSwitch()
+    qswitch = qswitch_driver.QSwitch(qswitch_driver.UDPConfig(
+        ip=fake.ip, timeout_ms=200, delay_s=0))
+    yield qswitch, fake
+    qswitch.close()
+    fake.close()
+
+
+def test_query_many_with_identification_query(udp_qswitch):
+    qswitch, fake = udp_qswitch
+    state = qswitch.query('stat?')
+    answers = qswitch.query_many(['stat?', '*IDN?', 'stat?'])
+    assert answers == [state, 'QDevil,QSwitch,1,1.10', state]
+    assert qswitch._breaker.state == CLOSED
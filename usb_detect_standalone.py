@@ -1,14 +1,18 @@
 # Requirements: pyserial, pyvisa, pyvisa-py
 
+from __future__ import annotations
 import sys
-import pyvisa as visa
 import serial.tools.list_ports as list_ports
 import serial
 import re
 from dataclasses import dataclass
-from typing import Sequence, Tuple, Optional
+from typing import Sequence, Tuple, Optional, List, TYPE_CHECKING
 from platform import system as platform_system
 
+# pyvisa is slow to import and only needed to open VISA resources
+if TYPE_CHECKING:
+    import pyvisa as visa
+
 
 @dataclass
 class Device:
@@ -47,6 +51,7 @@ def find_qswitch_on_usb(backend='@py') -> visa.Resource:
 
 
 def find_visa_device(address, description, backend='@py') -> visa.Resource:
+    import pyvisa as visa
     rm = resource_manager(backend)
     for tries in range(40):
         try:
@@ -59,6 +64,7 @@ def find_visa_device(address, description, backend='@py') -> visa.Resource:
 
 
 def resource_manager(backend=None) -> visa.ResourceManager:
+    import pyvisa as visa
     if backend:
         return visa.ResourceManager(backend)
     return visa.ResourceManager()  # Use default NI backend
@@ -96,72 +102,99 @@ def find_serial_devices() -> Sequence[Tuple[Device, str]]:
     return result
 
 
+class LineReader:
+    """
+    Answers from a serial port, one line at a time
+
+    A read returns as soon as the line terminator has arrived, instead of
+    waiting for a fixed number of bytes or for the timeout.  Bytes after the
+    terminator are kept for the next read, so several queries can be sent
+    at once and their answers read one by one (see query_many()).
+    """
+
+    def __init__(self, connection: serial.Serial):
+        """
+        Args:
+            connection: Open serial port, whose timeout limits the wait for
+                        each chunk of an answer
+        """
+        self.connection = connection
+        self._buffer = bytearray()
+
+    def query(self, cmd: str) -> str:
+        self.connection.write(f'{cmd}\n'.encode())
+        return self.readline()
+
+    def query_many(self, cmds: Sequence[str]) -> List[str]:
+        """
+        Send several queries in one write and return the answers in order
+        """
+        self.connection.write(''.join(f'{cmd}\n' for cmd in cmds).encode())
+        return [self.readline() for _ in cmds]
+
+    def readline(self) -> str:
+        while True:
+            end = self._buffer.find(b'\n')
+            if end >= 0:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + 1]
+                return line.decode('utf-8').strip()
+            chunk = self.connection.read(max(1, self.connection.in_waiting))
+            if not chunk:
+                raise ValueError(f'No answer from {self.connection.port}')
+            self._buffer += chunk
+
+
+def _line_reader(connection) -> LineReader:
+    if isinstance(connection, LineReader):
+        return connection
+    return LineReader(connection)
+
+
 def get_id(connection):
-    raw = bytes('*idn?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(40)
-    answer = data.decode('utf-8')
-    match = re.search('[^\n]+', answer)
-    return match[0]
+    return _line_reader(connection).query('*idn?')
 
 
 def get_ip_addr(connection):
-    raw = bytes('syst:comm:lan:ipad?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:ipad?')
     match = re.search('[0-9.]+', answer)
     return match[0]
 
 
 def get_mac_addr(connection):
-    raw = bytes('syst:comm:lan:mac?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:mac?')
     match = re.search('[0-9A-F:]+', answer)
     return match[0]
 
 
 def get_gateway(connection):
-    raw = bytes('syst:comm:lan:gat?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:gat?')
     match = re.search('[0-9.]+', answer)
     return match[0]
 
 
 def get_mask(connection):
-    raw = bytes('syst:comm:lan:smas?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:smas?')
     match = re.search('[0-9.]+', answer)
     return match[0]
 
 
 def get_name(connection):
-    raw = bytes('syst:comm:lan:host?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(30)
-    answer = data.decode('utf-8')
+    answer = _line_reader(connection).query('syst:comm:lan:host?')
     match = re.search('[^"]+', answer)
     return match[0]
 
 
 def get_dhcp(connection):
-    raw = bytes('syst:comm:lan:dhcp?\n', 'utf8')
-    connection.write(raw)
-    data = connection.read(3)
-    return (float(data.decode('utf-8')) == 1)
+    answer = _line_reader(connection).query('syst:comm:lan:dhcp?')
+    return (float(answer) == 1)
 
 
 def report_device_info():
     for device, serial_info in find_serial_devices():
         print(f'Found: {device.kind}')
         print(f'Port: {serial_info}')
-        connection = serial.Serial(serial_info, device.baud_rate, timeout=0.2)
+        connection = LineReader(serial.Serial(serial_info, device.baud_rate, timeout=0.2))
         id = get_id(connection)
         print(f'identification: {id}')
         mac_addr = get_mac_addr(connection)